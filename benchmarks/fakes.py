@@ -0,0 +1,400 @@
+import bisect
+import copy
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+# the parser is deployed on its own, so the fakes live next to it rather than in it
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firestore_to_BQ_parser'))
+from sinks import Sink
+
+# In-process stand-ins for the Firestore client and the BigQuery side (pandas_gbq reads and the
+# sinks), so the sync can run end to end without credentials - see sync_benchmark.py.
+
+
+def _utc(value):
+    """Firestore stores naive datetimes as UTC and returns them timezone-aware."""
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    if isinstance(value, dict):
+        return {k: _utc(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_utc(v) for v in value]
+    return value
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return self._data.get(field) if self._data else None
+
+
+class FakeDocumentRef:
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionRef(self.client, self.path.rsplit('/', 1)[0])
+
+    def get(self):
+        return FakeSnapshot(self, self.client.docs.get(self.path))
+
+    def set(self, data: Dict):
+        self.client.write(self.path, data)
+
+    def delete(self):
+        self.client.remove(self.path)
+
+    def collection(self, collection_id: str):
+        return FakeCollectionRef(self.client, f"{self.path}/{collection_id}")
+
+    def collections(self):
+        return [FakeCollectionRef(self.client, f"{self.path}/{c}") for c in sorted(self.client.subcollections.get(self.path, ()))]
+
+
+class FakeQuery:
+    """Filters, orders and cursors evaluated over the stored documents.
+
+    Like Firestore, documents are ordered by the order_by fields and then by name, and documents
+    missing a filtered or ordered field are left out. Sorted results are cached per query shape
+    until the next write to the collection (group), so paging through a large collection stays O(log n) per page.
+    """
+
+    def __init__(self, client, scope, filters=(), orders=(), limit_=None, start=None, end=None):
+        self.client = client
+        self.scope = scope  # ('collection', path) or ('group', collection_id)
+        self.filters = tuple(filters)
+        self.orders = tuple(orders)
+        self.limit_ = limit_
+        self.start = start  # (key, inclusive)
+        self.end = end
+
+    def _copy(self, **changes):
+        args = dict(filters=self.filters, orders=self.orders, limit_=self.limit_, start=self.start, end=self.end)
+        args.update(changes)
+        return FakeQuery(self.client, self.scope, **args)
+
+    def where(self, field: str, op: str, value):
+        value = tuple(_utc(value)) if op in ('in', 'not-in') else _utc(value)
+        return self._copy(filters=self.filters + ((field, op, value),))
+
+    def order_by(self, field: str, direction: str = 'ASCENDING'):
+        if field == '__name__':
+            return self
+        return self._copy(orders=self.orders + (field,))
+
+    def limit(self, count: int):
+        return self._copy(limit_=count)
+
+    def _cursor_key(self, cursor):
+        if isinstance(cursor, FakeSnapshot):
+            return tuple(cursor._data.get(f) for f in self.orders) + (cursor.reference.path,)
+        name = cursor.get('__name__')
+        return tuple(_utc(cursor.get(f)) for f in self.orders) + ((name.path if name is not None else ''),)
+
+    def start_after(self, cursor):
+        return self._copy(start=(self._cursor_key(cursor), False))
+
+    def start_at(self, cursor):
+        return self._copy(start=(self._cursor_key(cursor), True))
+
+    def end_before(self, cursor):
+        return self._copy(end=self._cursor_key(cursor))
+
+    def _sorted(self):
+        cache_key = (self.scope, self.filters, self.orders)
+        with self.client.lock:
+            cached = self.client.query_cache.get(cache_key)
+            version = self.client.versions.get(self.scope, 0)
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+            paths = self.client.scope_paths(self.scope)
+            rows = []
+            for path in paths:
+                data = self.client.docs[path]
+                if all(_match(data.get(f), op, v) for f, op, v in self.filters) and all(f in data for f in self.orders):
+                    rows.append((tuple(data[f] for f in self.orders) + (path,), path))
+            rows.sort(key=lambda r: r[0])
+            keys, paths = [r[0] for r in rows], [r[1] for r in rows]
+            self.client.query_cache[cache_key] = (version, keys, paths)
+            return keys, paths
+
+    def stream(self):
+        keys, paths = self._sorted()
+        lo, hi = 0, len(keys)
+        if self.start is not None:
+            key, inclusive = self.start
+            lo = (bisect.bisect_left if inclusive else bisect.bisect_right)(keys, key)
+        if self.end is not None:
+            hi = bisect.bisect_left(keys, self.end)
+        if self.limit_ is not None:
+            hi = min(hi, lo + self.limit_)
+        for path in paths[lo:hi]:
+            data = self.client.docs.get(path)
+            if data is not None:
+                yield FakeSnapshot(FakeDocumentRef(self.client, path), data)
+
+    def get(self):
+        return list(self.stream())
+
+    def get_partitions(self, partition_count: int):
+        """partition_count split points over the document names, so up to partition_count + 1 ranges."""
+        _, paths = self._copy(filters=(), orders=())._sorted()
+        points = [paths[len(paths) * (i + 1) // (partition_count + 1)] for i in range(partition_count)] if paths else []
+        bounds = [None] + [FakeDocumentRef(self.client, p) for p in dict.fromkeys(points)] + [None]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield FakePartition(start, end)
+
+
+class FakePartition:
+    def __init__(self, start_at, end_at):
+        self.start_at = start_at
+        self.end_at = end_at
+
+
+class FakeCollectionRef(FakeQuery):
+    def __init__(self, client, path: str):
+        super().__init__(client, ('collection', path))
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeDocumentRef(self.client, self.path.rsplit('/', 1)[0]) if '/' in self.path else None
+
+    def document(self, document_id: str):
+        return FakeDocumentRef(self.client, f"{self.path}/{document_id}")
+
+
+def _match(value, op, target) -> bool:
+    if op == 'in':
+        return value in target
+    if op == 'not-in':
+        return value is not None and value not in target
+    if value is None:
+        return op == '==' and target is None
+    try:
+        return {'==': value == target, '!=': value != target, '<': value < target, '<=': value <= target,
+                '>': value > target, '>=': value >= target}[op]
+    except TypeError:
+        return False
+
+
+class FakeFirestore:
+    """The subset of google.cloud.firestore.Client the streamer uses, backed by a dict of path -> fields."""
+
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+        self.collections_index: Dict[str, set] = {}  # collection path -> document paths
+        self.groups: Dict[str, set] = {}  # collection id -> document paths
+        self.subcollections: Dict[str, set] = {}  # document path -> collection ids
+        self.query_cache = {}
+        self.versions: Dict[tuple, int] = {}  # query scope -> number of writes, invalidates its cached results
+        self.lock = threading.RLock()
+
+    def collection(self, path: str):
+        return FakeCollectionRef(self, path)
+
+    def collection_group(self, collection_id: str):
+        return FakeQuery(self, ('group', collection_id))
+
+    def document(self, path: str):
+        return FakeDocumentRef(self, path)
+
+    def scope_paths(self, scope):
+        kind, name = scope
+        return list((self.collections_index if kind == 'collection' else self.groups).get(name, ()))
+
+    def _touched(self, collection_path: str):
+        for scope in (('collection', collection_path), ('group', collection_path.rsplit('/', 1)[-1])):
+            self.versions[scope] = self.versions.get(scope, 0) + 1
+
+    def write(self, path: str, data: Dict):
+        from firebase_admin import firestore
+        data = {k: datetime.now(timezone.utc) if v is firestore.SERVER_TIMESTAMP else _utc(v) for k, v in data.items()}
+        with self.lock:
+            collection_path = path.rsplit('/', 1)[0]
+            self.docs[path] = data
+            self.collections_index.setdefault(collection_path, set()).add(path)
+            self.groups.setdefault(collection_path.rsplit('/', 1)[-1], set()).add(path)
+            if '/' in collection_path:
+                parent, collection_id = collection_path.rsplit('/', 1)
+                self.subcollections.setdefault(parent, set()).add(collection_id)
+            self._touched(collection_path)
+
+    def remove(self, path: str):
+        with self.lock:
+            if self.docs.pop(path, None) is not None:
+                collection_path = path.rsplit('/', 1)[0]
+                self.collections_index[collection_path].discard(path)
+                self.groups[collection_path.rsplit('/', 1)[-1]].discard(path)
+                self._touched(collection_path)
+
+
+class FakeTableSink(Sink):
+    """Sink writing into a FakeBigQuery table (MERGE semantics applied when the table is read)."""
+
+    def __init__(self, bigquery, table_id: str, schema: List[Dict], write_disposition: str = "WRITE_APPEND",
+                 merge_key=None, target_bytes: int = 64 * 2**20):
+        super().__init__(schema, write_disposition if merge_key is None else "WRITE_APPEND", target_bytes)
+        self.bigquery = bigquery
+        self.table_id = table_id
+        self.merge_key = merge_key
+
+    def _write_table(self, table: pa.Table, write_disposition: str):
+        self.bigquery.append(self.table_id, table, write_disposition, self.merge_key)
+
+
+class FakeBigQuery:
+    """Tables as lists of Arrow tables, written through make_sink and read through read_gbq.
+
+    read_gbq understands the queries this package sends: a column list or *, an optional
+    `col >= TIMESTAMP('...')` filter, and the coverage GROUP BY user_id, metric aggregate.
+    """
+
+    def __init__(self):
+        self.tables: Dict[str, List[pa.Table]] = {}
+        self.merge_keys: Dict[str, object] = {}
+        self.queries: List[str] = []
+        self.lock = threading.Lock()
+
+    def create_table(self, table_id: str, schema: List[Dict]):
+        """An empty table, as the sync expects users3/observations3 to exist."""
+        from arrow_builder import arrow_schema
+        with self.lock:
+            self.tables[table_id] = [arrow_schema(schema).empty_table()]
+
+    def make_sink(self, backend: str, table_id: str, schema: List[Dict], project_id: str = None,
+                  write_disposition: str = "WRITE_APPEND", merge_key=None, **kwargs) -> Sink:
+        return FakeTableSink(self, table_id, schema, write_disposition, merge_key, **kwargs)
+
+    def append(self, table_id: str, table: pa.Table, write_disposition: str, merge_key=None):
+        with self.lock:
+            if write_disposition == "WRITE_TRUNCATE" or table_id not in self.tables:
+                self.tables[table_id] = []
+            self.tables[table_id].append(table)
+            if merge_key is not None:
+                self.merge_keys[table_id] = merge_key
+
+    def to_pandas(self, table_id: str) -> pd.DataFrame:
+        with self.lock:
+            tables = list(self.tables[table_id])
+            merge_key = self.merge_keys.get(table_id)
+        df = pa.concat_tables(tables, promote_options='default').to_pandas()
+        if merge_key is not None:
+            df = df.drop_duplicates([merge_key] if isinstance(merge_key, str) else list(merge_key), keep='last').reset_index(drop=True)
+        return df
+
+    def num_rows(self, table_id: str) -> int:
+        return len(self.to_pandas(table_id)) if table_id in self.tables else 0
+
+    def read_gbq(self, query: str, project_id: str = None, dialect: str = None, **kwargs) -> pd.DataFrame:
+        from google.api_core.exceptions import NotFound
+        self.queries.append(query)
+        table_id = re.search(r"FROM `([^`]+)`", query).group(1)
+        if table_id not in self.tables:
+            raise NotFound(f"Table {table_id} was not found")
+        df = self.to_pandas(table_id)
+        if 'GROUP BY user_id, metric' in query:
+            from coverage import batch_summary
+            return batch_summary(pa.Table.from_pandas(df, preserve_index=False)).to_pandas()
+        where = re.search(r"WHERE (\w+) >= TIMESTAMP\('([^']+)'\)", query)
+        if where:
+            df = df[df[where.group(1)] >= pd.Timestamp(where.group(2))]
+        selected = re.search(r"SELECT (.*?) FROM", query, re.S).group(1).strip()
+        if selected != '*':
+            df = df.loc[:, [c.strip() for c in selected.split(',')]]
+        return df.reset_index(drop=True)
+
+
+@contextmanager
+def fake_backends(firestore_client: FakeFirestore, bigquery: FakeBigQuery):
+    """Routes firestore.client(), pandas_gbq.read_gbq and make_sink (in every loaded module of this
+    package) to the fakes for the duration of the block."""
+    import firebase_admin
+    import pandas_gbq
+    from firebase_admin import firestore
+    patches = [(firestore, 'client', lambda *args, **kwargs: firestore_client),
+               (pandas_gbq, 'read_gbq', bigquery.read_gbq),
+               # a registered app makes FirestoreStreamer skip credential loading
+               (firebase_admin, '_apps', {'[DEFAULT]': object()})]
+    for name in ('sinks', 'main', 'coverage'):
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, 'make_sink'):
+            patches.append((module, 'make_sink', bigquery.make_sink))
+    originals = [(obj, attr, getattr(obj, attr)) for obj, attr, _ in patches]
+    for obj, attr, value in patches:
+        setattr(obj, attr, value)
+    try:
+        yield
+    finally:
+        for obj, attr, value in originals:
+            setattr(obj, attr, value)
+
+
+metric_collections = ['HealthObservations_HKQuantityTypeIdentifierStepCount', 'HealthObservations_HKQuantityTypeIdentifierHeartRate',
+                      'HealthObservations_HKQuantityTypeIdentifierRestingHeartRate', 'HealthObservations_HKQuantityTypeIdentifierHeartRateVariabilitySDNN',
+                      'HealthObservations_HKQuantityTypeIdentifierFlightsClimbed', 'HealthObservations_HKQuantityTypeIdentifierDistanceWalkingRunning',
+                      'HealthObservations_HKQuantityTypeIdentifierActiveEnergyBurned', 'HealthObservations_HKCategoryTypeIdentifierSleepAnalysis',
+                      'HealthObservations_HKWorkoutTypeIdentifier', 'HealthObservations_MHCHealthObservationTimedWalkingTestResultIdentifier']
+
+
+def populate(client: FakeFirestore, n_users: int = 100, n_metrics: int = 5, observations: int = 50, seed: int = 0,
+             start: Optional[datetime] = None) -> Dict:
+    """Fills the fake with users, the variables/healthobservation_cols list and `observations` documents
+    per user and metric (HealthObservations_* subcollections). Returns the counts written."""
+    rng = np.random.default_rng(seed)
+    start = start or datetime(2025, 1, 1, tzinfo=timezone.utc)
+    collections = [metric_collections[i % len(metric_collections)] + ('' if i < len(metric_collections) else str(i)) for i in range(n_metrics)]
+    client.write("variables/healthobservation_cols", {'cols': collections})
+    for u in range(n_users):
+        user_id = f"user{u:06d}"
+        enrolled = start - timedelta(days=int(rng.integers(30, 900)))
+        client.write(f"users/{user_id}", {
+            'dateOfEnrollment': enrolled, 'lastActiveDate': start - timedelta(hours=int(rng.integers(0, 240))),
+            'heightInCM': float(rng.normal(170, 10)), 'weightInKG': float(rng.normal(75, 12)),
+            'biologicalSexAtBirth': int(rng.integers(0, 2)), 'timeZone': 'Europe/London', 'language': 'en',
+            'comorbidities': {'hypertension': bool(rng.random() < 0.2)}, 'futureStudies': True,
+        })
+    n_observations = add_observations(client, n_users, collections, observations, issued_from=start - timedelta(days=1), seed=seed)
+    return {'users': n_users, 'collections': len(collections), 'observations': n_observations}
+
+
+def add_observations(client: FakeFirestore, n_users: int, collections: List[str], observations: int,
+                     issued_from: datetime, seed: int = 0) -> int:
+    """Writes `observations` documents per user and collection issued after issued_from (for delta runs)."""
+    rng = np.random.default_rng(seed + 1)
+    n = 0
+    for u in range(n_users):
+        user_id = f"user{u:06d}"
+        for collection in collections:
+            offsets = np.sort(rng.integers(0, 86400, observations))
+            values = rng.gamma(2.0, 50.0, observations)
+            for i in range(observations):
+                issued = issued_from + timedelta(seconds=int(offsets[i]) + 1)
+                begin = issued - timedelta(minutes=15)
+                doc = {'effectivePeriod': {'start': begin.isoformat(), 'end': issued.isoformat()}, 'issued': issued}
+                if collection.endswith('SleepAnalysis'):
+                    doc['valueString'] = 'asleep' if values[i] > 60 else 'inBed'
+                else:
+                    doc['valueQuantity'] = {'value': float(values[i]), 'unit': 'count'}
+                client.write(f"users/{user_id}/{collection}/{issued.strftime('%Y%m%d%H%M%S')}{i:05d}{seed}", doc)
+                n += 1
+    return n
@@ -0,0 +1,134 @@
+"""
+Offline end-to-end benchmark of the sync (firestore_to_BQ_parser/main.py) against the in-memory fakes in fakes.py.
+A standalone script, not a pytest(-benchmark) suite; it lives outside the deployed function source.
+
+Runs a full sync over synthetic users/observations, then a delta sync over newly issued ones, and
+reports throughput, per-collection latency and peak memory. Row counts in the fake BigQuery tables
+are checked against what was generated. With --baseline the run fails if throughput dropped by
+more than --tolerance against a previous --json output, so hot path changes can be regression-tested.
+
+Usage: python sync_benchmark.py [--users 200] [--metrics 6] [--observations 100] [--json out.json] [--baseline old.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+# the limiter would pace the fake reads like real ones - set before rate_limiter is imported
+os.environ.setdefault("FIRESTORE_READS_PER_SEC", "1e9")
+scratch = tempfile.mkdtemp()
+os.environ.setdefault("USER_REGISTRY_CACHE", os.path.join(scratch, "users_in_BQ.npz"))
+os.environ.setdefault("COVERAGE_CACHE", os.path.join(scratch, "coverage.parquet"))
+
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firestore_to_BQ_parser'))
+import main as sync
+from fakes import FakeBigQuery, FakeFirestore, add_observations, fake_backends, populate
+from pipeline import peak_rss_mb
+from utils import observations_schema, users_schema
+
+observations_table = "myheart_counts_development.observations3"
+
+
+def timed_sync(firestore_client, bigquery) -> dict:
+    """One main() run on the fakes with its wall time, traced peak memory and per-collection latencies."""
+    tracemalloc.start()
+    tic = time.perf_counter()
+    with fake_backends(firestore_client, bigquery):
+        summary = sync.main()
+    seconds = time.perf_counter() - tic
+    traced_mb = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    latencies = np.array([r['total_seconds'] for r in summary['results']])
+    return {'observations': summary['observations'], 'seconds': seconds,
+            'rows_per_sec': summary['observations'] / seconds if seconds else 0.0,
+            'collection_p50_seconds': float(np.median(latencies)) if len(latencies) else 0.0,
+            'collection_max_seconds': float(latencies.max()) if len(latencies) else 0.0,
+            'traced_peak_mb': traced_mb, 'errors': [r['collection'] for r in summary['results'] if r['error']],
+            # hot path latency percentiles of the run (see instrumentation)
+            'latency_seconds': {name: {k: h[k] for k in ('count', 'p50', 'p99')} for name, h in summary['metrics']['latency_seconds'].items()}}
+
+
+def run(n_users: int, n_metrics: int, observations: int, workers: int, partitions: int, batch_size: int) -> dict:
+    sync.max_workers, sync.partition_count, sync.batch_size = workers, partitions, batch_size
+    firestore_client, bigquery = FakeFirestore(), FakeBigQuery()
+    bigquery.create_table("myheart_counts_development.users3", users_schema)
+    bigquery.create_table(observations_table, observations_schema)
+    tic = time.perf_counter()
+    counts = populate(firestore_client, n_users, n_metrics, observations)
+    print(f"generated {counts['observations']} observations of {n_users} users in {counts['collections']} collections "
+          f"({time.perf_counter() - tic:.1f}s)")
+
+    full = timed_sync(firestore_client, bigquery)
+    assert not full['errors'], f"collections failed: {full['errors']}"
+    assert bigquery.num_rows(observations_table) == counts['observations'], "full sync lost or duplicated observations"
+    assert bigquery.num_rows("myheart_counts_development.users3") == n_users
+
+    # a delta: one more day of observations, issued after the full sync
+    cols = firestore_client.document("variables/healthobservation_cols").get().to_dict()['cols']
+    last_sync = firestore_client.document("_sync_metadata/last_sync").get().to_dict()['timestamp']
+    added = add_observations(firestore_client, n_users, cols, max(1, observations // 10), last_sync + timedelta(seconds=1), seed=1)
+    delta = timed_sync(firestore_client, bigquery)
+    assert not delta['errors'], f"collections failed: {delta['errors']}"
+    assert delta['observations'] == added, f"delta sync uploaded {delta['observations']} of {added} new observations"
+    assert bigquery.num_rows(observations_table) == counts['observations'] + added
+    coverage = bigquery.to_pandas("myheart_counts_development.coverage3")
+    assert coverage['count'].sum() == counts['observations'] + added, "coverage counts differ from the observations"
+
+    return {'config': {'users': n_users, 'metrics': n_metrics, 'observations': observations, 'workers': workers,
+                       'partitions': partitions, 'batch_size': batch_size},
+            'full': full, 'delta': delta, 'peak_rss_mb': peak_rss_mb()}
+
+
+def report(result: dict):
+    for name in ('full', 'delta'):
+        r = result[name]
+        print(f"{name:>5}: {r['observations']} obs in {r['seconds']:.2f}s ({r['rows_per_sec']:,.0f} rows/sec), "
+              f"collection p50 {r['collection_p50_seconds']:.2f}s max {r['collection_max_seconds']:.2f}s, traced peak {r['traced_peak_mb']:.0f} MB")
+        for stage, h in sorted(r['latency_seconds'].items()):
+            print(f"       {stage}: {h['count']} x p50 {h['p50'] * 1000:.1f}ms p99 {h['p99'] * 1000:.1f}ms")
+    print(f"peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    """Throughput figures that fell more than tolerance below the baseline."""
+    found = []
+    for name in ('full', 'delta'):
+        old, new = baseline[name]['rows_per_sec'], result[name]['rows_per_sec']
+        if old and new < old * (1 - tolerance):
+            found.append(f"{name}: {new:,.0f} rows/sec vs {old:,.0f} in the baseline")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--metrics", type=int, default=6)
+    parser.add_argument("--observations", type=int, default=100, help="per user and metric")
+    parser.add_argument("--workers", type=int, default=sync.max_workers)
+    parser.add_argument("--partitions", type=int, default=sync.partition_count)
+    parser.add_argument("--batch-size", type=int, default=sync.batch_size)
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--baseline", help="results of an earlier run to compare throughput with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    result = run(args.users, args.metrics, args.observations, args.workers, args.partitions, args.batch_size)
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        if found:
+            print("throughput regression:\n  " + "\n  ".join(found))
+            sys.exit(1)
+        print("no throughput regression")
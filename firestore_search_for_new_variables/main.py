@@ -1,12 +1,17 @@
 import os
 import logging
-import numpy as np
 import firebase_admin
 from firebase_admin import credentials, firestore
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 local_flag = False
+# concurrent list_collections calls - they are network bound, so well above the 0.5 CPU
+max_workers = int(os.environ.get("DISCOVERY_MAX_WORKERS", 16))
+# probe every user instead of only those created/active since the last discovery run
+full_scan = os.environ.get("DISCOVERY_FULL_SCAN", "false").lower() == "true"
 
 class FirestoreStreamer:
     """Focuses solely on streaming data out of Firestore efficiently."""
@@ -30,6 +35,41 @@ class FirestoreStreamer:
                 cred = credentials.ApplicationDefault()
                 
             firebase_admin.initialize_app(cred)
+
+    def get_users(self, since=None):
+        """Yields user document references - only users enrolled or active after `since` when given."""
+        user_col = self.db.collection("users")
+        if since is None:
+            # list_documents only returns references, it does not read the user documents
+            yield from user_col.list_documents(page_size=1000)
+            return
+        seen = set()
+        for field in ("dateOfEnrollment", "lastActiveDate"):
+            for doc in user_col.where(field, ">", since).select([field]).stream():
+                if doc.id not in seen:
+                    seen.add(doc.id)
+                    yield doc.reference
+
+
+def list_observation_cols(user_ref):
+    return {col.id for col in user_ref.collections() if col.id.startswith("HealthObservations")}
+
+def discover_cols(user_refs, max_workers):
+    """Lists the HealthObservations subcollections of every user through a bounded pool of list_collections calls."""
+    found, probed = set(), 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for user_ref in user_refs:
+            pending.add(executor.submit(list_observation_cols, user_ref))
+            probed += 1
+            # keep a bounded number of calls in flight instead of one future per user
+            if len(pending) >= max_workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found |= future.result()
+        for future in pending:
+            found |= future.result()
+    return found, probed
     
 
 def main():
@@ -39,17 +79,20 @@ def main():
 
     streamer = FirestoreStreamer(logger)
     
+    cols_ref = streamer.db.collection("variables").document("healthobservation_cols")
+    cols_doc = cols_ref.get()
+    state = cols_doc.to_dict() if cols_doc.exists else {}
+    since = None if full_scan else state.get("last_discovery")
+    discovery_start = datetime.now(timezone.utc)
+    if since:
+        logger.info(f"Incremental discovery - probing users enrolled or active since {since}")
+
     # check for users first
-    healthobservation_cols = []
-    user_col = streamer.db.collection("users")
-    for user_doc in user_col.stream():
-        user_id = user_doc.id
-        for col in user_col.document(user_id).collections():
-            if col.id.startswith("HealthObservations"):
-                healthobservation_cols.append(col.id)
-    # deduplicate column names
-    healthobservation_cols = np.unique(healthobservation_cols).tolist()
-    streamer.db.collection("variables").document("healthobservation_cols").set({"cols": healthobservation_cols})
+    found, probed = discover_cols(streamer.get_users(since), max_workers)
+    # incremental runs only see some users, so merge into the known columns
+    healthobservation_cols = sorted(found | set(state.get("cols", [])) if since else found)
+    cols_ref.set({"cols": healthobservation_cols, "last_discovery": discovery_start})
+    logger.info(f"Probed {probed} users, {len(set(healthobservation_cols) - set(state.get('cols', [])))} new columns")
     logger.info(f"Identified {len(healthobservation_cols)} unique health observation columns: {healthobservation_cols}")
 
 if __name__ == "__main__":
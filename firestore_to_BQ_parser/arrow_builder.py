@@ -0,0 +1,165 @@
+import numpy as np
+import pyarrow as pa
+from datetime import datetime
+from typing import Dict, List, Optional
+from instrumentation import instruments
+
+bq_to_arrow = {
+    'STRING': pa.string(),
+    'FLOAT64': pa.float64(),
+    'INT64': pa.int64(),
+    'BOOL': pa.bool_(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+}
+
+def arrow_schema(schema: List[Dict], dictionary_columns=()) -> pa.Schema:
+    """pyarrow schema for a BigQuery schema given as a list of {'name', 'type'} dicts."""
+    fields = []
+    for field in schema:
+        field_type = bq_to_arrow[field['type']]
+        if field['name'] in dictionary_columns:
+            field_type = pa.dictionary(pa.int32(), field_type)
+        fields.append(pa.field(field['name'], field_type))
+    return pa.schema(fields)
+
+def string_array(values: List) -> pa.Array:
+    try:
+        return pa.array(values, type=pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # a few documents store non-string values (e.g. timestamps) - keep their text form
+        return pa.array([v if v is None or isinstance(v, str) else str(v) for v in values], type=pa.string())
+
+
+class ObservationBatchBuilder:
+    """Fills preallocated column buffers from observation documents of one collection group.
+
+    user_id is dictionary-encoded per batch, metric is a constant dictionary column and value is a
+    float64 buffer with a null mask. Strings and timestamps are collected in preallocated lists
+    and converted by pyarrow in one call per column when the batch is flushed.
+    """
+
+    def __init__(self, metric: str, schema: List[Dict], capacity: int = 10000, synced_at: Optional[datetime] = None):
+        self.metric = metric
+        self.capacity = capacity
+        self.synced_at = synced_at
+        self.schema = arrow_schema(schema, dictionary_columns=('user_id', 'metric'))
+        self.user_codes = np.empty(capacity, dtype=np.int32)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.value_nulls = np.empty(capacity, dtype=bool)
+        self.units = [None] * capacity
+        self.value_strs = [None] * capacity
+        self.starts = [None] * capacity
+        self.ends = [None] * capacity
+        self.issued = [None] * capacity
+        self.reset()
+
+    def reset(self):
+        self.size = 0
+        self.user_ids = {}  # user_id -> dictionary code
+
+    def __len__(self):
+        return self.size
+
+    def append(self, user_id: str, data: Dict) -> bool:
+        """Adds one observation document's fields, returns True once the batch is full."""
+        period = data.get('effectivePeriod')
+        if not period or not isinstance(period, dict):
+            return False
+
+        i = self.size
+        code = self.user_ids.get(user_id)
+        if code is None:
+            code = self.user_ids[user_id] = len(self.user_ids)
+        self.user_codes[i] = code
+
+        quantity = data.get('valueQuantity') or {}
+        value = quantity.get('value')
+        if value is not None and (type(value) is not float and type(value) is not int):
+            # a bool or a value float() cannot parse is stored as null rather than failing the batch
+            try:
+                value = None if isinstance(value, bool) else float(value)
+            except (TypeError, ValueError):
+                value = None
+            if value is None:
+                instruments.count("invalid_values")
+        self.value_nulls[i] = value is None
+        self.values[i] = 0.0 if value is None else value
+        self.units[i] = quantity.get('unit')
+        self.value_strs[i] = data.get('valueString')
+        self.starts[i] = period.get('start')
+        self.ends[i] = period.get('end')
+        self.issued[i] = data.get('issued')
+
+        self.size += 1
+        return self.size >= self.capacity
+
+    def flush(self) -> pa.RecordBatch:
+        """Emits the buffered rows as a RecordBatch matching the schema and empties the builder."""
+        n = self.size
+        timestamp = bq_to_arrow['TIMESTAMP']
+        columns = {
+            # buffers are reused by the next batch, so numpy slices are copied
+            'user_id': pa.DictionaryArray.from_arrays(pa.array(self.user_codes[:n].copy()),
+                                                      pa.array(list(self.user_ids), type=pa.string())),
+            'metric': pa.DictionaryArray.from_arrays(pa.array(np.zeros(n, dtype=np.int32)),
+                                                     pa.array([self.metric], type=pa.string())),
+            'value': pa.array(self.values[:n].copy(), mask=self.value_nulls[:n].copy()),
+            'unit': string_array(self.units[:n]),
+            'value_str': string_array(self.value_strs[:n]),
+            'start': string_array(self.starts[:n]),
+            'end': string_array(self.ends[:n]),
+            'issued': pa.array(self.issued[:n], type=timestamp),
+            'synced_at': pa.repeat(pa.scalar(self.synced_at, type=timestamp), n) if self.synced_at is not None else pa.nulls(n, timestamp),
+        }
+        arrays = [columns[f.name] if f.name in columns else pa.nulls(n, f.type) for f in self.schema]
+        self.reset()
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+def benchmark(n_docs: int = 200000, n_users: int = 2000, batch_size: int = 10000, repeat: int = 3):
+    """Times the list-of-dicts + DataFrame path against the columnar builder on synthetic documents."""
+    import time
+    import pandas as pd
+    from datetime import timedelta, timezone
+    from utils import observation_dict, observations_schema
+
+    rng = np.random.default_rng(0)
+    t0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    docs = []
+    for i in range(n_docs):
+        start = t0 + timedelta(minutes=int(i))
+        docs.append((f"user{rng.integers(n_users):05d}", {
+            'effectivePeriod': {'start': start.isoformat(), 'end': (start + timedelta(minutes=15)).isoformat()},
+            'valueQuantity': {'value': float(rng.random() * 1000), 'unit': 'count'},
+            'issued': start,
+        }))
+    metric = 'StepCount'
+
+    def dict_path():
+        rows = []
+        for user_id, data in docs:
+            rows.append(observation_dict(metric, user_id, data))
+        return pd.DataFrame(rows)
+
+    def arrow_path():
+        builder = ObservationBatchBuilder(metric, observations_schema, capacity=batch_size)
+        batches = []
+        for user_id, data in docs:
+            if builder.append(user_id, data):
+                batches.append(builder.flush())
+        if len(builder):
+            batches.append(builder.flush())
+        return batches
+
+    for name, path in [('dicts + DataFrame', dict_path), ('arrow builder', arrow_path)]:
+        timings = []
+        for _ in range(repeat):
+            tic = time.perf_counter()
+            path()
+            timings.append(time.perf_counter() - tic)
+        best = min(timings)
+        print(f"{name:>18}: {best:.3f}s best of {repeat} ({n_docs / best:,.0f} docs/sec)")
+
+
+if __name__ == "__main__":
+    benchmark()
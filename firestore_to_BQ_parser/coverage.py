@@ -0,0 +1,222 @@
+import os
+import threading
+import pandas as pd
+import pandas_gbq as pdg
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from google.api_core.exceptions import NotFound
+from sinks import make_sink
+
+coverage_schema = [
+    {'name': 'user_id', 'type': 'STRING'},
+    {'name': 'metric', 'type': 'STRING'},
+    {'name': 'start_min', 'type': 'STRING'},
+    {'name': 'start_max', 'type': 'STRING'},
+    {'name': 'count', 'type': 'INT64'},
+    {'name': 'value_min', 'type': 'FLOAT64'},
+    {'name': 'value_max', 'type': 'FLOAT64'},
+    {'name': 'value_sum', 'type': 'FLOAT64'},
+    {'name': 'value_count', 'type': 'INT64'},
+    {'name': 'null_count', 'type': 'INT64'},
+    {'name': 'updated_at', 'type': 'TIMESTAMP'}
+]
+columns = [f['name'] for f in coverage_schema[2:-1]]
+
+# how each column of two summaries of the same (user_id, metric) combine
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+def _sum(a, b):
+    return b if a is None else a if b is None else a + b
+
+combine = [_min, _max, _sum, _min, _max, _sum, _sum, _sum]
+
+
+def is_not_found(e: Exception) -> bool:
+    """True for a missing table - pandas_gbq re-raises the API's NotFound as the cause of its own exception."""
+    return isinstance(e, NotFound) or isinstance(e.__cause__, NotFound)
+
+
+def batch_summary(batch) -> pa.Table:
+    """Per (user_id, metric) aggregates of one batch of observation rows, in coverage column order."""
+    table = batch if isinstance(batch, pa.Table) else pa.Table.from_batches([batch])
+    table = pa.table({'user_id': table['user_id'].cast(pa.string()), 'metric': table['metric'].cast(pa.string()),
+                      'start': table['start'], 'value': table['value']})
+    summary = table.group_by(['user_id', 'metric']).aggregate([
+        ('start', 'min'), ('start', 'max'), ('value', 'count', pc.CountOptions('all')),
+        ('value', 'min'), ('value', 'max'), ('value', 'sum'),
+        ('value', 'count', pc.CountOptions('only_valid')), ('value', 'count', pc.CountOptions('only_null'))])
+    return pa.Table.from_arrays(summary.columns, names=summary.column_names[:2] + columns)
+
+
+class CoverageSummary:
+    """Per (user_id, metric) coverage of the observations table - first/last start, row count, value
+    min/max/sum/count and null count - maintained incrementally by the sync.
+
+    Every uploaded batch is folded into the state once the checkpoint covering it is saved; only the (user_id, metric) rows it changed are
+    upserted to the coverage table. Like UserRegistry, the state is cached locally between runs
+    (COVERAGE_CACHE) with the largest updated_at, so a refresh only downloads rows updated since.
+    A cold start without a coverage table aggregates the observations table once, as does rebuild()
+    when the table may have missed changes (see main.py). Other BigQuery errors are raised, so the
+    caller can sync without coverage instead of rewriting the table.
+    """
+
+    def __init__(self, logger, table: str = "myheart_counts_development.coverage3",
+                 observations_table: str = "myheart_counts_development.observations3",
+                 project_id: str = "myheart-counts-development", cache_path: Optional[str] = None):
+        self.logger = logger
+        self.table = table
+        self.observations_table = observations_table
+        self.project_id = project_id
+        self.cache_path = cache_path or os.environ.get("COVERAGE_CACHE", "/tmp/coverage.parquet")
+        self.state: Dict[Tuple[str, str], list] = {}
+        self.changed = set()
+        self.watermark = None
+        self.table_exists = True
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.state)
+
+    def fold(self, batch):
+        """Adds a RecordBatch/Table of observation rows (user_id, metric, start, value) to the summary."""
+        self.fold_summary(batch_summary(batch))
+
+    def fold_summary(self, summary: pa.Table):
+        """Adds a batch_summary to the summary - callers can hold summaries until their rows are committed."""
+        if not summary.num_rows:
+            return
+        rows = zip(zip(summary['user_id'].to_pylist(), summary['metric'].to_pylist()),
+                   zip(*(summary[c].to_pylist() for c in columns)))
+        with self.lock:
+            for key, values in rows:
+                current = self.state.get(key)
+                self.state[key] = list(values) if current is None else [f(a, b) for f, a, b in zip(combine, current, values)]
+                self.changed.add(key)
+
+    def _frame(self, keys) -> pd.DataFrame:
+        keys = list(keys)
+        df = pd.DataFrame([self.state[k] for k in keys], columns=columns)
+        df.insert(0, 'user_id', [k[0] for k in keys])
+        df.insert(1, 'metric', [k[1] for k in keys])
+        return df
+
+    def _set_frame(self, df: pd.DataFrame):
+        # NaN from pandas back to None, so combine skips it
+        df = df.astype(object).where(df.notna(), None)
+        for row in df.itertuples(index=False):
+            self.state[(row.user_id, row.metric)] = [getattr(row, c) for c in columns]
+
+    def to_pandas(self) -> pd.DataFrame:
+        with self.lock:
+            return self._frame(self.state)
+
+    def load(self) -> bool:
+        """Loads the local cache, returns False if there is none for this table."""
+        if not os.path.exists(self.cache_path):
+            return False
+        try:
+            table = pq.read_table(self.cache_path)
+            if (table.schema.metadata or {}).get(b'table', b'').decode() != self.table:
+                return False
+            self._set_frame(table.to_pandas())
+            watermark = table.schema.metadata[b'watermark'].decode()
+            self.watermark = pd.Timestamp(watermark) if watermark else None
+            self.logger.info(f"Loaded coverage of {len(self.state)} user/metric pairs (updated up to {self.watermark})")
+            return True
+        except Exception as e:
+            self.logger.warning(f"Could not load coverage cache {self.cache_path}: {e}")
+            return False
+
+    def save(self):
+        """Persists the state as Parquet, replacing the cache file atomically."""
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            table = pa.Table.from_pandas(self.to_pandas(), preserve_index=False).replace_schema_metadata(
+                {'table': self.table, 'watermark': self.watermark.isoformat() if self.watermark is not None else ''})
+            pq.write_table(table, tmp_path, compression='zstd')
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            self.logger.warning(f"Could not save coverage cache {self.cache_path}: {e}")
+
+    def refresh(self):
+        """Loads the cache and fetches the coverage rows updated since its watermark (the whole table on a cold cache)."""
+        if not self.state:
+            self.load()
+        query = f"SELECT * FROM `{self.table}`"
+        if self.watermark is not None:
+            query += f" WHERE updated_at >= TIMESTAMP('{self.watermark.isoformat()}')"
+        try:
+            df = pdg.read_gbq(query, project_id=self.project_id, dialect="standard")
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            self.logger.warning(f"No coverage table {self.table}, aggregating {self.observations_table} once")
+            self.rebuild()
+            return
+        with self.lock:
+            self._set_frame(df.loc[:, ['user_id', 'metric', *columns]])
+            if len(df) and df['updated_at'].notna().any():
+                latest = pd.Timestamp(df['updated_at'].max())
+                self.watermark = latest if self.watermark is None else max(self.watermark, latest)
+        self.logger.info(f"Coverage refreshed: {len(df)} rows fetched, {len(self.state)} user/metric pairs")
+        self.save()
+
+    def rebuild(self):
+        """Replaces the state with an aggregate of the observations table; the next upload rewrites the whole coverage table."""
+        with self.lock:
+            self.state, self.changed = {}, set()
+        self.table_exists = False
+        self.bootstrap()
+
+    def bootstrap(self):
+        """Builds the state from the observations already in BigQuery (none on a fresh deployment)."""
+        query = f"""SELECT user_id, metric, MIN(start) start_min, MAX(start) start_max, COUNT(*) `count`,
+MIN(value) value_min, MAX(value) value_max, SUM(value) value_sum, COUNT(value) value_count, COUNTIF(value IS NULL) null_count
+FROM `{self.observations_table}` GROUP BY user_id, metric"""
+        try:
+            df = pdg.read_gbq(query, project_id=self.project_id, dialect="standard")
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            self.logger.warning(f"No observations table {self.observations_table} yet, coverage starts empty")
+            return
+        with self.lock:
+            self._set_frame(df)
+            # everything goes into the new table
+            self.changed.update(self.state)
+        self.logger.info(f"Coverage bootstrapped from {self.observations_table}: {len(self.state)} user/metric pairs")
+
+    def upload(self, sink_backend: str, updated_at: Optional[datetime] = None) -> int:
+        """Upserts the rows changed since the last upload to the coverage table, returns their number."""
+        updated_at = pd.Timestamp(updated_at if updated_at is not None else datetime.now())
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.tz_localize("UTC")
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            df = self._frame(changed)
+        if not len(df):
+            return 0
+        df['updated_at'] = updated_at
+        try:
+            if self.table_exists:
+                sink = make_sink(sink_backend, self.table, coverage_schema, project_id=self.project_id, merge_key=('user_id', 'metric'))
+            else:
+                # MERGE needs an existing table - the first upload creates it with the whole state
+                sink = make_sink(sink_backend, self.table, coverage_schema, project_id=self.project_id, write_disposition="WRITE_TRUNCATE")
+            with sink:
+                sink.write(df)
+        except Exception:
+            with self.lock:
+                self.changed.update(changed)
+            raise
+        self.table_exists = True
+        self.watermark = updated_at if self.watermark is None else max(self.watermark, updated_at)
+        self.save()
+        return len(df)
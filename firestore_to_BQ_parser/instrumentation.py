@@ -0,0 +1,157 @@
+import json
+import os
+import random
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+import numpy as np
+from pipeline import peak_rss_mb
+
+# forward spans and metrics to OpenTelemetry (configured through the usual OTEL_* variables) - needs opentelemetry-api
+otel_enabled = os.environ.get("SYNC_OTEL", "") not in ("", "0")
+# "cprofile" writes a cProfile dump, "py-spy" attaches py-spy record to this process; output in SYNC_PROFILE_PATH
+profile_mode = os.environ.get("SYNC_PROFILE", "")
+profile_path = os.environ.get("SYNC_PROFILE_PATH", "/tmp/sync_profile")
+
+
+class Histogram:
+    """Count, sum and max of all observations plus a reservoir sample of up to `size` of them for percentiles."""
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.samples = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.size:
+                self.samples[i] = value
+
+    def summary(self) -> Dict:
+        p50, p99 = np.percentile(self.samples, [50, 99]) if self.samples else (0.0, 0.0)
+        return {'count': self.count, 'sum': self.total, 'p50': float(p50), 'p99': float(p99), 'max': self.max}
+
+
+class Instruments:
+    """Counters, latency histograms and spans of the sync hot path, summarized once per run.
+
+    Calls are cheap enough for per-page/per-batch use (a lock and a list append); per-document
+    work is counted in blocks by the callers. With SYNC_OTEL set, every span and counter is also
+    recorded through the OpenTelemetry API, so any configured SDK exporter picks them up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.otel = None
+        if otel_enabled:
+            try:
+                from opentelemetry import metrics, trace
+                self.otel = (trace.get_tracer("firestore_to_bq"), metrics.get_meter("firestore_to_bq"), {}, {})
+            except ImportError:
+                pass
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.counters: Dict[str, float] = {}
+            self.histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.otel:
+            self._otel_instrument(2, name, 'create_counter').add(value)
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+        if self.otel:
+            self._otel_instrument(3, name, 'create_histogram').record(value)
+
+    def _otel_instrument(self, kind: int, name: str, create: str):
+        instruments = self.otel[kind]
+        if name not in instruments:
+            instruments[name] = getattr(self.otel[1], create)(name)
+        return instruments[name]
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Times the block into the `name` histogram (seconds), as an OpenTelemetry span when enabled."""
+        otel_span = self.otel[0].start_as_current_span(name, attributes=attributes) if self.otel else None
+        if otel_span is not None:
+            otel_span.__enter__()
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - tic)
+            if otel_span is not None:
+                otel_span.__exit__(None, None, None)
+
+    def summary(self, limiter=None) -> Dict:
+        """The run summary: counters and their per-second rates, latency percentiles, Firestore read/retry metrics and peak RSS."""
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            counters = dict(self.counters)
+            latencies = {name: h.summary() for name, h in self.histograms.items()}
+        summary = {'finished_at': datetime.now().isoformat(), 'elapsed_seconds': elapsed, 'counters': counters,
+                   'rates': {f'{name}_per_sec': value / elapsed for name, value in counters.items() if elapsed},
+                   'latency_seconds': latencies, 'peak_rss_mb': peak_rss_mb()}
+        if limiter is not None:
+            summary['firestore_reads'] = limiter.metrics()
+        return summary
+
+
+def to_json(summary: Dict) -> str:
+    return json.dumps(summary, default=str, sort_keys=True)
+
+
+@contextmanager
+def profiled(mode: Optional[str] = None, path: Optional[str] = None):
+    """Profiles the block when SYNC_PROFILE (or mode) is 'cprofile' or 'py-spy'; does nothing otherwise."""
+    mode = profile_mode if mode is None else mode
+    path = path or profile_path
+    if mode == "cprofile":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    elif mode == "py-spy":
+        import shutil
+        import subprocess
+        py_spy = shutil.which("py-spy")
+        process = subprocess.Popen([py_spy, "record", "--pid", str(os.getpid()), "--output", path + ".svg", "--nonblocking"]) if py_spy else None
+        try:
+            yield
+        finally:
+            if process is not None:
+                # py-spy writes its output on SIGINT
+                process.send_signal(signal.SIGINT)
+                process.wait(timeout=60)
+    else:
+        yield
+
+
+# one instance shared by every reader and sink in the process
+instruments = Instruments()
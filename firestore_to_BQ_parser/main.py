@@ -8,136 +8,312 @@ issued since the last run, avoiding redundant full-table scans.
 Key Features:
 - Delta sync using 'issued' timestamp to detect new health observations
 - Processes multiple HealthObservations subcollections per user
-- Pagination support for large datasets
-- Periodic checkpointing to CSV for recovery
+- Pagination support for large datasets, with adaptive page size
+- Shared AIMD rate limiter for Firestore reads with jittered retries (FIRESTORE_READS_PER_SEC)
+- Partitioned collection group scans read concurrently (SYNC_PARTITIONS)
+- Concurrent per-collection read/upload (SYNC_MAX_WORKERS, 1 = sequential)
+- Bounded-memory streaming upload in micro-batches (SYNC_BATCH_SIZE, SYNC_MAX_PENDING_BATCHES)
+- Pluggable BigQuery sinks sized by bytes: Parquet load jobs or Storage Write API (SYNC_SINK)
+- Per-collection/per-partition checkpoints in _sync_metadata/checkpoints; interrupted or
+  time-boxed runs (SYNC_TIME_BUDGET) resume where they stopped
 - Sync metadata tracking in Firestore (_sync_metadata collection)
-- Automatic skipping of users with no new data
+- Delta user sync on lastActiveDate/dateOfEnrollment watermarks, upserted with MERGE. Profile edits
+  that leave both fields alone, and users without either field, are invisible to the watermarks, so
+  every USERS_FULL_SCAN_DAYS (or with USERS_FULL_SCAN=true) all users are streamed once more
+- Per (user_id, metric) coverage summary (first/last start, counts, value min/max/sum) folded in
+  batch by batch; only changed rows are upserted to coverage3. Coverage never blocks the sync: if it
+  cannot be refreshed or uploaded, _sync_metadata/coverage is marked stale and the next run rebuilds
+  it from observations3
+- Counters and latency histograms of the hot path (Firestore pages/blocks, decoding, Arrow builds,
+  sink writes), logged as one JSON run summary and stored in _sync_metadata/last_run (+ /history);
+  exported through OpenTelemetry with SYNC_OTEL=1, profiled with SYNC_PROFILE=cprofile|py-spy
 
 Workflow:
 1. Retrieves last sync timestamp from Firestore metadata
-2. Iterates through all users, checking for new observations (issued > last_sync_time)
+2. Streams users changed since the stored watermarks, then new observations (issued > last_sync_time)
 3. Filters and collects only newly issued health observations
-4. Uploads users and observations to BigQuery (append mode)
+4. Upserts users and appends observations to BigQuery
 5. Updates sync metadata with current timestamp for next run
 
 Requirements:
 - Firestore composite index on 'issued' field for each HealthObservations subcollection
-- BigQuery tables: users3, observations3
+- BigQuery tables: users3, observations3 (coverage3 is created on the first run)
 - Firestore collection: _sync_metadata/last_sync (auto-created on first run)
+- Firestore documents: _sync_metadata/checkpoints (removed when a run completes)
 
 Note: This script assumes that the 'issued' field is properly set on health observation documents and that the Firestore structure follows the expected pattern (users/{user_id}/HealthObservations_{
 """
 
 import os
 import pandas as pd
-import pandas_gbq as pdg
 import logging
 import time
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from utils import FirestoreStreamer
+from pipeline import UploadPipeline, peak_rss_mb
+from sinks import make_sink
+from coverage import CoverageSummary, batch_summary
+from instrumentation import instruments, profiled, to_json
+from rate_limiter import limiter
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 local_flag = True
+# number of collection groups read/uploaded at once - 1 runs them sequentially
+max_workers = int(os.environ.get("SYNC_MAX_WORKERS", 4))
+# cursor ranges each collection group scan is split into and read concurrently
+partition_count = int(os.environ.get("SYNC_PARTITIONS", 4))
+# rows per upload micro-batch and batches buffered per collection - bounds peak memory
+batch_size = int(os.environ.get("SYNC_BATCH_SIZE", 10000))
+max_pending_batches = int(os.environ.get("SYNC_MAX_PENDING_BATCHES", 2))
+# BigQuery sink: "load" (Parquet load jobs), "write" (Storage Write API) or "local" (dry run)
+sink_backend = os.environ.get("SYNC_SINK", "load")
+# user fields whose stored maximum marks which users changed since the last run
+user_watermark_fields = ("lastActiveDate", "dateOfEnrollment")
+user_page_size = int(os.environ.get("SYNC_USER_PAGE_SIZE", 1000))
+# stream every user instead of the changed ones - forced, or once per USERS_FULL_SCAN_DAYS (0 = never)
+users_full_scan = os.environ.get("USERS_FULL_SCAN", "false").lower() == "true"
+users_full_scan_days = float(os.environ.get("USERS_FULL_SCAN_DAYS", 7))
+# seconds after which no more observations are read - the next invocation resumes from the checkpoints (0 = no limit)
+time_budget = float(os.environ.get("SYNC_TIME_BUDGET", 0))
+
+def sync_collection(streamer, heathobservation_col, last_sync_time, checkpoint=None, deadline=None, coverage=None):
+    """Streams the new observations of one collection group to BigQuery in micro-batches.
+
+    Partition cursors are checkpointed every time the sink has written out all buffered rows, so
+    an interrupted run resumes after the last observation that reached BigQuery. Reading stops
+    early once `deadline` (a time.time() value) has passed. Uploaded batches are folded into `coverage`
+    when the checkpoint covering them is saved, so a resumed run never counts the same rows twice.
+    """
+    result = {'collection': heathobservation_col, 'observations': 0, 'read_seconds': 0.0,
+              'upload_seconds': 0.0, 'total_seconds': 0.0, 'rows_per_sec': 0.0, 'error': None, 'done': False}
+    if checkpoint and checkpoint.get('done'):
+        result['done'] = True
+        logger.debug(f"Skipping {heathobservation_col}, already synced in this run")
+        return result
+    if deadline and time.time() > deadline:
+        # not started - the next invocation picks it up
+        logger.debug(f"Time budget reached, not starting {heathobservation_col}")
+        return result
+    # Add sync timestamp for tracking
+    synced_at = pd.Timestamp.now()
+
+    tic = time.time()
+    try:
+        if checkpoint:
+            cursors = checkpoint['cursors']
+            logger.debug(f"Resuming {heathobservation_col} from checkpoint")
+        else:
+            cursors = streamer.plan_partitions(heathobservation_col, last_sync_time, partition_count)
+
+        def checkpointed(batches):
+            # cursors are exactly at the last row of each batch when it is handed out
+            try:
+                while True:
+                    # checked before reading each batch, so no batch is started past the deadline
+                    if deadline and time.time() > deadline:
+                        logger.warning(f"Time budget reached, pausing {heathobservation_col}")
+                        return
+                    batch = next(batches, None)
+                    if batch is None:
+                        return
+                    yield batch, copy.deepcopy(cursors)
+            finally:
+                batches.close()
+
+        # coverage of the rows written since the last saved checkpoint
+        pending = []
+
+        def commit_coverage():
+            if coverage is not None:
+                for summary in pending:
+                    coverage.fold_summary(summary)
+            pending.clear()
+
+        def upload(item):
+            batch, batch_cursors = item
+            sink.write(batch)
+            if coverage is not None:
+                pending.append(batch_summary(batch))
+            if not sink.buffered_bytes and streamer.save_checkpoint(heathobservation_col, batch_cursors):
+                commit_coverage()
+
+        # Add only new observations (filtered by 'issued' timestamp)
+        observations = streamer.get_observation_batches(heathobservation_col, last_sync_time, cursors=cursors,
+                                                       batch_size=batch_size, synced_at=synced_at)
+        with make_sink(sink_backend, "myheart_counts_development.observations3", streamer.observations_schema,
+                       project_id="myheart-counts-development") as sink:
+            stats = UploadPipeline(upload, max_pending=max_pending_batches, size=lambda item: len(item[0])).run(checkpointed(observations))
+        result['done'] = all(cursor['done'] for cursor in cursors)
+        # closing the sink flushed every row up to cursors, also when the time budget paused the collection
+        if streamer.save_checkpoint(heathobservation_col, cursors, done=result['done']):
+            commit_coverage()
+        result.update({'observations': stats['rows'], 'read_seconds': stats['read_seconds'],
+                       'upload_seconds': stats['upload_seconds'], 'rows_per_sec': stats['rows_per_sec']})
+        if stats['rows']:
+            logger.debug(f"✓ Uploaded {sink.rows_written} observations of {heathobservation_col} to BigQuery in {sink.writes} writes ({sink.bytes_written / 2**20:.1f} MB)")
+    except Exception as e:
+        logger.error(f"Error processing {heathobservation_col}: {e}")
+        result['error'] = str(e)
+        instruments.count("collection_errors")
+
+    result['total_seconds'] = time.time() - tic
+    instruments.observe("collection_seconds", result['total_seconds'])
+    logger.debug(f"Finished healthobservation: {heathobservation_col} in {result['total_seconds']:.2f} seconds")
+    return result
 
 def main():
+    """Runs one sync and returns its summary: user and observation counts, observation seconds, the per-collection results
+    and the run metrics (see instrumentation.Instruments.summary)."""
+    # the limiter and instruments are module-level, so they outlive a run in a warm instance
+    instruments.reset()
+    limiter.reset_metrics()
     if local_flag:
-        creds = "/home/juan/Desktop/Juan/code/.creds/creds-myheart-counts-development.json"
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = creds
+        # an explicit GOOGLE_APPLICATION_CREDENTIALS wins over the local default
+        os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "/home/juan/Desktop/Juan/code/.creds/creds-myheart-counts-development.json")
 
     streamer = FirestoreStreamer(logger)
+    # coverage is an add-on: when it is unavailable the sync goes on without it and the next run rebuilds it
+    coverage_state = streamer.get_sync_state("coverage")
+    coverage = CoverageSummary(logger)
+    try:
+        if coverage_state.get('stale'):
+            logger.warning("Coverage missed changes in an earlier run, rebuilding it from the observations")
+            coverage.rebuild()
+        else:
+            coverage.refresh()
+    except Exception as e:
+        logger.error(f"Coverage unavailable, syncing without it (it is rebuilt on the next run): {e}")
+        coverage = None
+        streamer.update_sync_state("coverage", {'stale': True})
     
     # Capture start time for this sync
     sync_start_time = datetime.now()
+    deadline = time.time() + time_budget if time_budget else None
     
     # Get last sync time
     last_sync_time = streamer.get_last_sync_time()
+    # an unfinished run is resumed with its own time window
+    run_state = streamer.get_sync_state("checkpoints")
+    checkpoints = {}
+    if run_state:
+        sync_start_time = run_state['run_start']
+        last_sync_time = run_state.get('last_sync_time')
+        checkpoints = streamer.get_checkpoints()
+        logger.info(f"Resuming sync started at {sync_start_time} ({sum(c.get('done', False) for c in checkpoints.values())} collections already done)")
+    else:
+        streamer.update_sync_state("checkpoints", {'run_start': sync_start_time, 'last_sync_time': last_sync_time})
     if last_sync_time:
         logger.info(f"Running DELTA sync for documents issued after: {last_sync_time}")
     else:
         logger.info("Running FULL sync (no previous sync found)")
     
     users_accumulator = []
-    obs_accumulator = []
     users_processed = 0
-    users_with_updates = 0
-    new_observations = 0
+    new_users = 0
     
-    # check for users first
-    user_col = streamer.db.collection("users")
-    for user_doc in streamer.stream_collection(user_col, batch_size=10):
-        tic = time.time()
+    # check for users first - only the ones that changed since the last run
+    user_watermarks = streamer.get_sync_state("users_sync")
+    new_watermarks = dict(user_watermarks)
+    last_full_scan = streamer.get_sync_state("users_full_scan").get('at', 0)
+    full_user_scan = users_full_scan or (users_full_scan_days > 0 and time.time() - last_full_scan > users_full_scan_days * 86400)
+    if full_user_scan and user_watermarks:
+        logger.info("Running FULL user scan (watermarks miss changes to other profile fields)")
+    for user_doc in streamer.get_changed_users({} if full_user_scan else user_watermarks, page_size=user_page_size):
         user_id = user_doc.id
+        user_data = user_doc.to_dict()
         users_processed += 1
-        
-        # is user_id in bigquery?
-        if not user_id in streamer.users_in_BQ:
-            # Add User Data
-            users_accumulator.append({"user_id": user_id, **user_doc.to_dict(),'synced_at': sync_start_time})
-            logger.info(f"Added user: {user_id} (not in BigQuery)")
-            users_with_updates += 1
-        
-        tac = time.time()
-        logger.info(f"Finished user: {user_id} in {tac - tic:.2f} seconds")
+        users_accumulator.append({"user_id": user_id, **user_data, 'synced_at': sync_start_time})
+        if user_id not in streamer.users_in_BQ:
+            new_users += 1
+        for field in user_watermark_fields:
+            value = user_data.get(field)
+            if isinstance(value, datetime) and (field not in new_watermarks or value > new_watermarks[field]):
+                new_watermarks[field] = value
         
     if users_accumulator:
-        # Save to BigQuery
-        df = pd.DataFrame(users_accumulator)
-        df['comorbidities'] = df['comorbidities'].astype(str)
-        pdg.to_gbq(df, "myheart_counts_development.users3",
-                    project_id="myheart-counts-development",
-                    if_exists="replace",
-                    table_schema=streamer.users_schema)
-        logger.info(f"✓ Uploaded {len(df)} users to BigQuery")
+        # Upsert to BigQuery
+        with instruments.span("users_frame_seconds"):
+            df = pd.DataFrame(users_accumulator)
+            if 'comorbidities' in df:
+                df['comorbidities'] = df['comorbidities'].astype(str)
+        with make_sink(sink_backend, "myheart_counts_development.users3", streamer.users_schema,
+                       project_id="myheart-counts-development", merge_key="user_id") as sink:
+            sink.write(df)
+        streamer.users_in_BQ.add(df['user_id'], sync_start_time)
+        logger.info(f"✓ Upserted {len(df)} users to BigQuery ({new_users} new)")
         users_accumulator = []  # Clear after upload
+    streamer.update_sync_state("users_sync", new_watermarks)
+    if full_user_scan:
+        streamer.update_sync_state("users_full_scan", {'at': time.time()})
 
     # check for observations after
+    obs_tic = time.time()
     healthobservation_cols = streamer.db.collection("variables").document("healthobservation_cols").get().to_dict().get("cols", [])
-    for heathobservation_col in healthobservation_cols:
-        tic = time.time()
+    if max_workers > 1:
+        logger.info(f"Syncing {len(healthobservation_cols)} collections with {max_workers} workers")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda col: sync_collection(streamer, col, last_sync_time, checkpoints.get(col), deadline, coverage),
+                                        healthobservation_cols))
+    else:
+        results = [sync_collection(streamer, col, last_sync_time, checkpoints.get(col), deadline, coverage) for col in healthobservation_cols]
+
+    # the coverage of every checkpointed batch, also of failed or paused collections (their uncheckpointed rows are not folded)
+    if coverage is not None:
         try:
-            # Add only new observations (filtered by 'issued' timestamp)
-            obs_count = 0
-            for obs in streamer.get_observations(heathobservation_col, last_sync_time):        
-                obs_accumulator.append(obs)
-                obs_count += 1
-            
-            logger.info(f"{heathobservation_col}  → Collected {obs_count} observations")        
-            tac = time.time()
-            logger.info(f"Finished healthobservation: {heathobservation_col} in {tac - tic:.2f} seconds")
-                    
-            if obs_accumulator:
-                obs_df = pd.DataFrame(obs_accumulator)
-                # Add sync timestamp for tracking
-                obs_df['synced_at'] = pd.Timestamp.now()
-                
-                pdg.to_gbq(obs_df, "myheart_counts_development.observations3",
-                            project_id="myheart-counts-development",
-                            if_exists="replace",
-                            chunksize=1000,
-                            table_schema=streamer.observations_schema)
-                logger.info(f"✓ Uploaded {len(obs_df)} observations to BigQuery")
-                new_observations += len(obs_accumulator)
-                obs_accumulator = []  # Clear after upload
+            coverage_rows = coverage.upload(sink_backend, sync_start_time)
+            logger.info(f"✓ Upserted {coverage_rows} coverage rows ({len(coverage)} user/metric pairs)")
+            if coverage_state.get('stale'):
+                streamer.update_sync_state("coverage", {'stale': False})
         except Exception as e:
-            logger.error(f"Error processing {heathobservation_col}: {e}")
-            continue
-        
-        # add info to logs
-        logger.info(f"\n{'='*60}")
-        logger.info(f"Sync Summary:")
-        logger.info(f"  Users scanned: {users_processed}")
-        logger.info(f"  Users with new observations: {users_with_updates}")
-        logger.info(f"  Total new observations collected: {new_observations}")
-        logger.info(f"{'='*60}\n")
+            # the folded changes only live in this instance - the next run rebuilds the table instead
+            logger.error(f"Failed to upload coverage, it is rebuilt on the next run: {e}")
+            streamer.update_sync_state("coverage", {'stale': True})
 
+    new_observations = sum(r['observations'] for r in results)
+    obs_seconds = time.time() - obs_tic
+    failed_cols = [r['collection'] for r in results if r['error']]
+    pending_cols = [r['collection'] for r in results if not r['done'] and not r['error']]
+
+    # add info to logs
+    logger.info(f"\n{'='*60}")
+    logger.info(f"Sync Summary:")
+    logger.info(f"  Changed users synced: {users_processed}")
+    logger.info(f"  New users: {new_users}")
+    logger.info(f"  Total new observations collected: {new_observations}")
+    logger.info(f"  Throughput: {new_observations / obs_seconds if obs_seconds else 0:.0f} rows/sec over {obs_seconds:.2f} seconds")
+    logger.info(f"  Peak RSS: {peak_rss_mb():.0f} MB")
+    reads = streamer.limiter.metrics()
+    logger.info(f"  Firestore reads: {reads['reads']} ({reads['reads_per_sec']:.0f}/sec), {reads['throttles']} throttled, {reads['retries']} retries, final rate {reads['rate']:.0f}/sec")
+    for r in sorted(results, key=lambda r: r['total_seconds'], reverse=True):
+        logger.debug(f"  {r['collection']}: {r['observations']} obs, read {r['read_seconds']:.2f}s, upload {r['upload_seconds']:.2f}s, {r['rows_per_sec']:.0f} rows/sec")
+    logger.info(f"{'='*60}\n")
+
+    # one machine-readable line per run, also kept in Firestore for trend tracking
+    run_summary = {**instruments.summary(streamer.limiter), 'users': users_processed, 'new_users': new_users,
+                   'observations': new_observations, 'collections': len(results),
+                   'failed_collections': failed_cols, 'pending_collections': pending_cols,
+                   'slowest_collections': sorted(results, key=lambda r: r['total_seconds'], reverse=True)[:5]}
+    logger.info(f"Run summary: {to_json(run_summary)}")
+    streamer.save_run_summary(run_summary)
+
+    if failed_cols or pending_cols:
+        # do not move the watermark past observations that were never uploaded - the next run resumes from the checkpoints
+        logger.warning(f"Not updating sync timestamp, {len(failed_cols)} collections failed: {failed_cols}, {len(pending_cols)} paused: {pending_cols}")
+    else:
         # Update last sync time to the start of this sync
         streamer.update_last_sync_time(sync_start_time)
+        streamer.clear_checkpoints()
         logger.info("✓ Updated sync timestamp")
-    else:
+    if not new_observations:
         logger.info("No new observations found - nothing to sync")
     
     logger.info("\n✅ Sync completed successfully")
+    return {'users': users_processed, 'new_users': new_users, 'observations': new_observations,
+            'observation_seconds': obs_seconds, 'results': results, 'metrics': run_summary}
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with profiled():
+        main()
\ No newline at end of file
@@ -0,0 +1,91 @@
+import queue
+import resource
+import threading
+import time
+from typing import Callable, Dict, Generator, Iterable, List
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB."""
+    # ru_maxrss is reported in KB on Linux (the Cloud Functions runtime)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def batched(rows: Iterable, batch_size: int) -> Generator[List, None, None]:
+    """Groups an iterable into lists of at most batch_size items."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class UploadPipeline:
+    """Streams micro-batches (lists of rows or pyarrow.RecordBatches) to an upload function.
+
+    The producer (the caller's iterator) fills a bounded queue that `workers` upload threads
+    drain concurrently, so at most (max_pending + workers + 1) batches are held in memory
+    no matter how many rows the iterator produces. Use batched() to cut a row iterator.
+    """
+
+    def __init__(self, upload: Callable, max_pending: int = 2, workers: int = 1, size: Callable = len):
+        self.upload = upload
+        self.max_pending = max_pending
+        self.workers = workers
+        self.size = size  # rows in one queued item
+
+    def run(self, batches_in: Iterable) -> Dict:
+        """Uploads every batch and returns the run metrics (rows, batches, timings, rows/sec, peak RSS)."""
+        batches = queue.Queue(maxsize=self.max_pending)
+        stats = {'rows': 0, 'batches': 0, 'read_seconds': 0.0, 'upload_seconds': 0.0}
+        errors = []
+        lock = threading.Lock()
+
+        def drain():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if errors:
+                    # keep draining so the producer never blocks on a dead uploader
+                    continue
+                tic = time.time()
+                try:
+                    self.upload(batch)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                with lock:
+                    stats['upload_seconds'] += time.time() - tic
+                    stats['rows'] += self.size(batch)
+                    stats['batches'] += 1
+
+        uploaders = [threading.Thread(target=drain, daemon=True) for _ in range(self.workers)]
+        for uploader in uploaders:
+            uploader.start()
+
+        tic = time.time()
+        blocked = 0.0
+        try:
+            for batch in batches_in:
+                if errors:
+                    break
+                toc = time.time()
+                batches.put(batch)
+                blocked += time.time() - toc
+        finally:
+            stats['read_seconds'] = time.time() - tic - blocked
+            for _ in uploaders:
+                batches.put(None)
+            for uploader in uploaders:
+                uploader.join()
+
+        stats['seconds'] = time.time() - tic
+        stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+        stats['peak_rss_mb'] = peak_rss_mb()
+        if errors:
+            raise errors[0]
+        return stats
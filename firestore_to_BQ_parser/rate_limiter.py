@@ -0,0 +1,109 @@
+import os
+import random
+import threading
+import time
+from typing import Dict
+from google.api_core import exceptions as api_exceptions
+
+# errors Firestore returns when it wants clients to slow down
+retryable_errors = (api_exceptions.ResourceExhausted, api_exceptions.DeadlineExceeded, api_exceptions.ServiceUnavailable)
+
+
+class AdaptiveRateLimiter:
+    """Token bucket of document reads whose rate follows AIMD.
+
+    The rate grows additively while calls succeed and is cut multiplicatively whenever Firestore
+    answers RESOURCE_EXHAUSTED / DEADLINE_EXCEEDED, which are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, rate: float = 1000.0, min_rate: float = 10.0, max_rate: float = 20000.0, increase: float = 100.0,
+                 decrease: float = 0.5, max_retries: int = 5, base_backoff: float = 0.5, max_backoff: float = 30.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.tokens = rate  # allow a burst of one second
+        self.updated = time.monotonic()
+        self.started = self.updated
+        self.reads = 0
+        self.throttles = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        """Blocks until `tokens` reads are allowed by the current rate.
+
+        Requests larger than the bucket go through once it is full and leave it in debt.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= min(tokens, self.rate):
+                    self.tokens -= tokens
+                    self.reads += tokens
+                    return
+                wait = (min(tokens, self.rate) - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.throttles += 1
+
+    def call(self, fn, *args, tokens: int = 1, **kwargs):
+        """Runs fn once `tokens` reads are allowed, retrying throttling errors with jittered backoff."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                result = fn(*args, **kwargs)
+            except retryable_errors:
+                self.on_throttle()
+                if attempt == self.max_retries:
+                    raise
+                self.backoff(attempt)
+                continue
+            self.on_success()
+            return result
+
+    def backoff(self, attempt: int):
+        """Sleeps the jittered exponential backoff before retry number attempt + 1."""
+        with self.lock:
+            self.retries += 1
+        time.sleep(min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def reset_metrics(self):
+        """Restarts the read/throttle/retry counters (the current rate is kept), e.g. per run of a long-lived process."""
+        with self.lock:
+            self.started = time.monotonic()
+            self.reads = 0
+            self.throttles = 0
+            self.retries = 0
+
+    def metrics(self) -> Dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            return {'reads': self.reads, 'reads_per_sec': self.reads / elapsed if elapsed else 0.0,
+                    'throttles': self.throttles, 'retries': self.retries, 'rate': self.rate}
+
+
+def adapt_page_size(page_size: int, latency: float, target_latency: float = 1.0, min_size: int = 10, max_size: int = 5000) -> int:
+    """Doubles the page size while pages come back well under target_latency and halves it when they are slower."""
+    if latency < target_latency / 2:
+        return min(max_size, page_size * 2)
+    if latency > target_latency:
+        return max(min_size, page_size // 2)
+    return page_size
+
+
+# one limiter shared by every Firestore reader in the process
+limiter = AdaptiveRateLimiter(rate=float(os.environ.get("FIRESTORE_READS_PER_SEC", 1000)))
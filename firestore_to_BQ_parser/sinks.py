@@ -0,0 +1,271 @@
+import io
+import logging
+import os
+import threading
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from typing import Dict, List, Optional, Sequence, Union
+from arrow_builder import arrow_schema
+from instrumentation import instruments
+
+logger = logging.getLogger(__name__)
+
+def conform(data, schema: pa.Schema) -> pa.Table:
+    """Converts a DataFrame, RecordBatch or Table to a Table with exactly the schema's columns and types.
+
+    Missing columns are filled with nulls and columns outside the schema are dropped.
+    """
+    if isinstance(data, pd.DataFrame):
+        table = pa.Table.from_pandas(data, preserve_index=False)
+    elif isinstance(data, pa.RecordBatch):
+        table = pa.Table.from_batches([data])
+    else:
+        table = data
+
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            if column.type != field.type:
+                column = column.cast(field.type)
+        else:
+            column = pa.nulls(table.num_rows, field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class Sink:
+    """Buffers written data and hands it to _write_table in chunks of roughly target_bytes.
+
+    `schema` is a BigQuery schema list as defined in utils.py. With WRITE_TRUNCATE only the
+    first chunk replaces the table, later chunks of the same sink are appended.
+    """
+
+    def __init__(self, schema: List[Dict], write_disposition: str = "WRITE_APPEND", target_bytes: int = 64 * 2**20):
+        self.bq_schema = schema
+        self.schema = arrow_schema(schema)
+        self.write_disposition = write_disposition
+        self.target_bytes = target_bytes
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.writes = 0
+        self.dropped_columns = set()
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        """Buffers a DataFrame, RecordBatch or Table, writing out full chunks.
+
+        Columns outside the schema are dropped (see conform); each one is logged the first time this sink sees it.
+        """
+        names = data.columns if isinstance(data, pd.DataFrame) else data.schema.names
+        dropped = set(map(str, names)) - set(self.schema.names) - self.dropped_columns
+        if dropped:
+            self.dropped_columns.update(dropped)
+            logger.warning(f"{type(self).__name__}: dropping columns not in the schema: {sorted(dropped)}")
+        table = conform(data, self.schema)
+        with self.lock:
+            self.buffer.append(table)
+            self.buffered_bytes += table.nbytes
+            if self.buffered_bytes >= self.target_bytes:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # only flush what is buffered if the writer finished cleanly
+        if exc_type is None:
+            self.close()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        table = pa.concat_tables(self.buffer).combine_chunks()
+        self.buffer, self.buffered_bytes = [], 0
+        rows_per_chunk = max(1, int(table.num_rows * self.target_bytes / max(table.nbytes, 1)))
+        for offset in range(0, table.num_rows, rows_per_chunk):
+            chunk = table.slice(offset, rows_per_chunk)
+            with instruments.span("sink_write_seconds", sink=type(self).__name__):
+                self._write_table(chunk, self.write_disposition if not self.writes else "WRITE_APPEND")
+            instruments.count("sink_rows", chunk.num_rows)
+            instruments.count("sink_bytes", chunk.nbytes)
+            self.rows_written += chunk.num_rows
+            self.bytes_written += chunk.nbytes
+            self.writes += 1
+
+    def _write_table(self, table: pa.Table, write_disposition: str):
+        raise NotImplementedError
+
+
+class BigQueryLoadSink(Sink):
+    """Writes chunks as Parquet load jobs (one job per ~target_bytes, default 64MB)."""
+
+    def __init__(self, table_id: str, schema: List[Dict], project_id: str, write_disposition: str = "WRITE_APPEND",
+                 target_bytes: int = 64 * 2**20, client: Optional[bigquery.Client] = None):
+        super().__init__(schema, write_disposition, target_bytes)
+        self.table_id = table_id
+        self.load_schema = schema
+        self.client = client or bigquery.Client(project=project_id)
+
+    def _write_table(self, table: pa.Table, write_disposition: str):
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression="snappy")
+        buffer.seek(0)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=[bigquery.SchemaField(f['name'], f['type']) for f in self.load_schema],
+            write_disposition=write_disposition,
+        )
+        if write_disposition == "WRITE_APPEND":
+            job_config.schema_update_options = [bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+        self.client.load_table_from_file(buffer, self.table_id, job_config=job_config).result()
+
+
+class BigQueryMergeSink(BigQueryLoadSink):
+    """Loads chunks into a staging table and MERGEs it into table_id on close, keyed on merge_key
+    (a column name or a tuple of them).
+
+    Rows whose key already exists are updated in place, new keys are inserted. Staged rows carry
+    their write order (_load_seq), so of several rows with the same key the last one written wins,
+    as in LocalSink. Every sink stages into its own table, dropped on close or failure.
+    """
+
+    def __init__(self, table_id: str, schema: List[Dict], project_id: str, merge_key: Union[str, Sequence[str]],
+                 target_bytes: int = 64 * 2**20, client: Optional[bigquery.Client] = None):
+        super().__init__(f"{table_id}_staging_{uuid.uuid4().hex[:12]}", schema, project_id, "WRITE_TRUNCATE", target_bytes, client)
+        self.load_schema = schema + [{'name': '_load_seq', 'type': 'INT64'}]
+        self.target_table_id = table_id
+        self.merge_key = merge_key
+        self.merge_keys = [merge_key] if isinstance(merge_key, str) else list(merge_key)
+
+    def _write_table(self, table: pa.Table, write_disposition: str):
+        # rows_written only grows after a chunk is written, so the sequence is the row's position in the sink
+        sequence = pa.array(range(self.rows_written, self.rows_written + table.num_rows), pa.int64())
+        super()._write_table(table.append_column('_load_seq', sequence), write_disposition)
+
+    def close(self):
+        try:
+            super().close()
+            if self.writes:
+                self.client.query(self.merge_query()).result()
+        finally:
+            self.client.delete_table(self.table_id, not_found_ok=True)
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if exc_type is not None:
+            self.client.delete_table(self.table_id, not_found_ok=True)
+
+    def merge_query(self) -> str:
+        columns = [f['name'] for f in self.bq_schema]
+        updates = ", ".join(f"`{c}` = S.`{c}`" for c in columns if c not in self.merge_keys)
+        names = ", ".join(f"`{c}`" for c in columns)
+        values = ", ".join(f"S.`{c}`" for c in columns)
+        partition = ", ".join(f"`{c}`" for c in self.merge_keys)
+        on = " AND ".join(f"T.`{c}` = S.`{c}`" for c in self.merge_keys)
+        return f"""MERGE `{self.target_table_id}` T
+USING (SELECT * EXCEPT (_load_seq) FROM `{self.table_id}` WHERE TRUE
+       QUALIFY ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY _load_seq DESC) = 1) S
+ON {on}
+WHEN MATCHED THEN UPDATE SET {updates}
+WHEN NOT MATCHED THEN INSERT ({names}) VALUES ({values})"""
+
+
+class BigQueryWriteSink(Sink):
+    """Appends chunks through the Storage Write API default stream as serialized Arrow record batches.
+
+    Append requests are limited to 10MB, so chunks default to 8MB.
+    """
+
+    def __init__(self, table_id: str, schema: List[Dict], project_id: str, target_bytes: int = 8 * 2**20, client=None):
+        super().__init__(schema, "WRITE_APPEND", target_bytes)
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        self.types = types
+        self.client = client or bigquery_storage_v1.BigQueryWriteClient()
+        dataset, table = table_id.split(".")
+        template = types.AppendRowsRequest(write_stream=f"projects/{project_id}/datasets/{dataset}/tables/{table}/streams/_default")
+        template.arrow_rows = types.AppendRowsRequest.ArrowData(
+            writer_schema=types.ArrowSchema(serialized_schema=self.schema.serialize().to_pybytes()))
+        self.stream = writer.AppendRowsStream(self.client, template)
+
+    def _write_table(self, table: pa.Table, write_disposition: str):
+        futures = []
+        for batch in table.to_batches():
+            request = self.types.AppendRowsRequest(arrow_rows=self.types.AppendRowsRequest.ArrowData(
+                rows=self.types.ArrowRecordBatch(serialized_record_batch=batch.serialize().to_pybytes())))
+            futures.append(self.stream.send(request))
+        for future in futures:
+            future.result()
+
+    def close(self):
+        super().close()
+        self.stream.close()
+
+
+class LocalSink(Sink):
+    """Keeps written chunks in memory (and optionally as Parquet files under path) - for tests and dry runs.
+
+    With a merge_key, to_pandas keeps the last row written for each key (MERGE semantics).
+    """
+
+    def __init__(self, schema: List[Dict], path: Optional[str] = None, write_disposition: str = "WRITE_APPEND",
+                 target_bytes: int = 64 * 2**20, merge_key: Optional[Union[str, Sequence[str]]] = None):
+        super().__init__(schema, write_disposition, target_bytes)
+        self.path = path
+        self.merge_key = merge_key
+        self.tables = []
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def _write_table(self, table: pa.Table, write_disposition: str):
+        if write_disposition == "WRITE_TRUNCATE":
+            self.tables = []
+            if self.path:
+                for name in os.listdir(self.path):
+                    if name.endswith(".parquet"):
+                        os.remove(os.path.join(self.path, name))
+        self.tables.append(table)
+        if self.path:
+            pq.write_table(table, os.path.join(self.path, f"part-{len(self.tables):05d}.parquet"))
+
+    def to_pandas(self) -> pd.DataFrame:
+        with self.lock:
+            tables = self.tables + self.buffer
+        if not tables:
+            return pd.DataFrame(columns=self.schema.names)
+        df = pa.concat_tables(tables).to_pandas()
+        if self.merge_key:
+            df = df.drop_duplicates(self.merge_key if isinstance(self.merge_key, str) else list(self.merge_key), keep="last").reset_index(drop=True)
+        return df
+
+
+def make_sink(backend: str, table_id: str, schema: List[Dict], project_id: str,
+              write_disposition: str = "WRITE_APPEND", merge_key: Optional[Union[str, Sequence[str]]] = None, **kwargs) -> Sink:
+    """Creates the sink for a backend name: 'load' (Parquet load jobs), 'write' (Storage Write API) or 'local'.
+
+    With a merge_key rows are upserted on that column instead of following write_disposition.
+    """
+    if backend == "local":
+        return LocalSink(schema, write_disposition=write_disposition, merge_key=merge_key, **kwargs)
+    if backend not in ("load", "write"):
+        raise ValueError(f"Unknown sink backend: {backend}")
+    if merge_key:
+        return BigQueryMergeSink(table_id, schema, project_id, merge_key, **kwargs)
+    if backend == "write" and write_disposition == "WRITE_APPEND":
+        return BigQueryWriteSink(table_id, schema, project_id, **kwargs)
+    # Storage Write API default streams can only append - table replacements go through load jobs
+    return BigQueryLoadSink(table_id, schema, project_id, write_disposition, **kwargs)
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pandas_gbq as pdg
+from datetime import datetime
+from typing import Iterable, Optional
+
+
+class UserRegistry:
+    """Set of the user_ids already in the BigQuery users table.
+
+    The ids are kept as a hashed set for O(1) membership checks and persisted between runs as a
+    compact sorted array together with the largest synced_at seen, so a refresh only downloads
+    the users synced since then instead of the whole table.
+
+    The default cache (/tmp) only lives as long as one warm Cloud Function instance, so every cold
+    start reloads the whole table. USER_REGISTRY_CACHE (or cache_path) can point at a gs://bucket/object,
+    which is downloaded on load and uploaded on save and so is shared by every instance.
+    """
+
+    def __init__(self, logger, table: str = "myheart_counts_development.users3", project_id: str = "myheart-counts-development",
+                 cache_path: Optional[str] = None):
+        self.logger = logger
+        self.table = table
+        self.project_id = project_id
+        self.cache_path = cache_path or os.environ.get("USER_REGISTRY_CACHE", "/tmp/users_in_BQ.npz")
+        if self.cache_path.startswith("gs://"):
+            try:
+                from google.cloud import storage  # noqa: F401
+            except ImportError:
+                self.logger.warning(f"google-cloud-storage is not installed, caching the user registry locally instead of in {self.cache_path}")
+                self.cache_path = os.path.join(tempfile.gettempdir(), "users_in_BQ.npz")
+        # a gs:// cache is read and written through a local copy
+        self.local_path = (os.path.join(tempfile.gettempdir(), "users_in_BQ-" + os.path.basename(self.cache_path))
+                           if self.cache_path.startswith("gs://") else self.cache_path)
+        self.user_ids = set()
+        self.watermark = None
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.user_ids
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def _blob(self):
+        from google.cloud import storage
+        bucket, name = self.cache_path[len("gs://"):].split("/", 1)
+        return storage.Client(project=self.project_id).bucket(bucket).blob(name)
+
+    def load(self) -> bool:
+        """Loads the cache, returns False if there is none for this table."""
+        if self.local_path != self.cache_path:
+            try:
+                blob = self._blob()
+                if not blob.exists():
+                    return False
+                blob.download_to_filename(self.local_path)
+            except Exception as e:
+                self.logger.warning(f"Could not download user registry cache {self.cache_path}: {e}")
+                return False
+        if not os.path.exists(self.local_path):
+            return False
+        try:
+            with np.load(self.local_path) as cache:
+                if str(cache['table']) != self.table:
+                    return False
+                self.user_ids = set(cache['user_ids'].tolist())
+                watermark = str(cache['watermark'])
+                self.watermark = pd.Timestamp(watermark) if watermark else None
+            self.logger.info(f"Loaded {len(self.user_ids)} cached users (synced up to {self.watermark})")
+            return True
+        except Exception as e:
+            self.logger.warning(f"Could not load user registry cache {self.cache_path}: {e}")
+            return False
+
+    def save(self):
+        """Persists the registry as a sorted array, replacing the cache file atomically."""
+        tmp_path = self.local_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(f, user_ids=self.sorted_array(), table=np.array(self.table),
+                                    watermark=np.array(self.watermark.isoformat() if self.watermark is not None else ""))
+            os.replace(tmp_path, self.local_path)
+            if self.local_path != self.cache_path:
+                self._blob().upload_from_filename(self.local_path)
+        except Exception as e:
+            self.logger.warning(f"Could not save user registry cache {self.cache_path}: {e}")
+
+    def sorted_array(self) -> np.ndarray:
+        return np.array(sorted(self.user_ids), dtype=str)
+
+    def refresh(self):
+        """Loads the cache and fetches the user_ids synced since its watermark (the whole table on a cold cache)."""
+        if not self.user_ids:
+            self.load()
+        query = f"SELECT user_id, synced_at FROM `{self.table}`"
+        if self.watermark is not None:
+            # >= so users uploaded in the same second as the watermark are not missed - the set dedupes
+            query += f" WHERE synced_at >= TIMESTAMP('{self.watermark.isoformat()}')"
+        df = pdg.read_gbq(query, project_id=self.project_id, dialect="standard")
+        self.user_ids.update(df['user_id'])
+        if len(df) and df['synced_at'].notna().any():
+            latest = pd.Timestamp(df['synced_at'].max())
+            self.watermark = latest if self.watermark is None else max(self.watermark, latest)
+        self.logger.info(f"User registry refreshed: {len(df)} rows fetched, {len(self.user_ids)} users known")
+        self.save()
+
+    def add(self, user_ids: Iterable[str], synced_at: Optional[datetime] = None):
+        """Records users just uploaded to BigQuery so the next refresh does not need to fetch them."""
+        self.user_ids.update(user_ids)
+        if synced_at is not None:
+            synced_at = pd.Timestamp(synced_at)
+            if synced_at.tzinfo is None:
+                synced_at = synced_at.tz_localize("UTC")
+            self.watermark = synced_at if self.watermark is None else max(self.watermark, synced_at)
+        self.save()
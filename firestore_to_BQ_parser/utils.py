@@ -1,20 +1,18 @@
-import re
 import firebase_admin
 from firebase_admin import credentials, firestore
-from typing import Generator, Dict, Optional
+from typing import Generator, Dict, List, Optional, Tuple
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
 import time
 import os
-import pandas_gbq as pdg
-
-prefixes = [
-    "HealthObservations_HKQuantityTypeIdentifier",
-    "HealthObservations_HKCategoryTypeIdentifier",
-    "HealthObservations_com.apple.SensorKit.",
-    "HealthObservations_HKDataTypeIdentifier",
-    "HealthObservations_HKWorkoutTypeIdentifier",
-    "HealthObservations_MHC"
-]
+import pyarrow as pa
+from arrow_builder import ObservationBatchBuilder
+from user_registry import UserRegistry
+from rate_limiter import limiter, adapt_page_size, retryable_errors
+from metrics import clean_metric, registry as metric_registry
+from instrumentation import instruments
 
 users_schema  = [
     {'name': 'user_id', 'type': 'STRING'},
@@ -54,15 +52,36 @@ observations_schema = [
     {'name': 'value', 'type': 'FLOAT64'},
     {'name': 'unit', 'type': 'STRING'},
     {'name': 'value_str', 'type': 'STRING'},
+    {'name': 'start', 'type': 'STRING'},  # effectivePeriod
+    {'name': 'end', 'type': 'STRING'},
     {'name': 'issued', 'type': 'TIMESTAMP'},
     {'name': 'synced_at', 'type': 'TIMESTAMP'}
 ]
 
-pattern = re.compile(f"^({'|'.join(map(re.escape, prefixes))})")
+def snapshot_data(doc) -> Dict:
+    """Decoded fields of a document snapshot.
+
+    to_dict() deep-copies the whole document; the readers here never mutate it, so the
+    snapshot's own field dict is used when available.
+    """
+    data = getattr(doc, '_data', None)
+    return data if data is not None else doc.to_dict()
 
-def clean_metric(metric):
-    clean = pattern.sub('', metric)
-    return clean if clean else 'Workout'
+def observation_dict(metric: str, user_id: str, data: Dict) -> Optional[Dict]:
+    """Flattens one observation document into a row, or None if it has no effectivePeriod."""
+    period = data.get('effectivePeriod')
+    if not period or not isinstance(period, dict):
+        return None
+    quantity = data.get('valueQuantity') or {}
+    return {
+        **period,
+        'user_id': user_id,
+        'metric': metric,
+        'value': quantity.get('value'),
+        'unit': quantity.get('unit'),
+        'value_str': data.get('valueString'),
+        'issued': data.get('issued')  # Include 'issued' timestamp for tracking
+    }
 
 class FirestoreStreamer:
     """Focuses solely on streaming data out of Firestore efficiently."""
@@ -71,10 +90,13 @@ class FirestoreStreamer:
         self.logger = logger
         self.initialize_firebase()
         self.db = firestore.client()
-        query = f"SELECT user_id FROM `myheart_counts_development.users3`"
-        self.users_in_BQ = tuple(pdg.read_gbq(query, project_id="myheart-counts-development", dialect="standard")['user_id'])
+        self.users_in_BQ = UserRegistry(logger)
+        self.users_in_BQ.refresh()
         self.users_schema = users_schema
         self.observations_schema = observations_schema
+        # per-partition progress of the last get_observations call of each collection group
+        self.partition_cursors = {}
+        self.limiter = limiter
     
     def initialize_firebase(self):
         if not firebase_admin._apps:
@@ -117,15 +139,84 @@ class FirestoreStreamer:
         except Exception as e:
             self.logger.error(f"Failed to update sync time: {e}")
     
-    def stream_collection(self, collection_ref, batch_size: int = 500) -> Generator[Dict, None, None]:
-        """Generic generator to handle pagination logic once."""
+    def get_sync_state(self, name: str) -> Dict:
+        """Reads a sync state document from _sync_metadata (empty if it does not exist)."""
+        try:
+            doc = self.db.collection("_sync_metadata").document(name).get()
+            return {k: v for k, v in (doc.to_dict() or {}).items() if k != 'updated_at'} if doc.exists else {}
+        except Exception as e:
+            self.logger.warning(f"Could not retrieve sync state {name}: {e}")
+            return {}
+
+    def update_sync_state(self, name: str, state: Dict):
+        """Writes a sync state document to _sync_metadata."""
+        try:
+            self.db.collection("_sync_metadata").document(name).set({**state, 'updated_at': firestore.SERVER_TIMESTAMP})
+        except Exception as e:
+            self.logger.error(f"Failed to update sync state {name}: {e}")
+
+    def save_run_summary(self, summary: Dict):
+        """Stores the run summary as _sync_metadata/last_run and in the _sync_metadata/last_run/history trend collection."""
+        try:
+            self.update_sync_state("last_run", summary)
+            self.db.collection("_sync_metadata").document("last_run").collection("history").document(summary['finished_at']).set(summary)
+        except Exception as e:
+            self.logger.error(f"Failed to save run summary: {e}")
+
+    def checkpoint_collection(self):
+        return self.db.collection("_sync_metadata").document("checkpoints").collection("collections")
+
+    def get_checkpoints(self) -> Dict[str, Dict]:
+        """Per-collection checkpoints ({'done', 'cursors'}) of an unfinished sync run, keyed by collection group."""
+        try:
+            return {doc.id: doc.to_dict() for doc in self.checkpoint_collection().stream()}
+        except Exception as e:
+            self.logger.warning(f"Could not retrieve checkpoints: {e}")
+            return {}
+
+    def save_checkpoint(self, heathobservation_col: str, cursors: List[Dict], done: bool = False) -> bool:
+        """Stores the partition cursors of a collection group up to which observations are in BigQuery, returns whether it was saved."""
+        try:
+            self.checkpoint_collection().document(heathobservation_col).set({
+                'cursors': cursors,
+                'done': done,
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+            return True
+        except Exception as e:
+            self.logger.error(f"Failed to save checkpoint of {heathobservation_col}: {e}")
+            return False
+
+    def clear_checkpoints(self):
+        """Removes the checkpoints once a sync run has completed."""
+        try:
+            for doc in self.checkpoint_collection().stream():
+                doc.reference.delete()
+            self.db.collection("_sync_metadata").document("checkpoints").delete()
+        except Exception as e:
+            self.logger.error(f"Failed to clear checkpoints: {e}")
+
+    def stream_collection(self, collection_ref, batch_size: int = 500, target_latency: float = 1.0) -> Generator[Dict, None, None]:
+        """Generic generator to handle pagination logic once.
+
+        Pages are read through the shared rate limiter and the page size adapts so that each page
+        takes about target_latency seconds.
+        """
         last_doc = None
+        page_size = batch_size
         while True:
-            query = collection_ref.limit(batch_size)
+            query = collection_ref.limit(page_size)
             if last_doc:
                 query = query.start_after(last_doc)
-            
-            docs = list(query.stream())
+
+            def read_page():
+                tic = time.time()
+                docs = list(query.stream())
+                return docs, time.time() - tic
+
+            docs, latency = self.limiter.call(read_page, tokens=page_size)
+            instruments.observe("firestore_page_seconds", latency)
+            instruments.count("firestore_docs", len(docs))
             if not docs:
                 break
                 
@@ -133,33 +224,208 @@ class FirestoreStreamer:
                 yield doc
             
             last_doc = docs[-1]
-            time.sleep(0.1)
+            page_size = adapt_page_size(page_size, latency, target_latency)
     
-    def get_observations(self, heathobservation_col: str, last_sync_time: Optional[datetime] = None) -> Generator[Dict, None, None]:
-        """Streams health observations for a single user, filtering by issued timestamp."""
-        # pagination was removed - might consider re-instantiating it for scalability if needed, but for now we rely on Firestore's internal optimizations for collection_group queries with proper indexing
+    def get_changed_users(self, watermarks: Dict, page_size: int = 1000) -> Generator:
+        """Streams the user documents whose watermark fields (e.g. lastActiveDate) are past the stored values.
+
+        Firestore cannot filter on a document's update_time, so changes are detected through timestamp
+        fields the app maintains, and edits that do not move them are missed. Without watermarks (first
+        run, or a periodic full scan from main.py) every user is streamed.
+        """
+        user_col = self.db.collection("users")
+        if not watermarks:
+            yield from self.stream_collection(user_col, batch_size=page_size)
+            return
+        seen = set()
+        for field, watermark in watermarks.items():
+            query = user_col.where(field, ">", watermark).order_by(field)
+            for doc in self.stream_collection(query, batch_size=page_size):
+                if doc.id not in seen:
+                    seen.add(doc.id)
+                    yield doc
+
+    def plan_partitions(self, heathobservation_col: str, last_sync_time: Optional[datetime] = None, partition_count: int = 1) -> List[Dict]:
+        """Splits a collection group scan into cursor ranges that can be read independently.
+
+        Full syncs use Firestore partition queries (ranges of document names). Partition queries
+        cannot be combined with filters, so delta syncs split the issued window instead.
+        """
+        if not last_sync_time:
+            bounds = [(None, None)]
+            if partition_count > 1:
+                partitions = self.db.collection_group(heathobservation_col).get_partitions(partition_count - 1)
+                bounds = [(p.start_at.path if p.start_at else None, p.end_at.path if p.end_at else None) for p in partitions]
+            return [{'by': 'name', 'start': start, 'end': end, 'after': None, 'after_issued': None, 'done': False}
+                    for start, end in bounds]
+
+        edges = [last_sync_time, None]
+        step = (datetime.now(last_sync_time.tzinfo) - last_sync_time) / max(partition_count, 1)
+        if partition_count > 1 and step.total_seconds() > 0:
+            edges = [last_sync_time + i * step for i in range(partition_count)] + [None]
+        return [{'by': 'issued', 'start': start, 'end': end, 'after': None, 'after_issued': None, 'done': False}
+                for start, end in zip(edges[:-1], edges[1:])]
+
+    def partition_query(self, heathobservation_col: str, cursor: Dict):
+        """Builds the query of one partition, resuming after its last yielded document."""
         query = self.db.collection_group(heathobservation_col)
-    
-        if last_sync_time:
-            query = query.where("issued", ">", last_sync_time).order_by("issued")
-        
-        docs = query.stream()
-
-        for doc in docs:
-            user_id = doc.reference.parent.parent.id
-            data = doc.to_dict()
-            period = data.get('effectivePeriod')
-            issued = data.get('issued')
-            
-            if period and isinstance(period, dict):
-                yield {
-                    **period,
-                    'user_id': user_id,
-                    'metric': clean_metric(heathobservation_col),
-                    'value': data.get('valueQuantity', {}).get('value'),
-                    'unit': data.get('valueQuantity', {}).get('unit'),
-                    'value_str': data.get('valueString'),
-                    'issued': issued  # Include 'issued' timestamp for tracking
-                }
-        
-        #time.sleep(0.05)
+        if cursor['by'] == 'issued':
+            query = query.where("issued", ">", cursor['start'])
+            if cursor['end'] is not None:
+                query = query.where("issued", "<=", cursor['end'])
+            query = query.order_by("issued").order_by("__name__")
+            if cursor['after']:
+                query = query.start_after({"issued": cursor['after_issued'], "__name__": self.db.document(cursor['after'])})
+        else:
+            query = query.order_by("__name__")
+            if cursor['start']:
+                query = query.start_at({"__name__": self.db.document(cursor['start'])})
+            if cursor['end']:
+                query = query.end_before({"__name__": self.db.document(cursor['end'])})
+            if cursor['after']:
+                query = query.start_after({"__name__": self.db.document(cursor['after'])})
+        return query
+
+    def merge_streams(self, queries: Dict, max_buffered: int = 1000, read_block: int = 500, resume=None) -> Generator:
+        """Streams several queries concurrently, yielding (key, doc) as documents arrive and (key, None) once a query is exhausted.
+
+        Reads are paced by the shared rate limiter in blocks of read_block documents. When `resume(key, last_doc)`
+        is given, a query failing with a throttling error is re-opened after the last document it read, following
+        the limiter's jittered backoff and retry budget; other errors, and throttling past the budget, are raised.
+        """
+        buffer = queue.Queue(maxsize=max_buffered)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read(key, query):
+            streamed, counted = 0, 0
+            last_doc, attempt = None, 0
+            tic = time.perf_counter()
+            try:
+                while True:
+                    try:
+                        for doc in query.stream():
+                            if streamed % read_block == 0:
+                                if streamed:
+                                    self.limiter.on_success()
+                                    # includes the time spent blocked on a full buffer
+                                    instruments.observe("firestore_block_seconds", time.perf_counter() - tic)
+                                    instruments.count("firestore_docs", streamed - counted)
+                                    counted, tic = streamed, time.perf_counter()
+                                self.limiter.acquire(read_block)
+                            streamed += 1
+                            last_doc = doc
+                            if not put((key, doc)):
+                                return
+                        break
+                    except retryable_errors:
+                        self.limiter.on_throttle()
+                        if resume is None or attempt == self.limiter.max_retries:
+                            raise
+                        self.limiter.backoff(attempt)
+                        attempt += 1
+                        query = resume(key, last_doc)
+                put((key, None))
+            except Exception as e:
+                instruments.count("firestore_errors")
+                put((key, e))
+            finally:
+                instruments.count("firestore_docs", streamed - counted)
+
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            for key, query in queries.items():
+                executor.submit(read, key, query)
+            try:
+                pending = len(queries)
+                while pending:
+                    key, item = buffer.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if item is None:
+                        pending -= 1
+                    yield key, item
+            finally:
+                # release readers blocked on a full buffer if the consumer stopped early
+                stop.set()
+
+    def stream_observation_docs(self, heathobservation_col: str, last_sync_time: Optional[datetime] = None,
+                                partition_count: int = 1, cursors: Optional[List[Dict]] = None) -> Generator[Tuple[str, Dict], None, None]:
+        """Streams (user_id, fields) of the observation documents of a collection group issued after last_sync_time.
+
+        The scan is split into up to `partition_count` cursor ranges that are read concurrently and
+        merged into this single generator. Each partition's progress is kept in
+        `self.partition_cursors[heathobservation_col]`; passing that list back as `cursors` resumes
+        every partition after the last document it yielded.
+        """
+        if cursors is None:
+            cursors = self.plan_partitions(heathobservation_col, last_sync_time, partition_count)
+        self.partition_cursors[heathobservation_col] = cursors
+        queries = {i: self.partition_query(heathobservation_col, cursor) for i, cursor in enumerate(cursors) if not cursor['done']}
+        if not queries:
+            return
+
+        def resume(i, last_doc):
+            # the reader runs ahead of the consumer, so it resumes after the last document it read itself
+            if last_doc is None:
+                return queries[i]
+            return self.partition_query(heathobservation_col, dict(cursors[i], after=last_doc.reference.path,
+                                                                   after_issued=snapshot_data(last_doc).get('issued')))
+
+        for i, doc in self.merge_streams(queries, resume=resume):
+            cursor = cursors[i]
+            if doc is None:
+                cursor['done'] = True
+                continue
+            data = snapshot_data(doc)
+            cursor['after'] = doc.reference.path
+            cursor['after_issued'] = data.get('issued')
+            yield doc.reference.parent.parent.id, data
+
+    def get_observations(self, heathobservation_col: str, last_sync_time: Optional[datetime] = None,
+                         partition_count: int = 1, cursors: Optional[List[Dict]] = None) -> Generator[Dict, None, None]:
+        """Streams health observations of a collection group as one dict per document (see stream_observation_docs)."""
+        metric = clean_metric(heathobservation_col)
+        for user_id, data in self.stream_observation_docs(heathobservation_col, last_sync_time, partition_count, cursors):
+            obs = observation_dict(metric, user_id, data)
+            if obs:
+                yield obs
+
+    def get_observation_batches(self, heathobservation_col: str, last_sync_time: Optional[datetime] = None,
+                                partition_count: int = 1, cursors: Optional[List[Dict]] = None,
+                                batch_size: int = 10000, synced_at: Optional[datetime] = None) -> Generator[pa.RecordBatch, None, None]:
+        """Streams health observations of a collection group as pyarrow.RecordBatches of up to batch_size rows."""
+        builder = ObservationBatchBuilder(clean_metric(heathobservation_col), self.observations_schema,
+                                          capacity=batch_size, synced_at=synced_at)
+        decode_seconds = 0.0
+        for user_id, data in self.stream_observation_docs(heathobservation_col, last_sync_time, partition_count, cursors):
+            tic = time.perf_counter()
+            full = builder.append(user_id, data)
+            decode_seconds += time.perf_counter() - tic
+            if full:
+                yield self.observed(self.build(builder, decode_seconds))
+                decode_seconds = 0.0
+        if len(builder):
+            yield self.observed(self.build(builder, decode_seconds))
+
+    def build(self, builder: ObservationBatchBuilder, decode_seconds: float) -> pa.RecordBatch:
+        """Flushes the builder into a RecordBatch, recording the decode and Arrow build time of the batch."""
+        instruments.observe("decode_batch_seconds", decode_seconds)
+        with instruments.span("arrow_build_seconds"):
+            batch = builder.flush()
+        instruments.count("observation_rows", batch.num_rows)
+        return batch
+
+    def observed(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """Records the unit of the batch's metric in the metric registry (once per metric)."""
+        metric = batch.column('metric').dictionary[0].as_py()
+        if metric not in metric_registry.units:
+            metric_registry.observe_units(metric, batch.column('unit'))
+        return batch
@@ -0,0 +1,129 @@
+# Vectorized clinical categories for the derived labels (see derived_labels.py).
+# Everything works on whole arrays with np.select - no Python call per participant.
+
+import numpy as np
+import pandas as pd
+
+bmi_bins = [0, 19.9, 24.9, 29.9, 39.9, np.inf]
+bmi_labels = ['Underweight', 'Normal weight', 'Overweight', 'Obesity', 'Morbid Obesity']
+
+sleep_bins = [0, 6, 7, 9, np.inf]
+sleep_labels = ['Insufficient', 'Short', 'Normal', 'Too Long']
+
+
+def bin_categories(values, bins, labels, ordered=True) -> pd.Categorical:
+    """Right-closed bins (bins[i], bins[i+1]] -> labels[i], like pd.cut; NaN and out-of-range values give NaN.
+
+    Repeated labels (only allowed with ordered=False, as in pd.cut) map several bins to one category.
+    """
+    values = np.asarray(values, dtype=float)
+    categories = list(dict.fromkeys(labels))
+    conditions = [(values > lo) & (values <= hi) for lo, hi in zip(bins[:-1], bins[1:])]
+    codes = np.select(conditions, [categories.index(label) for label in labels], default=-1)
+    return pd.Categorical.from_codes(codes, categories, ordered=ordered)
+
+
+def fix_flipped_bp(systolic, diastolic):
+    """Swaps readings entered the wrong way round, so systolic is always the larger value."""
+    systolic, diastolic = np.asarray(systolic, dtype=float), np.asarray(diastolic, dtype=float)
+    flipped = diastolic > systolic
+    return np.where(flipped, diastolic, systolic), np.where(flipped, systolic, diastolic)
+
+
+def blood_pressure_category(systolic, diastolic) -> np.ndarray:
+    """ACC/AHA blood pressure stage per reading, 'Uncategorized' if either value is missing.
+
+    Crisis is tested first - in the old if-chain it came after Stage 1/2, which already caught every
+    crisis-level reading, so it could never be returned.
+    """
+    s, d = np.asarray(systolic, dtype=float), np.asarray(diastolic, dtype=float)
+    conditions = [
+        (s > 180) | (d > 120),
+        (s < 120) & (d < 80),
+        (120 <= s) & (s < 130) & (d < 80),
+        ((130 <= s) & (s < 140)) | ((80 <= d) & (d < 90)),
+        (140 <= s) | (90 <= d),
+    ]
+    choices = ['Hypertensive_Crisis', 'Normal', 'Elevated', 'Hypertension_Stage_1', 'Hypertension_Stage_2']
+    return np.select(conditions, choices, default='Uncategorized').astype(object)
+
+
+def bmi_category(bmi) -> pd.Categorical:
+    return bin_categories(bmi, bmi_bins, bmi_labels)
+
+
+def sleep_category(hours) -> pd.Categorical:
+    return bin_categories(hours, sleep_bins, sleep_labels)
+
+
+def legacy_categorize_bp(row):
+    """The row-wise if-chain formerly applied with DataFrame.apply, kept as the benchmark reference."""
+    systolic = row['values_systolic']
+    diastolic = row['values_diastolic']
+    if systolic < 120 and diastolic < 80:
+        return "Normal"
+    elif 120 <= systolic < 130 and diastolic < 80:
+        return "Elevated"
+    elif (130 <= systolic < 140) or (80 <= diastolic < 90):
+        return "Hypertension_Stage_1"
+    elif (140 <= systolic) or (90 <= diastolic):
+        return "Hypertension_Stage_2"
+    elif systolic > 180 or diastolic > 120:
+        return "Hypertensive_Crisis"
+    else:
+        return "Uncategorized"
+
+
+def check_parity(n=200_000, seed=0):
+    """Compares the vectorized categories with the apply/pd.cut versions on random readings (with NaNs and flips)."""
+    rng = np.random.default_rng(seed)
+    sys_dia = pd.DataFrame({'values_systolic': rng.normal(125, 25, n).round(), 'values_diastolic': rng.normal(80, 15, n).round()})
+    sys_dia.iloc[rng.choice(n, n // 100, replace=False), 0] = np.nan
+    sys_dia.iloc[rng.choice(n, n // 100, replace=False), 1] = np.nan
+
+    # swap - against the boolean-index copies it replaces
+    legacy = sys_dia.copy()
+    idx = legacy['values_diastolic'] > legacy['values_systolic']
+    sys_temp = legacy.loc[idx, 'values_systolic'].copy()
+    legacy.loc[idx, 'values_systolic'] = legacy.loc[idx, 'values_diastolic']
+    legacy.loc[idx, 'values_diastolic'] = sys_temp
+    systolic, diastolic = fix_flipped_bp(sys_dia['values_systolic'], sys_dia['values_diastolic'])
+    np.testing.assert_array_equal(systolic, legacy['values_systolic'])
+    np.testing.assert_array_equal(diastolic, legacy['values_diastolic'])
+
+    # blood pressure - identical except the readings that now reach Hypertensive_Crisis
+    expected = legacy.apply(legacy_categorize_bp, axis=1).to_numpy()
+    category = blood_pressure_category(systolic, diastolic)
+    crisis = category == 'Hypertensive_Crisis'
+    assert np.isin(expected[crisis], ['Hypertension_Stage_1', 'Hypertension_Stage_2']).all()
+    np.testing.assert_array_equal(category[~crisis], expected[~crisis])
+    assert ((systolic[crisis] > 180) | (diastolic[crisis] > 120)).all()
+
+    # bins - against pd.cut, including repeated labels
+    values = np.concatenate([rng.uniform(-5, 60, n), bmi_bins[1:-1], [np.nan, 0]])
+    pd.testing.assert_extension_array_equal(bmi_category(values), pd.cut(values, bmi_bins, labels=bmi_labels))
+    pd.testing.assert_extension_array_equal(sleep_category(values), pd.cut(values, sleep_bins, labels=sleep_labels))
+    bins, labels = [0, 1, 7, 19, 21, 23, 24], ['Late Sleeper', 'Very Late Sleeper', 'Shift Worker', 'Early Sleeper', 'Normal Sleeper', 'Late Sleeper']
+    pd.testing.assert_extension_array_equal(bin_categories(values, bins, labels, ordered=False),
+                                            pd.cut(values, bins, labels=labels, ordered=False))
+    print(f"parity ok ({crisis.sum()} of {n} readings are now Hypertensive_Crisis)")
+
+
+def benchmark(n=200_000, seed=0):
+    import time
+    rng = np.random.default_rng(seed)
+    sys_dia = pd.DataFrame({'values_systolic': rng.normal(125, 25, n).round(), 'values_diastolic': rng.normal(80, 15, n).round()})
+
+    tic = time.perf_counter()
+    sys_dia.apply(legacy_categorize_bp, axis=1)
+    legacy = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    blood_pressure_category(*fix_flipped_bp(sys_dia['values_systolic'], sys_dia['values_diastolic']))
+    vectorized = time.perf_counter() - tic
+    print(f"blood pressure, {n} participants: apply {legacy:.2f}s, np.select {vectorized:.3f}s ({legacy / vectorized:.0f}x)")
+
+
+if __name__ == "__main__":
+    check_parity()
+    benchmark()
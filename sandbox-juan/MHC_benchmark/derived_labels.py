@@ -0,0 +1,264 @@
+# Derived labels computed in stage 0 of recompute_labels.py.
+# Each function is a node of the label DAG (see label_dag.py): it gets a LabelIndex over its
+# source labels (see label_index.py) and returns the table stored under its name in the stage cache. To add a derived
+# label, add a function here - the driver picks it up.
+
+import altair as alt
+import numpy as np
+import pandas as pd
+from clinical_categories import bin_categories, blood_pressure_category, bmi_category, fix_flipped_bp, sleep_category
+from label_dag import derived
+from label_summary import types, summarize_labels
+
+categorical_labels = [k for k, v in types.items() if v in ('boolean', 'categorical')]
+numeric_labels = ["Hdl", "Ldl", "TotalCholesterol", "WeightKilograms", "sleep_time", "vigorous_act"]
+psych_labels = ['feel_worthwhile1', 'feel_worthwhile2', 'feel_worthwhile3', 'feel_worthwhile4', 'satisfiedwith_life']
+
+
+@derived('numeric_values', labels=numeric_labels)
+def numeric_values(lbls):
+    # get the numeric values first -
+    auxlbls_val = summarize_labels(lbls.frame, types)[1]
+    return auxlbls_val.loc[:,['HealthCode','labels','values_mean', 'values_median', 'values_max', 'values_min']]
+
+
+@derived('blood_pressure_categories', labels=['SystolicBloodPressure', 'DiastolicBloodPressure'])
+def blood_pressure_categories(lbls):
+    dia = lbls.latest("DiastolicBloodPressure").loc[:,['HealthCode','values']]
+    dia['values'] = dia['values'].astype(float)
+
+    sys = lbls.latest("SystolicBloodPressure").loc[:,['HealthCode','values']]
+    sys['values'] = sys['values'].astype(float)
+
+    sys_dia = pd.merge(sys, dia, on='HealthCode', suffixes=('_systolic', '_diastolic'))
+    # swap the flips, then get into categories
+    sys_dia['values_systolic'], sys_dia['values_diastolic'] = fix_flipped_bp(sys_dia['values_systolic'], sys_dia['values_diastolic'])
+    sys_dia['category'] = blood_pressure_category(sys_dia['values_systolic'], sys_dia['values_diastolic'])
+    return sys_dia
+
+
+@derived('blood_pressure_values', after=['blood_pressure_categories'])
+def blood_pressure_values(lbls, blood_pressure_categories):
+    return blood_pressure_categories.loc[:,['HealthCode','values_systolic']]
+
+
+@derived('bmi_categories', labels=['HeightCentimeters', 'WeightKilograms'])
+def bmi_categories(lbls):
+    height = lbls.latest("HeightCentimeters").loc[:,['HealthCode','values']]
+    height['values'] = height['values'].astype(float) / 100  # convert to meters
+    weight = lbls.max("WeightKilograms")
+    weight['values'] = weight['values'].astype(float)
+    bmi = pd.merge(weight, height, on='HealthCode', suffixes=('_weight', '_height'))
+    bmi['BMI_values'] = bmi['values_weight'] / (bmi['values_height'] ** 2)
+    bmi['category'] = bmi_category(bmi['BMI_values'])
+    return bmi.query('values_height>=1.4 and values_height <=2.1 and values_weight >=40')
+
+
+@derived('sleep_time_categories', labels=['sleep_time'])
+def sleep_time_categories(lbls):
+    sleep_time = lbls.latest("sleep_time").loc[:,['HealthCode','values']]
+    sleep_time['values'] = sleep_time['values'].astype(float)
+    sleep_time['category'] = sleep_category(sleep_time['values'])
+    return sleep_time.query('values<=12')
+
+
+@derived('wake_time_categories', labels=['WakeUpTime'])
+def wake_time_categories(lbls):
+    # WakeUpTime - these might be all wrong
+    wake_time = lbls.latest("WakeUpTime").loc[:,['HealthCode','values']]
+    wake_time['local_time'] = pd.to_datetime(wake_time['values']).dt.tz_localize(None)
+    wake_time['hour'] = pd.to_datetime(wake_time['local_time']).dt.hour + (wake_time['local_time'].dt.minute / 60)
+    wake_time['category'] = bin_categories(wake_time['hour'],
+                                            bins=[0, 5, 7, 9, 24],
+                                            labels=['Early Riser', 'Normal Riser', 'Late Riser', 'Very Late Riser'])
+    return wake_time
+
+
+@derived('go_sleep_time_categories', labels=['GoSleepTime'])
+def go_sleep_time_categories(lbls):
+    go_sleep_time = lbls.latest("GoSleepTime").loc[:,['HealthCode','values']]
+    go_sleep_time['local_time'] = pd.to_datetime(go_sleep_time['values']).dt.tz_localize(None)
+    go_sleep_time['hour'] = pd.to_datetime(go_sleep_time['local_time']).dt.hour+ (go_sleep_time['local_time'].dt.minute / 60)
+    go_sleep_time['category'] = bin_categories(go_sleep_time['hour'],
+                                                    bins=[0, 1, 7,19,21, 23, 24], ordered=False,
+                                                    labels=['Late Sleeper','Very Late Sleeper','Shift Worker','Early Sleeper', 'Normal Sleeper', 'Late Sleeper'])
+    return go_sleep_time
+
+
+@derived('psychological_factors_categories', labels=psych_labels)
+def psychological_factors_categories(lbls):
+    #                       count      mean       std  min  25%  50%  75%   max
+    # labels
+    # feel_worthwhile1    62188.0  7.488197  2.038789  0.0  7.0  8.0  9.0  10.0
+    # feel_worthwhile2    62207.0  7.209880  2.076224  0.0  6.0  8.0  9.0  10.0
+    # feel_worthwhile3    62171.0  4.292628  2.788223  0.0  2.0  4.0  7.0  10.0
+    # feel_worthwhile4    61888.0  2.433412  2.644067  0.0  0.0  1.0  4.0  10.0
+    # satisfiedwith_life  62261.0  7.270796  1.988985  0.0  6.0  8.0  9.0  10.0
+
+    cuts = {'feel_worthwhile1':[0,4,6,8,10.1],
+            'feel_worthwhile2':[0,4,6,8,10.1],
+            'feel_worthwhile3':[0,4,6,8,10.1],
+            'feel_worthwhile4':[0,1,3,5,10.1],
+            'satisfiedwith_life':[0,4,6,8,10.1]}
+    dfpsych_all = pd.DataFrame()
+    for var,cut in cuts.items():
+        dfpsych = lbls.latest(var).copy()
+        dfpsych['values'] = pd.to_numeric(dfpsych['values'], errors='coerce')
+        # dfcut with the above thresholds
+        dfpsych['category'] = bin_categories(dfpsych['values'], bins=cut, labels=['Low','Medium','High','Very High'])
+        dfpsych_all = pd.concat([dfpsych_all, dfpsych], ignore_index=True)
+    return dfpsych_all
+
+
+def happiness(lbls):
+    # happiness                  7.221016       7.288013    7.961086    6.181360           6.942890           7.564917
+    dfhappiness = lbls.rows("happiness").copy()
+    dfhappiness['values'] = pd.to_numeric(dfhappiness['values'], errors='coerce')
+    return dfhappiness
+
+
+@derived('happiness_longitudinal', labels=['happiness'])
+def happiness_longitudinal(lbls):
+    dfhappiness = happiness(lbls)
+    # longitudinal happiness
+    idx = dfhappiness.groupby('HealthCode')['values'].count()
+    idx = idx[idx>=3].index
+    dfhappiness_long = dfhappiness[dfhappiness['HealthCode'].isin(idx)].copy()
+    # plot it - sample 20 participants
+    sample_ids = dfhappiness_long['HealthCode'].sample(n=10, random_state=42).values
+    dfhappiness_long2 = dfhappiness_long[dfhappiness_long['HealthCode'].isin(sample_ids)].copy()
+    alt.Chart(dfhappiness_long2).mark_circle().encode(
+        x='timestamps:T',
+        y='values:Q',
+        color='HealthCode:N',
+        tooltip=['HealthCode:N','timestamps:T','values:Q']
+    ).properties(
+        title='Longitudinal Happiness Scores'
+    ).save('figures/happiness_longitudinal.html')
+    return dfhappiness_long
+
+
+@derived('happiness_static_categories', labels=['happiness'])
+def happiness_static_categories(lbls):
+    # happiness static values - categories
+    dfhappiness_static = lbls.latest("happiness").copy()
+    dfhappiness_static['values'] = pd.to_numeric(dfhappiness_static['values'], errors='coerce')
+    dfhappiness_static['category'] = bin_categories(dfhappiness_static['values'],
+                                            bins=[0, 4, 6, 8, 10],
+                                            labels=['Low','Medium','High','Very High'])
+    return dfhappiness_static
+
+
+# phys_activity              3.026438       3.025707    3.096056    2.956731           2.993261           3.059779
+# vigorous_act             73.407834      72.915853   78.833447   69.044003          70.965898          75.419630
+@derived('vigorous_categories', labels=['vigorous_act'])
+def vigorous_categories(lbls):
+    dfvig = lbls.rows("vigorous_act").sort_values(by='timestamps',ascending=False).copy()
+    dfvig['values'] = pd.to_numeric(dfvig['values'], errors='coerce')
+    dfvig['labels'] = bin_categories(dfvig['values'],
+                                    bins=[-1, 150, 300, 420, np.inf],
+                                    labels=['Below recommendation','Good','High volume','Athlete training'])
+    return dfvig
+
+
+@derived('physical_activity_categories', labels=['phys_activity'])
+def physical_activity_categories(lbls):
+    dfactivity = lbls.rows("phys_activity").sort_values(by='timestamps',ascending=False).copy()
+    dfactivity['values'] = pd.to_numeric(dfactivity['values'], errors='coerce')
+    dfactivity['labels'] = bin_categories(dfactivity['values'],
+                                    bins=[-1, 2, 4.1, np.inf],
+                                    labels=['Infrequent','Moderate','Frequent'])
+    return dfactivity
+
+
+heart_disease_map = {
+    "1": "Heart Attack/Myocardial Infarction",
+    "2": "Heart Bypass Surgery",
+    "3": "Coronary Blockage/Stenosis",
+    "4": "Coronary Stent/Angioplasty",
+    "5": "Angina (heart chest pains)",
+    "6": "High Coronary Calcium Score",
+    "7": "Heart Failure or CHF",
+    "8": "Atrial fibrillation (Afib)",
+    "9": "Congenital Heart",
+    "10": "None of the above",
+    "11": "Pulmonary Hypertension"
+}
+
+vascular_map = {
+    "1": "Stroke",
+    "2": "Transient Ischemic Attack (TIA)",
+    "3": "Carotid Artery Blockage/Stenosis",
+    "4": "Carotid Artery Surgery or Stent",
+    "5": "Peripheral Vascular Disease (Blockage/Stenosis, Surgery, or Stent)",
+    "6": "Abdominal Aortic Aneurysm",
+    "7": "None of the above",
+    "8": "Pulmonary Arterial Hypertension"
+}
+
+cerebrovascular = [
+    "Stroke",
+    "Transient Ischemic Attack (TIA)",
+    "Carotid Artery Blockage/Stenosis",
+    "Carotid Artery Surgery or Stent"
+]
+
+peripheral_systemic = [
+    "Abdominal Aortic Aneurysm",
+    "Peripheral Vascular Disease (Blockage/Stenosis, Surgery, or Stent)"
+]
+
+pulmonary = [
+    "Pulmonary Arterial Hypertension",
+    "Pulmonary Hypertension"
+]
+
+CAD_cols = ['Angina (heart chest pains)',
+            'Coronary Blockage/Stenosis',
+            'Coronary Stent/Angioplasty',
+            'Heart Attack/Myocardial Infarction',
+            'Heart Bypass Surgery',
+            'High Coronary Calcium Score']
+
+
+@derived('cat_final', labels=categorical_labels)
+def cat_final(lbls):
+    auxlbls_cat = summarize_labels(lbls.frame, types)[0]
+
+    # map vascular diseases
+    def map_diseases(labels,mapping):
+        a = auxlbls_cat.query(f'labels=="{labels}"')
+        a['values'] = a['values'].astype(float).astype(int).astype(str)
+        a['values'] = a['values'].map(mapping)
+        auxlbls_cat.loc[a.index,'values'] = a['values']
+        return auxlbls_cat
+    auxlbls_cat = map_diseases('vascular',vascular_map)
+    auxlbls_cat = map_diseases('heart_disease',heart_disease_map)
+
+    def map_systems(systems, system_name):
+        idx = auxlbls_cat['values'].isin(systems)
+        auxlbls_cat.loc[idx,'values'] = system_name
+        return auxlbls_cat
+
+    auxlbls_cat = map_systems(cerebrovascular, 'Cerebrovascular Disease')
+    auxlbls_cat = map_systems(peripheral_systemic, 'Peripheral/Systemic Vascular Disease')
+    auxlbls_cat = map_systems(pulmonary, 'PH')
+    auxlbls_cat = map_systems(CAD_cols, 'CAD')
+    # unify labels
+    auxlbls_cat.loc[auxlbls_cat['labels'].isin(['vascular','heart_disease']),'labels'] = 'cardiovascular_disease'
+
+    # plot the distributions
+    for labels in auxlbls_cat['labels'].unique():
+        aux = auxlbls_cat[auxlbls_cat['labels']==labels]
+        aux['timestamps_count'] = aux['timestamps_count'].astype(int)
+        aux['timestamps_count_bins'] = pd.cut(aux['timestamps_count'],bins=[0,1,2,5,10,np.inf], labels=['1','2','3-5','6-10','10+'])
+        chart = alt.Chart(aux).mark_bar().encode(
+            x=alt.X('timestamps_count_bins:O').sort(['1','2','3-5','6-10','10+']),
+            y='count()',
+            color='values:N',
+            tooltip=['timestamps_count_bins','values:N','count()']
+        ).properties(
+            title=f'Distribution of {labels}'
+        ).facet(column='values:N').save(f'figures/{labels}_distribution.html')
+
+    return auxlbls_cat.query('labels!="sleep_diagnosis2"')
@@ -0,0 +1,144 @@
+import hashlib
+import inspect
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Tuple
+import pandas as pd
+from label_index import LabelIndex
+
+max_workers = int(os.environ.get("LABELS_MAX_WORKERS", os.cpu_count() or 1))
+
+
+@dataclass
+class Node:
+    name: str
+    fn: Callable
+    labels: Tuple[str, ...] = ()  # source labels (values of dflbls['labels'])
+    after: Tuple[str, ...] = ()  # other nodes whose outputs it reads
+    version: int = 1
+    code: str = field(default='', repr=False)
+    files: Tuple[str, ...] = field(default=(), repr=False)  # source files of the code it runs
+
+
+# every derived label, by name - filled by the @derived decorator (see derived_labels.py)
+nodes: Dict[str, Node] = {}
+
+
+def source_files(fn: Callable) -> Tuple[str, ...]:
+    """The file defining fn plus the local modules (next to it) that file imports helpers or constants from."""
+    own = os.path.abspath(inspect.getsourcefile(fn))
+    files = {own}
+    for value in list(fn.__globals__.values()):
+        path = getattr(inspect.getmodule(value), '__file__', None)
+        if path and os.path.dirname(os.path.abspath(path)) == os.path.dirname(own):
+            files.add(os.path.abspath(path))
+    return tuple(sorted(files))
+
+
+def derived(name: str, labels=(), after=(), version: int = 1):
+    """Registers fn(lbls, **outputs) as the node computing the derived table `name`.
+
+    lbls is a LabelIndex over only the declared source labels and each node in
+    `after` is passed as a keyword argument holding its output. The node is recomputed when those
+    inputs change or any source file it can reach does: its own module (so helpers and constants
+    defined there) and the local modules that module imports from (e.g. clinical_categories.py).
+    Bump version to force a recompute for anything else.
+    """
+    def register(fn):
+        if name in nodes:
+            raise ValueError(f"Derived label {name} is defined twice")
+        nodes[name] = Node(name, fn, tuple(labels), tuple(after), version, inspect.getsource(fn), source_files(fn))
+        return fn
+    return register
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def topological_order(selected: Dict[str, Node]):
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Derived labels have a dependency cycle through {name}")
+        if name not in selected:
+            raise KeyError(f"Unknown derived label {name}")
+        visiting.add(name)
+        for dep in selected[name].after:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in selected:
+        visit(name)
+    return order
+
+
+def run_nodes(dflbls: pd.DataFrame, cache, workers: int = max_workers) -> Dict[str, str]:
+    """Brings every registered node's table in the stage cache up to date.
+
+    Nodes whose source labels, upstream outputs and source files are unchanged since their last run are
+    skipped; the others run in parallel processes as soon as the nodes they read are done.
+    Returns {node: 'cached' | 'computed'}.
+    """
+    order = topological_order(nodes)
+    index = LabelIndex(dflbls)
+    label_hashes = {label: frame_hash(index.rows(label)) for label in index.labels}
+
+    def key(node):
+        return cache.key(files=node.files, tables=node.after, values={
+            'labels': {label: label_hashes.get(label) for label in node.labels},
+            'code': node.code, 'version': node.version})
+
+    def inputs(node):
+        return index.subset(node.labels), {dep: cache.load(dep) for dep in node.after}
+
+    status, keys, running = {}, {}, {}
+    pending = list(order)
+    # fork, so the worker processes do not re-run the driver script on import (spawn/forkserver do)
+    parallel = workers > 1 and 'fork' in multiprocessing.get_all_start_methods()
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) if parallel else None
+    tic = time.time()
+    try:
+        while pending or running:
+            for name in [n for n in pending if all(dep in status for dep in nodes[n].after)]:
+                pending.remove(name)
+                node = nodes[name]
+                keys[name] = key(node)
+                if cache.fresh(f'node:{name}', keys[name]):
+                    status[name] = 'cached'
+                    continue
+                lbls, outputs = inputs(node)
+                if pool is None:
+                    finish(cache, name, keys[name], node.fn(lbls, **outputs))
+                    status[name] = 'computed'
+                else:
+                    running[pool.submit(node.fn, lbls, **outputs)] = name
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    finish(cache, name, keys[name], future.result())
+                    status[name] = 'computed'
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    computed = [n for n in order if status[n] == 'computed']
+    print(f"derived labels: {len(computed)} computed, {len(order) - len(computed)} unchanged in {time.time() - tic:.1f}s"
+          + (f" ({', '.join(computed)})" if computed else ""))
+    return status
+
+
+def finish(cache, name, key, df):
+    cache.save(name, df)
+    cache.done(f'node:{name}', key, tables=[name])
@@ -0,0 +1,173 @@
+import math
+import os
+import numpy as np
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def group_bounds(df: pd.DataFrame):
+    """Stable sort of df by (labels, HealthCode) - the order groupby would give - and the row offsets
+    of every group: (sorted df, group starts, group ends, label starts as indices into the groups)."""
+    order = np.lexsort((pd.factorize(df['HealthCode'], sort=True)[0], pd.factorize(df['labels'], sort=True)[0]))
+    df = df.iloc[order]
+    labels = df['labels'].to_numpy()
+    codes = df['HealthCode'].to_numpy()
+    new_label = np.r_[True, labels[1:] != labels[:-1]]
+    starts = np.flatnonzero(new_label | np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+    return df, starts, ends, np.flatnonzero(new_label[starts])
+
+
+def iter_label_dicts(df: pd.DataFrame):
+    """Yields (label, {HealthCode: {'timestamps': [...], 'values': [...]}}) in label then HealthCode order.
+
+    Columns are converted to lists once and sliced per group - nothing is done per row in Python.
+    """
+    if df.empty:
+        return
+    df, starts, ends, label_starts = group_bounds(df)
+    labels = df['labels'].to_numpy()
+    codes = df['HealthCode'].to_numpy()[starts].tolist()
+    timestamps = df['timestamps'].to_numpy().tolist()
+    values = df['values'].to_numpy().tolist()
+    label_ends = np.r_[label_starts[1:], len(starts)]
+    for g0, g1 in zip(label_starts, label_ends):
+        yield labels[starts[g0]], {code: {'timestamps': timestamps[s:e], 'values': values[s:e]}
+                                   for code, s, e in zip(codes[g0:g1], starts[g0:g1].tolist(), ends[g0:g1].tolist())}
+
+
+def write_labels_json(df: pd.DataFrame, path: str):
+    """Writes the nested label -> HealthCode -> {timestamps, values} JSON one label at a time, compact.
+
+    NaN values are written as null (json.dump wrote the non-standard NaN).
+    """
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b'{')
+        for i, (label, by_code) in enumerate(iter_label_dicts(df)):
+            f.write((b',' if i else b'') + orjson.dumps(label) + b':' + orjson.dumps(by_code, option=option, default=str))
+        f.write(b'}')
+    os.replace(tmp_path, path)
+
+
+def labels_table(df: pd.DataFrame) -> pa.Table:
+    """The long table in the labels Parquet layout: numbers and booleans in value, anything else in value_str."""
+    values = df['values'].astype(object)
+    present = values.notna()
+    is_number = values.map(type).isin([bool, int, float, np.bool_, np.int64, np.float64]) & present
+    value_str = pd.Series(None, index=values.index, dtype=object)
+    value_str[present & ~is_number] = values[present & ~is_number].astype(str)
+    return pa.table({
+        'labels': pa.array(df['labels'].astype(str), pa.string()),
+        'HealthCode': pa.array(df['HealthCode'], pa.string()),
+        'timestamps': pa.array(df['timestamps'], pa.string(), from_pandas=True),
+        'value': pa.array(values.where(is_number).astype(float), pa.float64(), from_pandas=True),
+        'value_str': pa.array(value_str, pa.string(), from_pandas=True),
+    })
+
+
+def write_labels_parquet(df: pd.DataFrame, path: str):
+    """Writes the long table as a Parquet dataset partitioned by label (path/labels=<label>/...)."""
+    df, _, _, _ = group_bounds(df)
+    pq.write_to_dataset(labels_table(df), path, partition_cols=['labels'], compression='zstd',
+                        existing_data_behavior='delete_matching')
+
+
+def read_labels_parquet(path: str) -> dict:
+    """Reads the partitioned dataset back into the nested dict of last_labels.json."""
+    df = pq.read_table(path).to_pandas()
+    df['labels'] = df['labels'].astype(str)
+    df['values'] = df['value'].astype(object).where(df['value'].notna(), df['value_str'])
+    return dict(iter_label_dicts(df))
+
+
+def export_labels(df: pd.DataFrame, json_path: str, parquet_path: str = None):
+    """Writes last_labels.json and, if parquet_path is given, the equivalent partitioned Parquet dataset."""
+    write_labels_json(df, json_path)
+    if parquet_path:
+        write_labels_parquet(df, parquet_path)
+
+
+def legacy_export(df: pd.DataFrame) -> dict:
+    """The former stage-2 groupby + iterrows construction, kept as the benchmark reference."""
+    grouped = df.groupby(['labels', 'HealthCode']).agg({'values': list, 'timestamps': list})
+    final_dict = {}
+    for (label, health_code), row in grouped.iterrows():
+        if label not in final_dict:
+            final_dict[label] = {}
+        final_dict[label][health_code] = {"timestamps": row['timestamps'], "values": row['values']}
+    return final_dict
+
+
+def synthetic_stage2(n_codes=20000, seed=0) -> pd.DataFrame:
+    """A stage-2 shaped table: numeric, categorical/boolean and longitudinal labels, unsorted, with NaNs."""
+    from label_summary import labels_to_long, synthetic_labels, types
+    df = labels_to_long(synthetic_labels(types, n_codes, seed)).sample(frac=1, random_state=seed)
+    rng = np.random.default_rng(seed)
+    df.loc[df.sample(frac=0.01, random_state=seed).index, 'values'] = np.nan
+    df.loc[df['labels'] == 'Diabetes', 'values'] = rng.random((df['labels'] == 'Diabetes').sum()) > 0.5
+    df['timestamps'] = df['timestamps'].fillna('')
+    return df
+
+
+def normalize(obj):
+    """NaN -> None and numbers as float, so the legacy dict compares with what was read back."""
+    if isinstance(obj, dict):
+        return {k: normalize(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [normalize(v) for v in obj]
+    if isinstance(obj, float) and math.isnan(obj):
+        return None
+    if isinstance(obj, (bool, int, float)):
+        return float(obj)
+    return obj
+
+
+def check_round_trip(df: pd.DataFrame, folder: str):
+    """Asserts that last_labels.json and the Parquet dataset both read back to the legacy nested dict."""
+    import json
+    expected = normalize(legacy_export(df))
+    json_path, parquet_path = os.path.join(folder, 'last_labels.json'), os.path.join(folder, 'last_labels')
+    export_labels(df, json_path, parquet_path)
+    with open(json_path, 'r') as f:
+        loaded = json.load(f)
+    assert list(loaded) == list(expected) and all(list(loaded[k]) == list(expected[k]) for k in expected), "key order differs"
+    assert normalize(loaded) == expected, "last_labels.json does not round-trip"
+    assert normalize(read_labels_parquet(parquet_path)) == expected, "Parquet dataset does not round-trip"
+    print("round trip ok (json and parquet)")
+
+
+def benchmark(n_codes=20000):
+    """Time and size of the legacy iterrows + json.dump(indent=2) export against the columnar writer."""
+    import json
+    import tempfile
+    import time
+
+    df = synthetic_stage2(n_codes)
+    folder = tempfile.mkdtemp()
+    check_round_trip(df, folder)
+
+    tic = time.perf_counter()
+    with open(os.path.join(folder, 'legacy.json'), 'w') as f:
+        json.dump(legacy_export(df), f, indent=2)
+    legacy = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    write_labels_json(df, os.path.join(folder, 'last_labels.json'))
+    fast = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    write_labels_parquet(df, os.path.join(folder, 'last_labels'))
+    parquet = time.perf_counter() - tic
+    parquet_bytes = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(os.path.join(folder, 'last_labels')) for name in names)
+
+    mb = lambda name: os.path.getsize(os.path.join(folder, name)) / 2**20
+    print(f"{len(df)} rows: iterrows + json.dump(indent=2) {legacy:.1f}s {mb('legacy.json'):.0f} MB, "
+          f"columnar json {fast:.1f}s {mb('last_labels.json'):.0f} MB, parquet {parquet:.1f}s {parquet_bytes / 2**20:.0f} MB")
+
+
+if __name__ == "__main__":
+    benchmark()
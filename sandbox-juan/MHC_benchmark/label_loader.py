@@ -0,0 +1,264 @@
+import math
+from array import array
+import ijson
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# kinds of the 'values' entries, so the DataFrame gets back the same Python types json.loads gives
+NULL, INT, FLOAT, BOOL, STR = range(5)
+
+labels_parquet_schema = pa.schema([
+    ('labels', pa.dictionary(pa.int32(), pa.string())),
+    ('HealthCode', pa.dictionary(pa.int32(), pa.string())),
+    ('timestamps', pa.string()),
+    ('value', pa.float64()),  # numbers and booleans
+    ('value_str', pa.string()),  # everything else
+])
+
+
+def sorted_categorical(ids, names) -> pd.Categorical:
+    """Categorical of dictionary ids into names, recoded to lexically sorted categories."""
+    order = np.argsort(np.array(names, dtype=object)) if names else np.empty(0, dtype=np.int64)
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return pd.Categorical.from_codes(rank[np.frombuffer(ids, dtype=np.int32)], categories=np.array(names, dtype=object)[order])
+
+
+class LabelColumns:
+    """Typed column buffers for the long label table (labels, HealthCode, timestamps, values).
+
+    Labels, HealthCodes and string values are dictionary encoded, numbers go to a float array,
+    so a row costs a few bytes plus its timestamp string instead of a nested dict entry.
+    """
+
+    def __init__(self):
+        self.label_names, self.label_index = [], {}
+        self.codes, self.code_index = [], {}
+        self.strings, self.string_index = [], {}
+        self.clear()
+
+    def clear(self):
+        self.label_ids = array('i')
+        self.code_ids = array('i')
+        self.timestamps = []
+        self.kinds = array('b')
+        self.numbers = array('d')
+        self.string_ids = array('i')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    @staticmethod
+    def _encode(value, names, index):
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(names)
+            names.append(value)
+        return i
+
+    def append(self, label, code, timestamps, values):
+        """Adds one HealthCode entry, exploded to one row per timestamp (one NaN row if it is empty)."""
+        timestamps = timestamps if isinstance(timestamps, list) else [timestamps]
+        values = values if isinstance(values, list) else [values]
+        if not timestamps:
+            timestamps, values = [math.nan], [math.nan]
+        if len(values) != len(timestamps):
+            raise ValueError(f"{label}/{code}: {len(timestamps)} timestamps but {len(values)} values")
+
+        label_id = self._encode(label, self.label_names, self.label_index)
+        code_id = self._encode(code, self.codes, self.code_index)
+        n = len(timestamps)
+        self.label_ids.extend([label_id] * n)
+        self.code_ids.extend([code_id] * n)
+        self.timestamps.extend(timestamps)
+        for value in values:
+            if isinstance(value, bool):
+                kind, number, string_id = BOOL, float(value), -1
+            elif isinstance(value, int):
+                kind, number, string_id = INT, float(value), -1
+            elif isinstance(value, float):
+                kind, number, string_id = FLOAT, value, -1
+            elif isinstance(value, str):
+                kind, number, string_id = STR, math.nan, self._encode(value, self.strings, self.string_index)
+            else:
+                kind, number, string_id = NULL, math.nan, -1
+            self.kinds.append(kind)
+            self.numbers.append(number)
+            self.string_ids.append(string_id)
+
+    def values(self) -> np.ndarray:
+        """The 'values' column as objects of the types json.loads would have produced."""
+        kinds = np.frombuffer(self.kinds, dtype=np.int8)
+        numbers = np.frombuffer(self.numbers, dtype=np.float64)
+        string_ids = np.frombuffer(self.string_ids, dtype=np.int32)
+        values = np.empty(len(kinds), dtype=object)
+        values[kinds == NULL] = None
+        values[kinds == FLOAT] = numbers[kinds == FLOAT].tolist()
+        values[kinds == INT] = numbers[kinds == INT].astype(np.int64).tolist()
+        values[kinds == BOOL] = numbers[kinds == BOOL].astype(bool).tolist()
+        if self.strings:
+            values[kinds == STR] = np.array(self.strings, dtype=object)[string_ids[kinds == STR]]
+        return values
+
+    def to_frame(self) -> pd.DataFrame:
+        """The rows of label_summary.labels_to_long(json.load(...)) on the parsed file, in compact dtypes.
+
+        HealthCode and labels are categoricals over the dictionary codes already built (with sorted
+        categories, so they sort and group like the object columns did), timestamps an
+        Arrow-backed string column (missing ones are <NA>). values keeps the Python types json.loads
+        gives, since the categorical summaries group on them.
+        """
+        return pd.DataFrame({
+            'HealthCode': sorted_categorical(self.code_ids, self.codes),
+            'timestamps': pd.arrays.ArrowStringArray(pa.chunked_array([pa.array(self.timestamps, pa.string(), from_pandas=True)])),
+            'values': self.values(),
+            'labels': sorted_categorical(self.label_ids, self.label_names),
+        })
+
+    def to_arrow(self) -> pa.RecordBatch:
+        kinds = np.frombuffer(self.kinds, dtype=np.int8)
+        numbers = np.frombuffer(self.numbers, dtype=np.float64)
+        string_ids = np.frombuffer(self.string_ids, dtype=np.int32)
+        return pa.RecordBatch.from_arrays([
+            pa.DictionaryArray.from_arrays(pa.array(self.label_ids, pa.int32()), pa.array(self.label_names, pa.string())),
+            pa.DictionaryArray.from_arrays(pa.array(self.code_ids, pa.int32()), pa.array(self.codes, pa.string())),
+            pa.array([t if isinstance(t, str) else None for t in self.timestamps], pa.string()),
+            pa.array(numbers, pa.float64(), mask=np.isin(kinds, (INT, FLOAT, BOOL), invert=True)),
+            pa.array(np.array(self.strings + [None], dtype=object)[string_ids], pa.string()),
+        ], schema=labels_parquet_schema)
+
+
+def parse_labels(f, columns, on_full=None, batch_rows=500_000):
+    """Streams {label: {HealthCode: {'timestamps': [...], 'values': [...]}}} from a binary file into columns.
+
+    Walks the JSON events without building the nested dict - only the entry being parsed is held
+    as Python objects. With on_full, on_full(columns) is called (and the buffers cleared) every
+    batch_rows rows and once at the end.
+    """
+    depth = 0
+    label = code = field = None
+    entry = {}
+    current = None  # array being filled
+    for event, value in ijson.basic_parse(f, use_float=True, buf_size=1 << 20):
+        if event == 'map_key':
+            if depth == 1:
+                label = value
+            elif depth == 2:
+                code = value
+            else:
+                field = value
+        elif event == 'start_map':
+            depth += 1
+            if depth == 3:
+                entry = {}
+        elif event == 'end_map':
+            if depth == 3:
+                columns.append(label, code, entry.get('timestamps'), entry.get('values'))
+                if on_full is not None and len(columns) >= batch_rows:
+                    on_full(columns)
+                    columns.clear()
+            depth -= 1
+        elif event == 'start_array':
+            current = entry[field] = []
+        elif event == 'end_array':
+            current = None
+        elif current is not None:
+            current.append(value)
+        else:
+            entry[field] = value
+    if on_full is not None and len(columns):
+        on_full(columns)
+        columns.clear()
+    return columns
+
+
+def load_labels(path: str) -> pd.DataFrame:
+    """Reads labels_labels.json into the long label table (HealthCode, timestamps, values, labels)."""
+    with open(path, 'rb') as f:
+        return parse_labels(f, LabelColumns()).to_frame()
+
+
+def labels_to_parquet(path: str, parquet_path: str, batch_rows: int = 500_000) -> int:
+    """Converts labels_labels.json to a Parquet file of the long label table, one row group per batch_rows.
+
+    Memory stays at one row group whatever the size of the JSON. Returns the number of rows written.
+    """
+    rows = 0
+    with open(path, 'rb') as f, pq.ParquetWriter(parquet_path, labels_parquet_schema, compression='zstd') as writer:
+        def write(columns):
+            nonlocal rows
+            writer.write_batch(columns.to_arrow())
+            rows += len(columns)
+        parse_labels(f, LabelColumns(), on_full=write, batch_rows=batch_rows)
+    return rows
+
+
+def load_enrollment_info(path: str) -> pd.DataFrame:
+    """Reads labels_enrollment_info.json ({HealthCode: {field: value}}) one HealthCode at a time.
+
+    Same frame as pd.DataFrame(json.load(f)).T - one row per HealthCode, object columns.
+    """
+    codes, columns = [], {}
+    with open(path, 'rb') as f:
+        for i, (code, record) in enumerate(ijson.kvitems(f, '', use_float=True)):
+            codes.append(code)
+            for field, value in record.items():
+                column = columns.get(field)
+                if column is None:
+                    column = columns[field] = [math.nan] * i
+                column.append(value)
+            for column in columns.values():
+                if len(column) == i:
+                    column.append(math.nan)
+    return pd.DataFrame({field: pd.Series(column, dtype=object) for field, column in columns.items()}).set_axis(codes)
+
+
+def benchmark(n_codes=20000):
+    """Peak Python memory and time of json.loads + labels_to_long against the streaming loader."""
+    import json
+    import os
+    import tempfile
+    import time
+    import tracemalloc
+    from label_summary import labels_to_long, synthetic_labels, types
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'labels_labels.json')
+    with open(path, 'w') as f:
+        json.dump(synthetic_labels(types, n_codes), f)
+    print(f"synthetic labels file: {os.path.getsize(path) / 2**20:.0f} MB")
+
+    def measure(name, fn):
+        tracemalloc.start()
+        tic = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - tic
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        print(f"{name}: {seconds:.1f}s, peak {peak:.0f} MB")
+        return result
+
+    def legacy():
+        with open(path, 'r') as f:
+            return labels_to_long(json.loads(f.read()))
+
+    expected = measure("json.loads + labels_to_long", legacy)
+    dflbls = measure("load_labels", lambda: load_labels(path))
+    # same rows; the compact dtypes back as the legacy object columns
+    as_legacy = dflbls.astype(object)
+    as_legacy['timestamps'] = as_legacy['timestamps'].where(dflbls['timestamps'].notna(), np.nan)
+    pd.testing.assert_frame_equal(expected, as_legacy)
+    print(f"frame memory: {expected.memory_usage(deep=True).sum() / 2**20:.0f} MB object columns, "
+          f"{dflbls.memory_usage(deep=True).sum() / 2**20:.0f} MB compact")
+
+    parquet_path = os.path.join(folder, 'labels.parquet')
+    rows = measure("labels_to_parquet", lambda: labels_to_parquet(path, parquet_path, batch_rows=100_000))
+    assert rows == len(expected)
+    print(f"parquet: {os.path.getsize(parquet_path) / 2**20:.0f} MB, {rows} rows")
+    print("outputs match")
+
+
+if __name__ == "__main__":
+    benchmark()
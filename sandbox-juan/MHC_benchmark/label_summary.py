@@ -0,0 +1,183 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+types = {
+    'sleep_diagnosis1': 'boolean',
+    'atwork': 'ordinal',
+    'phys_activity': 'ordinal',
+    'sleep_time': 'float',
+    'sleep_time1': 'float',
+    'vigorous_act': 'ordinal',
+    'work': 'boolean',
+    'sleep_diagnosis2': 'categorical',
+    'happiness': 'float',
+    'heart_disease': 'categorical',
+    'vascular': 'categorical',
+    'feel_worthwhile1': 'ordinal',
+    'feel_worthwhile2': 'ordinal',
+    'feel_worthwhile3': 'ordinal',
+    'feel_worthwhile4': 'ordinal',
+    'satisfiedwith_life': 'ordinal',
+    'BiologicalSex': 'boolean',
+    'WakeUpTime': 'float',
+    'GoSleepTime': 'float',
+    'HeightCentimeters': 'float',
+    'WeightKilograms': 'float',
+    'Diabetes': 'boolean',
+    'Hypertension': 'boolean',
+    'Hdl': 'float',
+    'Ldl': 'float',
+    'TotalCholesterol': 'float',
+    'DiastolicBloodPressure': 'float',
+    'SystolicBloodPressure': 'float'
+}
+
+val_stats = ['mean', 'median', 'max', 'min']
+
+
+def labels_to_long(aux):
+    """Flattens {label: {HealthCode: {'timestamps': [...], 'values': [...]}}} into one long table.
+
+    Same rows and order as exploding each label's DataFrame(v).T and concatenating them, in a
+    single pass over HealthCodes (empty lists still give one NaN row, like explode).
+    """
+    labels, codes, lengths, timestamps, values = [], [], [], [], []
+    for label, by_code in aux.items():
+        n_label = 0
+        for code, entry in by_code.items():
+            ts, vs = entry.get('timestamps'), entry.get('values')
+            ts = ts if isinstance(ts, list) else [ts]
+            vs = vs if isinstance(vs, list) else [vs]
+            if not ts:
+                ts, vs = [np.nan], [np.nan]
+            codes.append(code)
+            lengths.append(len(ts))
+            timestamps.append(ts)
+            values.append(vs)
+            n_label += len(ts)
+        labels.append((label, n_label))
+
+    return pd.DataFrame({
+        'HealthCode': np.repeat(np.array(codes, dtype=object), lengths),
+        'timestamps': list(itertools.chain.from_iterable(timestamps)),
+        'values': list(itertools.chain.from_iterable(values)),
+        'labels': np.repeat(np.array([l for l, _ in labels], dtype=object), [n for _, n in labels]),
+    })
+
+
+def summarize_labels(dflbls, types):
+    """Per-HealthCode summaries of the long label table, split into categorical and numeric labels.
+
+    Returns (auxlbls_cat, auxlbls_val) with the columns stage 0 has always written to
+    temp/cat.csv and temp/val.csv - including the 'values_<lambda_0>'/'values_<lambda_1>'
+    names of the 25%/75% quantiles.
+    """
+    # keep the labels in file order when sorting the grouped results
+    label_order = pd.CategoricalDtype(list(dict.fromkeys(dflbls['labels'])), ordered=True)
+    kinds = dflbls['labels'].map(types)
+
+    cat = dflbls[kinds.isin(['boolean', 'categorical'])]
+    auxlbls_cat = (cat.assign(labels=cat['labels'].astype(label_order))
+                   .groupby(['labels', 'HealthCode', 'values'], sort=False, observed=True)['timestamps']
+                   .agg(['count', 'min', 'max'])
+                   .add_prefix('timestamps_')
+                   .reset_index()
+                   .sort_values(['labels', 'HealthCode'], kind='mergesort'))
+    auxlbls_cat = auxlbls_cat.loc[:, ['HealthCode', 'values', 'timestamps_count', 'timestamps_min', 'timestamps_max', 'labels']]
+    auxlbls_cat['labels'] = auxlbls_cat['labels'].astype(object)
+
+    val = dflbls[kinds.isin(['float', 'ordinal'])]
+    val = val.assign(labels=val['labels'].astype(label_order), values=pd.to_numeric(val['values'], errors='coerce'))
+    grouped = val.groupby(['labels', 'HealthCode'], observed=True)
+    auxlbls_val = pd.concat([
+        grouped['timestamps'].agg(['count', 'min', 'max']).add_prefix('timestamps_'),
+        grouped['values'].agg(val_stats).add_prefix('values_'),
+        # one grouped quantile call instead of a Python lambda per group
+        grouped['values'].quantile([0.25, 0.75]).unstack().reindex(columns=[0.25, 0.75]).set_axis(['values_<lambda_0>', 'values_<lambda_1>'], axis=1),
+    ], axis=1).reset_index()
+    auxlbls_val = auxlbls_val.loc[:, ['HealthCode', 'timestamps_count', 'timestamps_min', 'timestamps_max']
+                                  + [f'values_{s}' for s in val_stats] + ['values_<lambda_0>', 'values_<lambda_1>', 'labels']]
+    auxlbls_val['labels'] = auxlbls_val['labels'].astype(object)
+    return auxlbls_cat.reset_index(drop=True), auxlbls_val
+
+
+def legacy_summary(aux, types):
+    """The original stage-0 loop (per-label concat + lambda quantiles), kept as the benchmark reference."""
+    dflbls, auxlbls_val, auxlbls_cat = pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    for k, v in aux.items():
+        df2 = pd.DataFrame(v).T.explode(column=['timestamps', 'values'])
+        df2 = df2.reset_index().rename(columns={'index': 'HealthCode'})
+        df2['labels'] = k
+        dflbls = pd.concat([dflbls, df2], ignore_index=True)
+        if types[k] == 'boolean' or types[k] == 'categorical':
+            aux2 = df2.groupby(['HealthCode', 'values']).aggregate({'timestamps': ['count', 'min', 'max']}).reset_index()
+            aux2.columns = [c.strip('_') for c in aux2.columns.map('_'.join)]
+            aux2['labels'] = k
+            auxlbls_cat = pd.concat([auxlbls_cat, aux2], ignore_index=True)
+        elif types[k] == 'float' or types[k] == 'ordinal':
+            df2['values'] = pd.to_numeric(df2['values'], errors='coerce')
+            aux2 = df2.groupby('HealthCode').aggregate({'timestamps': ['count', 'min', 'max'],
+                                                        'values': ['mean', 'median', 'max', 'min', lambda x: x.quantile(0.25), lambda x: x.quantile(0.75)]}).reset_index()
+            aux2.columns = [c.strip('_') for c in aux2.columns.map('_'.join)]
+            aux2['labels'] = k
+            auxlbls_val = pd.concat([auxlbls_val, aux2], ignore_index=True)
+    return dflbls, auxlbls_cat, auxlbls_val
+
+
+def synthetic_labels(types, n_codes=60000, seed=0):
+    """A labels_labels.json-shaped dict with roughly production sizes (10k-45k HealthCodes per label)."""
+    rng = np.random.default_rng(seed)
+    codes = np.array([f'hc{i:06d}' for i in range(n_codes)])
+    base = np.datetime64('2015-03-01T00:00:00')
+    aux = {}
+    for label, kind in types.items():
+        chosen = rng.choice(codes, size=int(n_codes * rng.uniform(0.15, 0.75)), replace=False)
+        counts = rng.geometric(0.5, size=len(chosen))
+        by_code = {}
+        for code, n in zip(chosen, counts):
+            ts = (base + rng.integers(0, 3 * 365 * 86400, size=n).astype('timedelta64[s]')).astype(str).tolist()
+            if kind in ('boolean', 'categorical'):
+                vs = rng.integers(1, 4, size=n).astype(str).tolist()
+            else:
+                vs = np.round(rng.normal(7, 2, size=n), 2).tolist()
+            by_code[code] = {'timestamps': ts, 'values': vs}
+        aux[label] = by_code
+    return aux
+
+
+def benchmark(types, n_codes=60000):
+    """Times the legacy stage-0 loop against labels_to_long + summarize_labels on a synthetic labels file."""
+    import json
+    import os
+    import tempfile
+    import time
+
+    path = os.path.join(tempfile.mkdtemp(), 'labels_labels.json')
+    with open(path, 'w') as f:
+        json.dump(synthetic_labels(types, n_codes), f)
+    with open(path, 'r') as f:
+        aux = json.loads(f.read())
+    print(f"synthetic labels file: {os.path.getsize(path) / 2**20:.0f} MB, {sum(len(v) for v in aux.values())} (label, HealthCode) pairs")
+
+    tic = time.perf_counter()
+    dflbls_old, cat_old, val_old = legacy_summary(aux, types)
+    legacy = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    dflbls = labels_to_long(aux)
+    cat_new, val_new = summarize_labels(dflbls, types)
+    vectorized = time.perf_counter() - tic
+    print(f"legacy loop: {legacy:.1f}s, vectorized: {vectorized:.1f}s ({legacy / vectorized:.1f}x)")
+
+    # same rows, values and statistics
+    pd.testing.assert_frame_equal(dflbls_old.reset_index(drop=True), dflbls, check_dtype=False)
+    keys = ['labels', 'HealthCode', 'values']
+    pd.testing.assert_frame_equal(cat_old.sort_values(keys).reset_index(drop=True),
+                                  cat_new.sort_values(keys).reset_index(drop=True), check_dtype=False)
+    pd.testing.assert_frame_equal(val_old.reset_index(drop=True), val_new, check_dtype=False)
+    print("outputs match")
+
+
+if __name__ == "__main__":
+    benchmark(types)
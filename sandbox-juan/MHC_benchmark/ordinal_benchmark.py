@@ -0,0 +1,234 @@
+# Cross-validated benchmark of the ordinal models (ordinal_models.py) on the ordinal labels
+# recompute_labels.py derives. Run: ORDINAL_FEATURES=<parquet/csv with a HealthCode column> python ordinal_benchmark.py
+# (without ORDINAL_FEATURES it runs on a synthetic problem). ORDINAL_MULTI_TARGET=1 trains every target
+# and model in one parallel batch over a shared memory-mapped feature matrix.
+
+import hashlib
+import os
+import resource
+import time
+import joblib
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, cohen_kappa_score, mean_absolute_error
+from sklearn.model_selection import StratifiedKFold
+from label_index import LabelIndex
+from ordinal_models import FrankHallOrdinalClassifier, OrderedLogit
+
+psych_targets = ['feel_worthwhile1', 'feel_worthwhile2', 'feel_worthwhile3', 'feel_worthwhile4', 'satisfiedwith_life']
+raw_ordinal_targets = ['atwork']
+
+# name -> (factory, spec); the spec is part of the fold cache key, so change it with the parameters
+models = {
+    'frank_hall_rf': (lambda: FrankHallOrdinalClassifier(RandomForestClassifier(n_estimators=200, min_samples_leaf=5, n_jobs=1, random_state=0)),
+                      'FrankHall(RandomForest(n_estimators=200, min_samples_leaf=5))'),
+    'ordered_logit': (lambda: OrderedLogit(distr='logit'), 'OrderedModel(logit, bfgs, maxiter=200)'),
+}
+
+
+def ordinal_targets(cache) -> dict:
+    """{target: Series of ordinal class codes indexed by HealthCode} from the stage cache tables."""
+    targets = {}
+    psych = cache.load('psychological_factors_categories')
+    for label in psych_targets:
+        rows = psych[psych['labels'] == label]
+        targets[label] = pd.Series(rows['category'].cat.codes.to_numpy(), index=rows['HealthCode'].to_numpy())
+    happiness = cache.load('happiness_static_categories')
+    targets['happiness'] = pd.Series(happiness['category'].cat.codes.to_numpy(), index=happiness['HealthCode'].to_numpy())
+    # every answer, newest first - the category is in 'labels'
+    activity = cache.load('physical_activity_categories').drop_duplicates(subset=['HealthCode'])
+    targets['phys_activity'] = pd.Series(activity['labels'].cat.codes.to_numpy(), index=activity['HealthCode'].to_numpy())
+    # ordinal answers with no derived node - the latest raw answer, ranked
+    index = LabelIndex(cache.load('dfalllbls')).subset(raw_ordinal_targets)
+    for label in raw_ordinal_targets:
+        latest = index.latest(label)
+        values = pd.to_numeric(latest['values'], errors='coerce').to_numpy()
+        codes = np.searchsorted(np.unique(values[~np.isnan(values)]), values)
+        targets[label] = pd.Series(np.where(np.isnan(values), -1, codes), index=latest['HealthCode'].to_numpy())
+    # -1 is a missing category
+    return {name: y[y >= 0] for name, y in targets.items()}
+
+
+def load_features(path: str) -> pd.DataFrame:
+    """Participant features (one row per HealthCode, numeric columns) as float32."""
+    df = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+    return df.set_index('HealthCode').select_dtypes('number').astype(np.float32)
+
+
+def align(features: pd.DataFrame, y: pd.Series):
+    """Rows of the participants that have both features and the target (raw features - see standardize)."""
+    y = y[~y.index.duplicated()]
+    codes = features.index.intersection(y.index)
+    return features.loc[codes].to_numpy(dtype=np.float32), y.loc[codes].to_numpy()
+
+
+def standardize(X_train, X_test):
+    """Both splits scaled with the training fold's mean and std, so no held-out statistics leak into the fit.
+
+    Both modes standardize here, per target and fold, so their scores are comparable.
+    """
+    mean, std = X_train.mean(axis=0), X_train.std(axis=0)
+    std = np.where(std > 0, std, 1)
+    return [np.nan_to_num((X - mean) / std).astype(np.float32) for X in (X_train, X_test)]
+
+
+def array_hash(*arrays) -> str:
+    h = hashlib.blake2b(digest_size=12)
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process and of its (joblib) worker processes, in MB."""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def cross_validate(target, model_name, X, y, n_splits=5, seed=0, cache_dir='temp/models') -> pd.DataFrame:
+    """Stratified k-fold scores of one model on one target, one row per fold.
+
+    Fitted models are cached per fold under cache_dir, keyed on the data, the fold and the model
+    spec, so re-running the benchmark only fits what changed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = fold_key(X, y, model_name, n_splits, seed)
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    return pd.DataFrame([fit_fold(target, model_name, fold, X[train], y[train], X[test], y[test],
+                                  os.path.join(cache_dir, f'{target}-{model_name}-{fold}-{key}.joblib'))
+                         for fold, (train, test) in enumerate(folds.split(X, y))])
+
+
+def fold_key(X, y, model_name, n_splits, seed) -> str:
+    return array_hash(X, y, np.array([n_splits, seed]), np.frombuffer(models[model_name][1].encode(), dtype=np.uint8))
+
+
+def fit_fold(target, model_name, fold, X_train, y_train, X_test, y_test, path, n_jobs=None) -> dict:
+    """Fits (or loads the cached) model of one fold and scores it on the held-out rows.
+
+    Timings are untraced wall time. peak_mb is the peak RSS of the process that ran the fit (a joblib
+    worker in multi-target mode) and of its children - a high-water mark since that process started,
+    not the fold's own allocation.
+    """
+    X_train, X_test = standardize(X_train, X_test)
+    tic = time.perf_counter()
+    cached = os.path.exists(path)
+    if cached:
+        model = joblib.load(path)
+    else:
+        model = models[model_name][0]()
+        if n_jobs is not None and hasattr(model, 'n_jobs'):
+            model.n_jobs = n_jobs
+        model.fit(X_train, y_train)
+        joblib.dump(model, path)
+    fit_seconds = time.perf_counter() - tic
+    tic = time.perf_counter()
+    predictions = model.predict(X_test)
+    predict_seconds = time.perf_counter() - tic
+    peak_mb = peak_rss_mb()
+    return {'target': target, 'model': model_name, 'fold': fold, 'cached': cached,
+            'n_train': len(y_train), 'n_test': len(y_test),
+            'accuracy': accuracy_score(y_test, predictions),
+            'mae': mean_absolute_error(y_test, predictions),
+            'qwk': cohen_kappa_score(y_test, predictions, weights='quadratic'),
+            'fit_seconds': fit_seconds, 'predict_seconds': predict_seconds, 'peak_mb': peak_mb}
+
+
+def run_benchmark(features: pd.DataFrame, targets: dict, model_names=tuple(models), n_splits=5, cache_dir='temp/models') -> pd.DataFrame:
+    """Mean fold scores, total runtime and peak memory per (target, model)."""
+    folds = []
+    for target, y in targets.items():
+        X, y = align(features, y)
+        if len(np.unique(y)) < 2:
+            print(f"{target}: fewer than two classes, skipped")
+            continue
+        for model_name in model_names:
+            folds.append(cross_validate(target, model_name, X, y, n_splits=n_splits, cache_dir=cache_dir))
+            print(f"{target} / {model_name}: done, peak RSS so far {peak_rss_mb():.0f} MB")
+    return summarize(pd.concat(folds, ignore_index=True))
+
+
+def summarize(folds: pd.DataFrame) -> pd.DataFrame:
+    """One row per (target, model) from the per-fold rows."""
+    return folds.groupby(['target', 'model'], sort=False).agg(
+        n=('n_test', 'sum'), accuracy=('accuracy', 'mean'), mae=('mae', 'mean'), qwk=('qwk', 'mean'),
+        fit_seconds=('fit_seconds', 'sum'), predict_seconds=('predict_seconds', 'sum'),
+        peak_mb=('peak_mb', 'max'), cached_folds=('cached', 'sum')).reset_index()
+
+
+def shared_feature_matrix(features: pd.DataFrame, path='temp/features.npy'):
+    """Raw float32 features written once as .npy and reopened memory-mapped read-only.
+
+    joblib hands memmaps to worker processes by file name, so every worker reads the same pages;
+    each fold standardizes its own rows (see standardize).
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.save(path, features.to_numpy(dtype=np.float32))
+    return np.load(path, mmap_mode='r')
+
+
+def _fit_target_fold(target, model_name, fold, X, rows, y, train, test, path):
+    # rows are this target's participants in the shared matrix; only the fold's rows are copied
+    return fit_fold(target, model_name, fold, X[rows[train]], y[train], X[rows[test]], y[test], path, n_jobs=1)
+
+
+def train_all_targets(features: pd.DataFrame, targets: dict, model_names=tuple(models), n_splits=5, seed=0,
+                      n_jobs=-1, cache_dir='temp/models', matrix_path='temp/features.npy') -> pd.DataFrame:
+    """Multi-target mode: every (target, model, fold) fit as one joblib batch over a shared feature matrix.
+
+    The matrix is built once for all participants; each task picks its target's fold rows from the memmap
+    and standardizes them on the training fold, exactly as run_benchmark does.
+    Models are fitted single-threaded inside the tasks, the parallelism is across tasks.
+    Returns the tidy per-fold metrics table (see summarize for the per-model view).
+    """
+    X = shared_feature_matrix(features, matrix_path)
+    position = pd.Series(np.arange(len(features)), index=features.index)
+    os.makedirs(cache_dir, exist_ok=True)
+    tasks = []
+    for target, y in targets.items():
+        y = y[~y.index.duplicated()]
+        y = y[y.index.isin(features.index)]
+        rows, y = position.loc[y.index].to_numpy(), y.to_numpy()
+        if len(np.unique(y)) < 2:
+            print(f"{target}: fewer than two classes, skipped")
+            continue
+        folds = list(StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed).split(rows, y))
+        for model_name in model_names:
+            key = array_hash(rows, fold_key(X[rows], y, model_name, n_splits, seed))
+            for fold, (train, test) in enumerate(folds):
+                path = os.path.join(cache_dir, f'{target}-{model_name}-{fold}-{key}-shared.joblib')
+                tasks.append(delayed(_fit_target_fold)(target, model_name, fold, X, rows, y, train, test, path))
+    tic = time.perf_counter()
+    folds = pd.DataFrame(Parallel(n_jobs=n_jobs)(tasks))
+    # the workers are still alive, so RUSAGE_CHILDREN does not count them yet - they report their own peak
+    print(f"{len(tasks)} fold fits for {folds['target'].nunique()} targets in {time.perf_counter() - tic:.1f}s, "
+          f"peak RSS {peak_rss_mb():.0f} MB (parent), {folds['peak_mb'].max():.0f} MB (largest worker)")
+    return folds
+
+
+def synthetic_problem(n=4000, n_features=20, targets=('feel_worthwhile1', 'satisfiedwith_life', 'phys_activity', 'atwork'), seed=0):
+    """Features and ordinal targets cut from noisy linear scores - for running the harness without real data."""
+    rng = np.random.default_rng(seed)
+    codes = np.array([f'hc{i:06d}' for i in range(n)])
+    features = pd.DataFrame(rng.normal(size=(n, n_features)).astype(np.float32), index=codes,
+                            columns=[f'f{i}' for i in range(n_features)])
+    result = {}
+    for target in targets:
+        score = features.to_numpy() @ rng.normal(size=n_features) + rng.logistic(size=n) * 2
+        result[target] = pd.Series(np.digitize(score, np.quantile(score, [0.25, 0.5, 0.75])), index=codes)
+    return features, result
+
+
+if __name__ == "__main__":
+    features_path = os.environ.get('ORDINAL_FEATURES')
+    if features_path:
+        from stage_cache import StageCache
+        features, targets = load_features(features_path), ordinal_targets(StageCache('temp'))
+    else:
+        print("ORDINAL_FEATURES not set - running on a synthetic problem")
+        features, targets = synthetic_problem()
+    if os.environ.get('ORDINAL_MULTI_TARGET'):
+        print(summarize(train_all_targets(features, targets)).to_string(index=False))
+    else:
+        print(run_benchmark(features, targets).to_string(index=False))
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+
+
+def _fit_threshold(base_estimator, X, y, threshold):
+    # Binary target: Is label > current class?
+    clf = clone(base_estimator)
+    clf.fit(X, (y > threshold).astype(int))
+    return clf
+
+
+def _proba_above(clf, X):
+    # a threshold model that saw a single class (0 or 1) predicts it with certainty - predict_proba has one column then
+    if len(clf.classes_) == 1:
+        return np.full(X.shape[0], float(clf.classes_[0]))
+    return clf.predict_proba(X)[:, list(clf.classes_).index(1)]
+
+
+class FrankHallOrdinalClassifier:
+    """Frank & Hall ordinal classifier: K-1 binary "y > class k" models combined into class probabilities.
+
+    The threshold models are independent, so they are fitted (and queried) in parallel with joblib;
+    large X arrays are memory-mapped into the worker processes rather than copied.
+    """
+
+    def __init__(self, base_estimator, n_jobs=-1):
+        self.base_estimator = base_estimator
+        self.n_jobs = n_jobs
+        self.clfs = []
+
+    def fit(self, X, y):
+        y = np.asarray(y)
+        self.unique_class = np.sort(np.unique(y))
+        # Create (K-1) binary classifiers
+        self.clfs = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_threshold)(self.base_estimator, X, y, threshold) for threshold in self.unique_class[:-1])
+        return self
+
+    def predict_proba(self, X):
+        # Collect probabilities from all binary models - threads, predict_proba releases the GIL
+        probs = Parallel(n_jobs=self.n_jobs, prefer='threads')(delayed(_proba_above)(clf, X) for clf in self.clfs)
+        probs = np.column_stack(probs)
+
+        # Convert cumulative probabilities back to individual class probabilities
+        final_probs = np.zeros((X.shape[0], len(self.unique_class)))
+        final_probs[:, 0] = 1 - probs[:, 0] # Prob(Class 1)
+        for i in range(1, len(self.unique_class) - 1):
+            final_probs[:, i] = probs[:, i-1] - probs[:, i] # Prob(Class i)
+        final_probs[:, -1] = probs[:, -1] # Prob(Last Class)
+
+        return final_probs
+
+    def predict(self, X):
+        return self.unique_class[np.argmax(self.predict_proba(X), axis=1)]
+
+
+class OrderedLogit:
+    """statsmodels OrderedModel (ordered logit/probit) behind the same fit/predict_proba/predict interface."""
+
+    def __init__(self, distr='logit', method='bfgs', maxiter=200):
+        self.distr = distr
+        self.method = method
+        self.maxiter = maxiter
+
+    def fit(self, X, y):
+        from statsmodels.miscmodels.ordinal_model import OrderedModel
+        y = np.asarray(y)
+        self.unique_class = np.sort(np.unique(y))
+        endog = pd.Categorical(y, categories=self.unique_class, ordered=True)
+        self.res_ = OrderedModel(endog, np.asarray(X, dtype=float), distr=self.distr).fit(
+            method=self.method, maxiter=self.maxiter, disp=False)
+        return self
+
+    def predict_proba(self, X):
+        return np.asarray(self.res_.model.predict(self.res_.params, exog=np.asarray(X, dtype=float)))
+
+    def predict(self, X):
+        return self.unique_class[np.argmax(self.predict_proba(X), axis=1)]
@@ -5,80 +5,49 @@
 # - work - Employment status
 
 import pandas as pd
-import json
 import altair as alt
 import numpy as np
-compute_flag = [2]#0,1,2
+from label_summary import types, summarize_labels
+from label_loader import load_enrollment_info, load_labels
+from stage_cache import StageCache
+from label_dag import nodes, run_nodes
+import derived_labels  # registers the derived label nodes
+from label_export import export_labels
+compute_flag = [0,1,2] # stages whose inputs have not changed since their last run are skipped
+export_parquet = False # also write last_labels as a Parquet dataset partitioned by label
+
+# typed Parquet intermediates under temp/ - see stage_cache.py
+cache = StageCache('temp')
+source_files = ['source_data/labels_enrollment_info.json', 'source_data/labels_labels.json']
+stage0_tables = ['cat', 'val', 'dfalllbls', *nodes]
+stage1_tables = ['merged_categorical_labels', 'merged_numeric_labels']
+stage_keys = {}
+
+def stale(stage, files=(), tables=()):
+    # the stage script is an input of every stage
+    stage_keys[stage] = cache.key(files=['recompute_labels.py', *files], tables=tables)
+    if cache.fresh(stage, stage_keys[stage]):
+        print(f'{stage}: inputs unchanged, skipped')
+        return False
+    return True
 
 if 0 in compute_flag:
-    types = {
-        'sleep_diagnosis1': 'boolean',
-        'atwork': 'ordinal',
-        'phys_activity': 'ordinal',
-        'sleep_time': 'float',
-        'sleep_time1': 'float',
-        'vigorous_act': 'ordinal',
-        'work': 'boolean',
-        'sleep_diagnosis2': 'categorical',
-        'happiness': 'float',
-        'heart_disease': 'categorical',
-        'vascular': 'categorical',
-        'feel_worthwhile1': 'ordinal',
-        'feel_worthwhile2': 'ordinal',
-        'feel_worthwhile3': 'ordinal',
-        'feel_worthwhile4': 'ordinal',
-        'satisfiedwith_life': 'ordinal',
-        'BiologicalSex': 'boolean',
-        'WakeUpTime': 'float',
-        'GoSleepTime': 'float',
-        'HeightCentimeters': 'float',
-        'WeightKilograms': 'float',
-        'Diabetes': 'boolean',
-        'Hypertension': 'boolean',
-        'Hdl': 'float',
-        'Ldl': 'float',
-        'TotalCholesterol': 'float',
-        'DiastolicBloodPressure': 'float',
-        'SystolicBloodPressure': 'float'
-    }
-
-    reload_flag = True
-    if reload_flag:
-        # Read JSON string from a file
-        with open('source_data/labels_enrollment_info.json', 'r') as f:
-            df = pd.DataFrame(json.loads(f.read())).T
-
-        with open('source_data/labels_labels.json', 'r') as f:
-            dflbls,auxlbls_val,auxlbls_cat = pd.DataFrame(),pd.DataFrame(),pd.DataFrame()
-            aux = json.loads(f.read())
-            for k,v in aux.items():
-                df2 = pd.DataFrame(v).T.explode(column=['timestamps','values'])
-                df2 = df2.reset_index().rename(columns={'index':'HealthCode'})
-                df2['labels'] = k
-                dflbls = pd.concat([dflbls, df2], ignore_index=True)
-                # summary
-                if types[k] == 'boolean' or types[k] == 'categorical':
-                    aux2 = df2.groupby(['HealthCode','values']).aggregate({'timestamps':['count','min','max']} ).reset_index()   
-                    aux2.columns = [c.strip('_') for c in aux2.columns.map('_'.join)]
-                    aux2['labels'] = k
-                    auxlbls_cat = pd.concat([auxlbls_cat, aux2], ignore_index=True)
-                elif types[k] == 'float' or types[k] == 'ordinal':
-                    df2['values'] = pd.to_numeric(df2['values'], errors='coerce')
-                    # add 25% and 75% quantiles
-                    aux2 = df2.groupby('HealthCode').aggregate({'timestamps':['count','min','max'],
-                                            'values':['mean','median','max','min',lambda x: x.quantile(0.25),lambda x: x.quantile(0.75)]}).reset_index()
-                    aux2.columns = [c.strip('_') for c in aux2.columns.map('_'.join)]
-                
-                    aux2['labels'] = k
-                    auxlbls_val = pd.concat([auxlbls_val, aux2], ignore_index=True)
-
-        auxlbls_cat.to_csv('temp/cat.csv',index=False)
-        auxlbls_val.to_csv('temp/val.csv',index=False)
-        dflbls.to_csv('temp/dfalllbls.csv',index=False)
+    labels_key = cache.key(files=source_files + ['label_loader.py', 'label_summary.py'])
+    if not cache.fresh('labels', labels_key):
+        # streamed - neither file is held in memory as text or as a nested dict
+        df = load_enrollment_info('source_data/labels_enrollment_info.json')
+        dflbls = load_labels('source_data/labels_labels.json')
+        # summary - includes 25% and 75% quantiles
+        auxlbls_cat, auxlbls_val = summarize_labels(dflbls, types)
+
+        cache.save('cat', auxlbls_cat)
+        cache.save('val', auxlbls_val)
+        cache.save('dfalllbls', dflbls)
+        cache.done('labels', labels_key, tables=['cat', 'val', 'dfalllbls'])
     else: 
-        auxlbls_cat = pd.read_csv('temp/cat.csv')
-        auxlbls_val = pd.read_csv('temp/val.csv')
-        dflbls = pd.read_csv('temp/dfalllbls.csv')
+        auxlbls_cat = cache.load('cat')
+        auxlbls_val = cache.load('val')
+        dflbls = cache.load('dfalllbls')
         
     # Analyse values first
 
@@ -134,163 +103,6 @@ if 0 in compute_flag:
     # sleep_time1                    1.269803    1.0   56
     # vigorous_act                   1.267454    1.0   56
 
-    # now get the labels one by one
-    # get the numeric values first - 
-    auxlbls_val.query('labels in ("Hdl","Ldl","TotalCholesterol","WeightKilograms","sleep_time","vigorous_act")').loc[:,['HealthCode','labels','values_mean', 'values_median', 'values_max', 'values_min']].to_csv('temp/numeric_values.csv',index=False)
-
-    # blood pressure categories
-    dia = dflbls.query('labels == "DiastolicBloodPressure"').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).loc[:,['HealthCode','values']]
-    dia['values'] = dia['values'].astype(float)
-
-    sys = dflbls.query('labels == "SystolicBloodPressure"').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).loc[:,['HealthCode','values']]
-    sys['values'] = sys['values'].astype(float)
-
-    sys_dia = pd.merge(sys, dia, on='HealthCode', suffixes=('_systolic', '_diastolic'))
-    # identify the flips
-    idx = sys_dia['values_diastolic'] > sys_dia['values_systolic']
-    sys_temp = sys_dia.loc[idx,'values_systolic'].copy()
-    dia_temp = sys_dia.loc[idx,'values_diastolic'].copy()
-    sys_dia.loc[idx,'values_systolic'] = dia_temp
-    sys_dia.loc[idx,'values_diastolic'] = sys_temp
-    del sys_temp, dia_temp
-    # now get into categories
-    def categorize_bp(row):
-        systolic = row['values_systolic']
-        diastolic = row['values_diastolic']
-        if systolic < 120 and diastolic < 80:
-            return "Normal"
-        elif 120 <= systolic < 130 and diastolic < 80:
-            return "Elevated"
-        elif (130 <= systolic < 140) or (80 <= diastolic < 90):
-            return "Hypertension_Stage_1"
-        elif (140 <= systolic) or (90 <= diastolic):
-            return "Hypertension_Stage_2"
-        elif systolic > 180 or diastolic > 120:
-            return "Hypertensive_Crisis"
-        else:
-            return "Uncategorized"
-    sys_dia['category'] = sys_dia.apply(categorize_bp, axis=1)
-    sys_dia.loc[:,['HealthCode','values_systolic']].to_csv('temp/blood_pressure_values.csv',index=False)
-    sys_dia.to_csv('temp/blood_pressure_categories.csv',index=False)
-
-    # BMI 
-    height = dflbls.query('labels == "HeightCentimeters"').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).loc[:,['HealthCode','values']]
-    height['values'] = height['values'].astype(float) / 100  # convert to meters    
-    weight = dflbls.query('labels == "WeightKilograms"').groupby('HealthCode')['values'].max().reset_index()
-    weight['values'] = weight['values'].astype(float)
-    bmi = pd.merge(weight, height, on='HealthCode', suffixes=('_weight', '_height'))
-    bmi['BMI_values'] = bmi['values_weight'] / (bmi['values_height'] ** 2)
-    bmi['category'] = pd.cut(bmi['BMI_values'], 
-                            bins=[0, 19.9, 24.9, 29.9, 39.9, np.inf], 
-                            labels=['Underweight', 'Normal weight', 'Overweight', 'Obesity','Morbid Obesity'])
-    bmi = bmi.query('values_height>=1.4 and values_height <=2.1 and values_weight >=40')
-    bmi.to_csv('temp/bmi_categories.csv',index=False)
-
-    # sleep_time
-    sleep_time = dflbls.query('labels == "sleep_time"').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).loc[:,['HealthCode','values']]
-    sleep_time['values'] = sleep_time['values'].astype(float)
-    sleep_time['category'] = pd.cut(sleep_time['values'], 
-                                        bins=[0, 6, 7, 9, np.inf], 
-                                        labels=['Insufficient', 'Short', 'Normal', 'Too Long'])
-    sleep_time.query('values<=12').to_csv('temp/sleep_time_categories.csv',index=False)
-
-    # WakeUpTime - these might be all wrong
-    wake_time = dflbls.query('labels == "WakeUpTime"').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).loc[:,['HealthCode','values']]
-    wake_time['local_time'] = pd.to_datetime(wake_time['values']).dt.tz_localize(None)
-    wake_time['hour'] = pd.to_datetime(wake_time['local_time']).dt.hour + (wake_time['local_time'].dt.minute / 60)
-    wake_time['category'] = pd.cut(wake_time['hour'], 
-                                            bins=[0, 5, 7, 9, 24], 
-                                            labels=['Early Riser', 'Normal Riser', 'Late Riser', 'Very Late Riser'])
-    wake_time.to_csv('temp/wake_time_categories.csv',index=False)
-
-    # GoSleepTime
-    go_sleep_time = dflbls.query('labels == "GoSleepTime"').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).loc[:,['HealthCode','values']]
-    go_sleep_time['local_time'] = pd.to_datetime(go_sleep_time['values']).dt.tz_localize(None)
-    go_sleep_time['hour'] = pd.to_datetime(go_sleep_time['local_time']).dt.hour+ (go_sleep_time['local_time'].dt.minute / 60)
-    go_sleep_time['category'] = pd.cut(go_sleep_time['hour'], 
-                                                    bins=[0, 1, 7,19,21, 23, 24], ordered=False,
-                                                    labels=['Late Sleeper','Very Late Sleeper','Shift Worker','Early Sleeper', 'Normal Sleeper', 'Late Sleeper'])
-    go_sleep_time.to_csv('temp/go_sleep_time_categories.csv',index=False)
-
-    # psychological factors
-    #                       count      mean       std  min  25%  50%  75%   max
-    # labels                                                                   
-    # feel_worthwhile1    62188.0  7.488197  2.038789  0.0  7.0  8.0  9.0  10.0
-    # feel_worthwhile2    62207.0  7.209880  2.076224  0.0  6.0  8.0  9.0  10.0
-    # feel_worthwhile3    62171.0  4.292628  2.788223  0.0  2.0  4.0  7.0  10.0
-    # feel_worthwhile4    61888.0  2.433412  2.644067  0.0  0.0  1.0  4.0  10.0
-    # satisfiedwith_life  62261.0  7.270796  1.988985  0.0  6.0  8.0  9.0  10.0
-
-    cuts = {'feel_worthwhile1':[0,4,6,8,10.1],
-            'feel_worthwhile2':[0,4,6,8,10.1],
-            'feel_worthwhile3':[0,4,6,8,10.1],
-            'feel_worthwhile4':[0,1,3,5,10.1],
-            'satisfiedwith_life':[0,4,6,8,10.1]}
-    dfpsych_all = pd.DataFrame()
-    for var,cut in cuts.items():
-        dfpsych = dflbls.query('labels == @var').sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).copy()
-        dfpsych['values'] = pd.to_numeric(dfpsych['values'], errors='coerce')
-        # dfcut with the above thresholds
-        dfpsych['category'] = pd.cut(dfpsych['values'], bins=cut, labels=['Low','Medium','High','Very High'])
-        dfpsych_all = pd.concat([dfpsych_all, dfpsych], ignore_index=True)
-    dfpsych_all.to_csv('temp/psychological_factors_categories.csv',index=False)
-
-    # happiness                  7.221016       7.288013    7.961086    6.181360           6.942890           7.564917
-    dfhappiness = dflbls.query('labels == "happiness"').copy()
-    dfhappiness['values'] = pd.to_numeric(dfhappiness['values'], errors='coerce')
-    # longitudinal happiness
-    idx = dfhappiness.groupby('HealthCode')['values'].count()
-    idx = idx[idx>=3].index
-    dfhappiness_long = dfhappiness[dfhappiness['HealthCode'].isin(idx)].copy()
-    # plot it - sample 20 participants
-    sample_ids = dfhappiness_long['HealthCode'].sample(n=10, random_state=42).values
-    dfhappiness_long2 = dfhappiness_long[dfhappiness_long['HealthCode'].isin(sample_ids)].copy() 
-    alt.Chart(dfhappiness_long2).mark_circle().encode(
-        x='timestamps:T',
-        y='values:Q',
-        color='HealthCode:N',
-        tooltip=['HealthCode:N','timestamps:T','values:Q']
-    ).properties(
-        title='Longitudinal Happiness Scores'
-    ).save('figures/happiness_longitudinal.html')
-    dfhappiness_long.to_csv('temp/happiness_longitudinal.csv',index=False)
-
-    # happiness static values - categories
-    dfhappiness_static = dfhappiness.sort_values(by='timestamps',ascending=False).drop_duplicates(subset=['HealthCode']).copy()
-    dfhappiness_static['values'] = pd.to_numeric(dfhappiness_static['values'], errors='coerce')
-    dfhappiness_static['category'] = pd.cut(dfhappiness_static['values'], 
-                                            bins=[0, 4, 6, 8, 10], 
-                                            labels=['Low','Medium','High','Very High'])
-    dfhappiness_static.to_csv('temp/happiness_static_categories.csv',index=False)
-
-    # phys_activity              3.026438       3.025707    3.096056    2.956731           2.993261           3.059779
-    # vigorous_act             73.407834      72.915853   78.833447   69.044003          70.965898          75.419630
-    dfactivity = dflbls.query('labels in ["phys_activity"]').sort_values(by='timestamps',ascending=False).copy()
-    dfactivity['values'] = pd.to_numeric(dfactivity['values'], errors='coerce')
-    dfvig = dflbls.query('labels in ["vigorous_act"]').sort_values(by='timestamps',ascending=False).copy()
-    dfvig['values'] = pd.to_numeric(dfvig['values'], errors='coerce')
-    # merge
-    # dfact = pd.merge(dfactivity.loc[:,['HealthCode','values']], 
-    #                  dfvig.loc[:,['HealthCode','values']],
-    #                    on=['HealthCode'], suffixes=('_phys','_vig'))
-    dfvig['labels'] = pd.cut(dfvig['values'], 
-                                    bins=[-1, 150, 300, 420, np.inf], 
-                                    labels=['Below recommendation','Good','High volume','Athlete training'])
-    dfactivity['labels'] = pd.cut(dfactivity['values'], 
-                                    bins=[-1, 2, 4.1, np.inf], 
-                                    labels=['Infrequent','Moderate','Frequent'])
-
-    # sample_ids = dfact['HealthCode'].sample(n=100, random_state=42).values
-    # dfact2 = dfact[dfact['HealthCode'].isin(sample_ids)].copy() 
-
-    # alt.Chart(dfact2).mark_circle().encode(x='values_vig:Q',
-    #                                     y='values_phys:N',
-    #                                     detail='HealthCode:N',
-    #                                     tooltip=['HealthCode:N','vig_category:N','phys_category:N']).save('figures/physical_activity_scatter.html')
-    # dfact.to_csv('temp/physical_activity_categories.csv',index=False)
-    dfvig.to_csv('temp/vigorous_categories.csv',index=False)
-    dfactivity.to_csv('temp/physical_activity_categories.csv',index=False)
-
     auxlbls_cat.groupby('labels').aggregate({'timestamps_count':'sum',
                                             'HealthCode':'nunique'}).sort_values('HealthCode',ascending=False)
     #                   timestamps_count  HealthCode
@@ -333,116 +145,26 @@ if 0 in compute_flag:
     # Ldl                                15356         6845
     # happiness                          41839         4163
 
-    # plot distribution of one of the labels
-    auxlbls_cat = pd.read_csv('temp/cat.csv')
-    # auxlbls_cat = auxlbls_cat.melt(id_vars=['HealthCode','labels',
-    #                                         'values','timestamps_count'], 
-    #                                         value_vars=['timestamps_min', 'timestamps_max'], 
-    #                                         var_name='timestamp', value_name='timestamp_values')
-
-
-    heart_disease_map = {
-        "1": "Heart Attack/Myocardial Infarction",
-        "2": "Heart Bypass Surgery",
-        "3": "Coronary Blockage/Stenosis",
-        "4": "Coronary Stent/Angioplasty",
-        "5": "Angina (heart chest pains)",
-        "6": "High Coronary Calcium Score",
-        "7": "Heart Failure or CHF",
-        "8": "Atrial fibrillation (Afib)",
-        "9": "Congenital Heart",
-        "10": "None of the above",
-        "11": "Pulmonary Hypertension"
-    }
-
-    vascular_map = {
-        "1": "Stroke",
-        "2": "Transient Ischemic Attack (TIA)",
-        "3": "Carotid Artery Blockage/Stenosis",
-        "4": "Carotid Artery Surgery or Stent",
-        "5": "Peripheral Vascular Disease (Blockage/Stenosis, Surgery, or Stent)",
-        "6": "Abdominal Aortic Aneurysm",
-        "7": "None of the above",
-        "8": "Pulmonary Arterial Hypertension"
-    }
-
-    # map vascular diseases
-    def map_diseases(labels,mapping):
-        a = auxlbls_cat.query(f'labels=="{labels}"')
-        a['values'] = a['values'].astype(float).astype(int).astype(str)
-        a['values'] = a['values'].map(mapping)
-        auxlbls_cat.loc[a.index,'values'] = a['values']
-        return auxlbls_cat
-    auxlbls_cat = map_diseases('vascular',vascular_map)
-    auxlbls_cat = map_diseases('heart_disease',heart_disease_map)
-
-    cerebrovascular = [
-        "Stroke",
-        "Transient Ischemic Attack (TIA)",
-        "Carotid Artery Blockage/Stenosis",
-        "Carotid Artery Surgery or Stent"
-    ]
-
-    peripheral_systemic = [
-        "Abdominal Aortic Aneurysm",
-        "Peripheral Vascular Disease (Blockage/Stenosis, Surgery, or Stent)"
-    ]
-
-    pulmonary = [
-        "Pulmonary Arterial Hypertension",
-        "Pulmonary Hypertension"
-    ]
-
-    CAD_cols = ['Angina (heart chest pains)', 
-                'Coronary Blockage/Stenosis',
-                'Coronary Stent/Angioplasty', 
-                'Heart Attack/Myocardial Infarction',
-                'Heart Bypass Surgery',
-                'High Coronary Calcium Score']
-
-    def map_systems(systems, system_name):
-        idx = auxlbls_cat['values'].isin(systems)
-        auxlbls_cat.loc[idx,'values'] = system_name
-        return auxlbls_cat
-
-    auxlbls_cat = map_systems(cerebrovascular, 'Cerebrovascular Disease')
-    auxlbls_cat = map_systems(peripheral_systemic, 'Peripheral/Systemic Vascular Disease')
-    auxlbls_cat = map_systems(pulmonary, 'PH')
-    auxlbls_cat = map_systems(CAD_cols, 'CAD')
-    # unify labels
-    auxlbls_cat.loc[auxlbls_cat['labels'].isin(['vascular','heart_disease']),'labels'] = 'cardiovascular_disease'
-    auxlbls_cat.query('labels!="sleep_diagnosis2"').to_csv('temp/cat_final.csv',index=False)
-
-    # plot the distributions
-    for labels in auxlbls_cat['labels'].unique():
-        aux = auxlbls_cat[auxlbls_cat['labels']==labels]
-        aux['timestamps_count'] = aux['timestamps_count'].astype(int)
-        aux['timestamps_count_bins'] = pd.cut(aux['timestamps_count'],bins=[0,1,2,5,10,np.inf], labels=['1','2','3-5','6-10','10+'])
-        chart = alt.Chart(aux).mark_bar().encode(
-            x=alt.X('timestamps_count_bins:O').sort(['1','2','3-5','6-10','10+']),
-            y='count()',
-            color='values:N',
-            tooltip=['timestamps_count_bins','values:N','count()']
-        ).properties(
-            title=f'Distribution of {labels}'
-        ).facet(column='values:N').save(f'figures/{labels}_distribution.html')
+    # derived labels - one node per table, see derived_labels.py. Nodes whose source labels
+    # and code are unchanged since their last run are skipped, the others run in parallel
+    run_nodes(dflbls, cache)
 
 
 # merge labels
-if 1 in compute_flag:
-    files = ['sleep_time_categories.csv', 
-    'blood_pressure_categories.csv',
-        'wake_time_categories.csv', 
-            'go_sleep_time_categories.csv', 
-            'bmi_categories.csv',
-            'happiness_static_categories.csv']
+if 1 in compute_flag and stale('stage1', tables=stage0_tables):
+    files = ['sleep_time_categories', 
+    'blood_pressure_categories',
+        'wake_time_categories', 
+            'go_sleep_time_categories', 
+            'bmi_categories',
+            'happiness_static_categories']
 
     # merge all labels - categories
     df_final = pd.DataFrame()
     for file in files:
         print(file)
-        df = pd.read_csv('temp/'+file).loc[:,['HealthCode','category']]
-        df['label_type'] = file.replace('_categories.csv','')
+        df = cache.load(file).loc[:,['HealthCode','category']]
+        df['label_type'] = file.replace('_categories','')
         df_final = pd.concat([df_final, df], axis=0, ignore_index=True)
 
     labelmappings = {'bmi':'BMI_categories',
@@ -459,13 +181,13 @@ if 1 in compute_flag:
     # df = pd.read_csv(f'temp/{file}').loc[:,['HealthCode','phys_category','vig_category']]
     # df['label_type'] = file.replace('_categories.csv','')
     # df_final = pd.concat([df_final, df], axis=0, ignore_index=True)
-    file = 'psychological_factors_categories.csv'
-    df = pd.read_csv(f'temp/{file}').loc[:,['HealthCode','category','labels']].rename(columns={'labels':'label_type'})
+    file = 'psychological_factors_categories'
+    df = cache.load(file).loc[:,['HealthCode','category','labels']].rename(columns={'labels':'label_type'})
     df_final = pd.concat([df_final, df], axis=0, ignore_index=True)
 
-    df = pd.read_csv('temp/cat_final.csv').rename(columns={'labels':'label_type','values':'category'}).loc[:,['HealthCode','category','label_type']]
+    df = cache.load('cat_final').rename(columns={'labels':'label_type','values':'category'}).loc[:,['HealthCode','category','label_type']]
     df_final = pd.concat([df_final, df], axis=0, ignore_index=True)
-    df_final.to_csv('temp/merged_categorical_labels.csv', index=False)
+    cache.save('merged_categorical_labels', df_final)
     aux = df_final.groupby(['label_type','category'])['HealthCode'].nunique().reset_index()
     auxt = aux.groupby(['label_type'])['HealthCode'].sum()
     aux = aux.merge(auxt,on='label_type',suffixes=('','_total'), how='left',)
@@ -474,12 +196,12 @@ if 1 in compute_flag:
     aux.to_csv('temp/label_counts.csv',index=False)
 
     # handle numeric labels
-    files = ['numeric_values.csv', 
-            'bmi_categories.csv',
-            'blood_pressure_values.csv']
-    df = pd.read_csv('temp/'+files[0])
-    df2 = pd.read_csv('temp/'+files[1])
-    df3 = pd.read_csv('temp/'+files[2])
+    files = ['numeric_values', 
+            'bmi_categories',
+            'blood_pressure_values']
+    df = cache.load(files[0])
+    df2 = cache.load(files[1])
+    df3 = cache.load(files[2])
     df2.rename(columns={'BMI':'values'}, inplace=True)
     df2['labels'] = 'BMI_values'
     df2.rename(columns={'BMI_values':'values'},inplace=True)
@@ -489,22 +211,22 @@ if 1 in compute_flag:
     df_final = pd.concat([df.loc[:,['HealthCode','values','labels']],
                         df2.loc[:,['HealthCode','values','labels']],
                         df3.loc[:,['HealthCode','values','labels']]], axis=0, ignore_index=True)
-    df_final.to_csv('temp/merged_numeric_labels.csv', index=False)
+    cache.save('merged_numeric_labels', df_final)
+    cache.done('stage1', stage_keys['stage1'], tables=stage1_tables, files=['temp/label_counts.csv'])
 
 
     # df_final.groupby(['labels']).agg({'HealthCode':'nunique',
     #                                 'values':['mean','median','std','min','max']}).to_csv('temp/value_counts.csv',index=True)
 
 
-if 2 in compute_flag:
-    import json
+if 2 in compute_flag and stale('stage2', tables=stage1_tables + ['happiness_longitudinal']):
 
-    # numeric labels - 'temp/merged_numeric_labels.csv'
-    dfn = pd.read_csv('temp/merged_numeric_labels.csv')
+    # numeric labels - merged_numeric_labels
+    dfn = cache.load('merged_numeric_labels')
     dfn.groupby('labels')['values'].agg(['nunique','mean','median','std','min','max']).to_csv('temp/value_counts.csv',index=True)
 
-    # categorical labels - 'temp/merged_categorical_labels.csv'
-    dfc = pd.read_csv('temp/merged_categorical_labels.csv')
+    # categorical labels - merged_categorical_labels
+    dfc = cache.load('merged_categorical_labels')
     dfc.rename(columns={'category':'values','label_type':'labels'},inplace=True)
             
         # compute the CVD categories - and disabiguation
@@ -532,35 +254,18 @@ if 2 in compute_flag:
     cat_summ['percentage'] = cat_summ['n_participants'] / cat_tot 
     cat_summ.to_csv('temp/cat_summary.csv',index=False)
     
-    # longitudinal labels - 'temp/longitudinal_labels.csv'
-    dfl = pd.read_csv('temp/happiness_longitudinal.csv')
+    # longitudinal labels - happiness_longitudinal
+    dfl = cache.load('happiness_longitudinal')
 
     df = pd.concat([dfn, dfc,dfl], axis=0, ignore_index=True)
     df['timestamps'] = df['timestamps'].fillna('')
 
-    grouped = df.groupby(['labels', 'HealthCode']).agg({
-        'values': list,
-        'timestamps': list
-    })
-
-    # 3. Transform to nested dictionary structure
-    final_dict = {}
-
-    # Iterate through the multi-index groups
-    for (label, health_code), row in grouped.iterrows():
-        if label not in final_dict:
-            final_dict[label] = {}
-        
-        final_dict[label][health_code] = {
-            "timestamps": row['timestamps'],
-            "values": row['values']
-        }
-
-    # 4. Save to local file
+    # nested label -> HealthCode -> {timestamps, values}, written from the sorted columns (label_export.py)
     file_name = "source_data/last_labels.json"
-    with open(file_name, "w") as f:
-        json.dump(final_dict, f, indent=2)
+    parquet_name = 'source_data/last_labels' if export_parquet else None
+    export_labels(df, file_name, parquet_name)
 
     print(f"Saved to {file_name}")
+    cache.done('stage2', stage_keys['stage2'], files=[file_name, 'temp/value_counts.csv', 'temp/cat_summary.csv'] + ([parquet_name] if parquet_name else []))
 
 
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Object columns mixing types (e.g. label values that are numbers for some labels and strings
+    for others) are stored as strings, which is what they came back as from the old CSVs."""
+    mixed = {}
+    for c in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[c], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            mixed[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df.assign(**mixed) if mixed else df
+
+
+class StageCache:
+    """Typed Parquet store for the intermediates passed between the recompute_labels.py stages.
+
+    Tables keep their dtypes (categoricals, timestamps, floats) and are memory-mapped when read.
+    manifest.json records the content hash of every table and, for every stage, a key hashed from
+    its inputs, so a stage whose inputs have not changed since its last run can be skipped.
+    """
+
+    def __init__(self, folder: str = 'temp'):
+        self.folder = folder
+        self.manifest_path = os.path.join(folder, 'manifest.json')
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'files': {}, 'tables': {}, 'stages': {}}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, f'{name}.parquet')
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def file_hash(self, path: str) -> str:
+        """Content hash of a file, only re-read when its size or mtime changed."""
+        stat = os.stat(path)
+        known = self.manifest['files'].get(path)
+        if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = file_hash(path)
+        self.manifest['files'][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._save_manifest()
+        return digest
+
+    def key(self, files=(), tables=(), values=None) -> str:
+        """Hashes a stage's inputs: source files by content, cached tables by their stored hash, plus any JSON-able values."""
+        h = hashlib.blake2b(digest_size=16)
+        for path in files:
+            h.update(f'file:{path}:{self.file_hash(path)}'.encode())
+        for name in tables:
+            # a table missing from the manifest (fresh or partial cache) hashes as None, so the stage is stale
+            h.update(f'table:{name}:{self.manifest["tables"].get(name)}'.encode())
+        h.update(json.dumps(values, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def save(self, name: str, df: pd.DataFrame):
+        path = self.path(name)
+        table = pa.Table.from_pandas(arrow_safe(df), preserve_index=False)
+        pq.write_table(table, path + '.tmp', compression='zstd')
+        os.replace(path + '.tmp', path)
+        self.manifest['tables'][name] = file_hash(path)
+        self._save_manifest()
+
+    def load(self, name: str) -> pd.DataFrame:
+        return pq.read_table(self.path(name), memory_map=True).to_pandas()
+
+    def fresh(self, stage: str, key: str) -> bool:
+        """True if the stage last ran with this key and everything it produced is still there."""
+        done = self.manifest['stages'].get(stage)
+        if not done or done['key'] != key:
+            return False
+        return (all(name in self.manifest['tables'] and os.path.exists(self.path(name)) for name in done['tables'])
+                and all(os.path.exists(path) for path in done['files']))
+
+    def done(self, stage: str, key: str, tables=(), files=()):
+        """Records that the stage ran with this key and produced these tables and files."""
+        self.manifest['stages'][stage] = {'key': key, 'tables': list(tables), 'files': list(files)}
+        self._save_manifest()
@@ -1,42 +1,17 @@
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.base import clone
+from ordinal_models import FrankHallOrdinalClassifier
 
-class FrankHallOrdinalClassifier:
-    def __init__(self, base_estimator):
-        self.base_estimator = base_estimator
-        self.clfs = []
-
-    def fit(self, X, y):
-        self.unique_class = np.sort(np.unique(y))
-        self.clfs = []
-        # Create (K-1) binary classifiers
-        for i in range(len(self.unique_class) - 1):
-            # Binary target: Is label > current class?
-            binary_y = (y > self.unique_class[i]).astype(int)
-            clf = clone(self.base_estimator)
-            clf.fit(X, binary_y)
-            self.clfs.append(clf)
-        return self
-
-    def predict_proba(self, X):
-        # Collect probabilities from all binary models
-        probs = [clf.predict_proba(X)[:, 1] for clf in self.clfs]
-        probs = np.column_stack(probs)
-        
-        # Convert cumulative probabilities back to individual class probabilities
-        final_probs = np.zeros((X.shape[0], len(self.unique_class)))
-        final_probs[:, 0] = 1 - probs[:, 0] # Prob(Class 1)
-        for i in range(1, len(self.unique_class) - 1):
-            final_probs[:, i] = probs[:, i-1] - probs[:, i] # Prob(Class i)
-        final_probs[:, -1] = probs[:, -1] # Prob(Last Class)
-        
-        return final_probs
-
-    def predict(self, X):
-        return self.unique_class[np.argmax(self.predict_proba(X), axis=1)]
+# FrankHallOrdinalClassifier lives in ordinal_models.py (threshold models fitted in parallel);
+# ordinal_benchmark.py cross-validates it against OrderedModel on the recomputed labels.
 
 # Usage:
-model = FrankHallOrdinalClassifier(RandomForestClassifier())
-model.fit(X_train, y_train)
-predictions = model.predict(X_test)
+if __name__ == "__main__":
+    from ordinal_benchmark import synthetic_problem
+    features, targets = synthetic_problem(n=1000, targets=('satisfiedwith_life',))
+    X, y = features.to_numpy(), targets['satisfiedwith_life'].to_numpy()
+    X_train, X_test, y_train, y_test = X[:800], X[800:], y[:800], y[800:]
+    model = FrankHallOrdinalClassifier(RandomForestClassifier())
+    model.fit(X_train, y_train)
+    predictions = model.predict(X_test)
+    print(f"accuracy: {np.mean(predictions == y_test):.3f}")
@@ -0,0 +1,230 @@
+# Streams BigQuery query results into partitioned Parquet as Arrow record batches.
+# Rows come through the BigQuery Storage Read API and are written batch by batch, so peak memory is a
+# few batches rather than the whole result (read_gbq builds the full DataFrame before to_parquet).
+# Run: python bq_export.py  - benchmark against an in-process fake client, no credentials needed.
+
+import os
+import resource
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+project_id = "imperial-410612"
+activity_table = f"`{project_id}.MHC_PH.activity_us2`"
+watch_variables = ('StepCount', 'FlightsClimbedPaceMax', 'StepCountPaceMax', 'FlightsClimbedPaceMean',
+                   'StepCountPaceMean', 'RestingHeartRate', 'HeartRateVariabilitySDNN')
+phone_variables = ('StepCount', 'FlightsClimbedPaceMax', 'StepCountPaceMax', 'FlightsClimbedPaceMean',
+                   'StepCountPaceMean')
+
+
+def activity_query(device_rank: str, variables, cohort='UK', min_span_days=1000) -> str:
+    """Clean UK rows of one device for PAH patients and Healthy patients followed for more than min_span_days."""
+    variables = ','.join(f"'{v}'" for v in variables)
+    where = f"""clean_status = 'clean_1'
+and device_rank = '{device_rank}'
+and cohort = '{cohort}' and variable in ({variables})"""
+    return f"""select patient,`Group`,diagnosis_date,startTime startDate,variable,value  from {activity_table}
+where
+(patient in
+(select patient
+from {activity_table}
+where {where}
+and `Group` in ('Healthy')
+group by patient,`Group`,diagnosis_date
+having date_diff(max(startTime), min(startTime), DAY) >{min_span_days})
+or `Group` = 'PAH')
+and
+{where}"""
+
+
+def dictionary_encode(batch: pa.RecordBatch, keep=()) -> pa.RecordBatch:
+    """String columns as dictionary<int32, string> (patient, Group and variable repeat on every row)."""
+    columns = [c.dictionary_encode() if pa.types.is_string(c.type) and name not in keep else c
+               for name, c in zip(batch.schema.names, batch.columns)]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def iter_query_batches(client, query: str, bqstorage_client=None, max_queue_size=2):
+    """Record batches of a query result. With a BigQuery Storage client the read streams are downloaded
+    in parallel and at most max_queue_size pages wait in memory."""
+    rows = client.query(query).result()
+    return rows.to_arrow_iterable(bqstorage_client=bqstorage_client, max_queue_size=max_queue_size)
+
+
+class PartitionedParquetWriter:
+    """Hive-partitioned zstd Parquet dataset (path/variable=StepCount/part-0.parquet) written batch by batch.
+
+    Rows are buffered per partition and flushed as one row group every row_group_rows, so memory
+    is bounded by row_group_rows per open partition. (pyarrow.dataset.write_dataset queues the whole
+    input when it comes from a Python iterator faster than the files are written.)
+    """
+
+    def __init__(self, path: str, schema: pa.Schema, partition_cols=('variable',), row_group_rows=128 * 1024):
+        self.path = path
+        self.partition_cols = list(partition_cols)
+        self.schema = pa.schema([f for f in schema if f.name not in self.partition_cols])
+        self.row_group_rows = row_group_rows
+        self.buffers, self.writers = {}, {}
+        self.rows = 0
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def write_batch(self, batch: pa.RecordBatch):
+        self.rows += batch.num_rows
+        if not self.partition_cols:
+            return self._append((), batch)
+        keys = [pc.fill_null(batch.column(c).cast(pa.string()), '__HIVE_DEFAULT_PARTITION__').dictionary_encode()
+                for c in self.partition_cols]
+        codes = np.stack([k.indices.to_numpy() for k in keys], axis=1)
+        unique, inverse = np.unique(codes, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        batch = batch.take(pa.array(order)).select(self.schema.names)
+        for i, code in enumerate(unique):
+            value = tuple(keys[j].dictionary[code[j]].as_py() for j in range(len(keys)))
+            self._append(value, batch.slice(bounds[i], bounds[i + 1] - bounds[i]))
+
+    def _append(self, value, batch):
+        buffer = self.buffers.setdefault(value, [])
+        buffer.append(batch)
+        if sum(b.num_rows for b in buffer) >= self.row_group_rows:
+            self._flush(value)
+
+    def _flush(self, value):
+        buffer = self.buffers.pop(value, [])
+        if not buffer:
+            return
+        if value not in self.writers:
+            folder = os.path.join(self.path, *(f'{c}={quote(v, safe="")}' for c, v in zip(self.partition_cols, value)))
+            os.makedirs(folder, exist_ok=True)
+            self.writers[value] = pq.ParquetWriter(os.path.join(folder, 'part-0.parquet'), self.schema, compression='zstd')
+        self.writers[value].write_table(pa.Table.from_batches(buffer, self.schema))
+
+    def close(self):
+        for value in list(self.buffers):
+            self._flush(value)
+        for writer in self.writers.values():
+            writer.close()
+
+
+def write_batches(batches, path: str, partition_cols=('variable',), row_group_rows=128 * 1024) -> int:
+    """Writes record batches incrementally as a hive-partitioned Parquet dataset; returns the row count.
+
+    Partition columns become directory names, the other string columns are dictionary encoded.
+    The first batch fixes the schema.
+    """
+    writer = None
+    for batch in batches:
+        batch = dictionary_encode(batch, keep=partition_cols)
+        if writer is None:
+            writer = PartitionedParquetWriter(path, batch.schema, partition_cols, row_group_rows)
+        writer.write_batch(batch)
+    if writer is None:
+        return 0
+    writer.close()
+    return writer.rows
+
+
+def export_query(client, query: str, path: str, bqstorage_client=None, partition_cols=('variable',)) -> int:
+    """One query to one partitioned Parquet dataset, streamed."""
+    return write_batches(iter_query_batches(client, query, bqstorage_client), path, partition_cols)
+
+
+def export_activity(client, bqstorage_client=None, folder='.', partition_cols=('variable',)) -> dict:
+    """The Watch and iPhone exports, run concurrently (both are network and Parquet-encoder bound,
+    which release the GIL). Returns {dataset path: rows}."""
+    jobs = {os.path.join(folder, 'mhc_export'): activity_query('Watch1', watch_variables),
+            os.path.join(folder, 'mhc_phone_export'): activity_query('iPhone1', phone_variables)}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = {path: pool.submit(export_query, client, query, path, bqstorage_client, partition_cols)
+                   for path, query in jobs.items()}
+        return {path: future.result() for path, future in futures.items()}
+
+
+class FakeRowIterator:
+    def __init__(self, batches):
+        self._batches = batches
+
+    def to_arrow_iterable(self, bqstorage_client=None, max_queue_size=2):
+        return self._batches()
+
+
+class FakeQueryJob:
+    def __init__(self, batches):
+        self._batches = batches
+
+    def result(self):
+        return FakeRowIterator(self._batches)
+
+
+class FakeBigQueryClient:
+    """Stands in for bigquery.Client in the benchmark: query() results are synthetic activity rows,
+    generated lazily in batches of batch_rows like Storage Read API pages."""
+
+    def __init__(self, n_rows=2_000_000, n_patients=500, batch_rows=100_000, seed=0):
+        self.n_rows, self.n_patients, self.batch_rows, self.seed = n_rows, n_patients, batch_rows, seed
+        self.queries = []
+
+    def query(self, query: str):
+        self.queries.append(query)
+        variables = list(phone_variables if "'iPhone1'" in query else watch_variables)
+
+        def batches():
+            rng = np.random.default_rng(self.seed)
+            patients = np.array([f'patient{i:05d}' for i in range(self.n_patients)])
+            for start in range(0, self.n_rows, self.batch_rows):
+                n = min(self.batch_rows, self.n_rows - start)
+                patient = rng.integers(0, self.n_patients, n)
+                yield pa.record_batch({
+                    'patient': pa.array(patients[patient]),
+                    'Group': pa.array(np.where(patient % 4 == 0, 'PAH', 'Healthy')),
+                    'diagnosis_date': pa.array(np.datetime64('2015-01-01') + (patient % 365).astype('timedelta64[D]')),
+                    'startDate': pa.array(np.datetime64('2016-01-01T00:00:00', 'us') + rng.integers(0, 3 * 365 * 86400, n).astype('timedelta64[s]'),
+                                          pa.timestamp('us', tz='UTC')),
+                    'variable': pa.array(np.array(variables)[rng.integers(0, len(variables), n)]),
+                    'value': pa.array(rng.gamma(2.0, 50.0, n)),
+                })
+
+        return FakeQueryJob(batches)
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(n_rows=2_000_000):
+    """Materialize-then-write (the read_gbq path) against the streamed export, on the fake client.
+
+    Run each half in a fresh process for a clean peak RSS: python bq_export.py legacy|streamed
+    """
+    import sys
+    import tempfile
+    folder = tempfile.mkdtemp()
+    client = FakeBigQueryClient(n_rows=n_rows)
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'streamed'
+    tic = time.perf_counter()
+    if mode == 'legacy':
+        for name, device, variables in (('mhc_export', 'Watch1', watch_variables), ('mhc_phone_export', 'iPhone1', phone_variables)):
+            df = pa.Table.from_batches(list(client.query(activity_query(device, variables)).result().to_arrow_iterable())).to_pandas()
+            df.to_parquet(os.path.join(folder, f'{name}.parquet'), index=False)
+            del df
+    else:
+        written = export_activity(client, folder=folder)
+        print(f"streamed: 2 x {n_rows} rows in {time.perf_counter() - tic:.1f}s, peak RSS {peak_rss_mb():.0f} MB")
+        table = ds.dataset(os.path.join(folder, 'mhc_export'), format='parquet', partitioning='hive').to_table()
+        assert table.num_rows == written[os.path.join(folder, 'mhc_export')] == n_rows
+        assert pa.types.is_dictionary(table.schema.field('patient').type)
+        assert set(pc.unique(table['variable']).to_pylist()) == set(watch_variables)
+        return
+    print(f"{mode}: 2 x {n_rows} rows in {time.perf_counter() - tic:.1f}s, peak RSS {peak_rss_mb():.0f} MB")
+
+
+if __name__ == "__main__":
+    benchmark()
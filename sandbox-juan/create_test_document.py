@@ -6,26 +6,16 @@ from firebase_admin import credentials, firestore
 from typing import Generator, Dict
 import logging
 import time
-import re
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firestore_to_BQ_parser'))
+from rate_limiter import limiter, adapt_page_size
+from metrics import clean_metric
 
 # Simplified Logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
-prefixes = [
-    "HealthObservations_HKQuantityTypeIdentifier",
-    "HealthObservations_HKCategoryTypeIdentifier",
-    "HealthObservations_com.apple.SensorKit.",
-    "HealthObservations_HKDataTypeIdentifier",
-    "HealthObservations_HKWorkoutTypeIdentifier",
-    "HealthObservations_MHC"
-]
-pattern = re.compile(f"^({'|'.join(map(re.escape, prefixes))})")
-
-def clean_metric(metric):
-    clean = pattern.sub('', metric)
-    return clean if clean else 'Workout'
-
 class FirestoreStreamer:
     """Focuses solely on streaming data out of Firestore efficiently."""
     
@@ -35,15 +25,22 @@ class FirestoreStreamer:
             firebase_admin.initialize_app(cred)
         self.db = firestore.client()
 
-    def stream_collection(self, collection_ref, batch_size: int = 500) -> Generator[Dict, None, None]:
+    def stream_collection(self, collection_ref, batch_size: int = 500, target_latency: float = 1.0) -> Generator[Dict, None, None]:
         """Generic generator to handle pagination logic once."""
         last_doc = None
+        page_size = batch_size
         while True:
-            query = collection_ref.limit(batch_size)
+            query = collection_ref.limit(page_size)
             if last_doc:
                 query = query.start_after(last_doc)
-            
-            docs = list(query.stream())
+
+            def read_page():
+                tic = time.time()
+                docs = list(query.stream())
+                return docs, time.time() - tic
+
+            # shared adaptive rate limit instead of a fixed sleep per page
+            docs, latency = limiter.call(read_page, tokens=page_size)
             if not docs:
                 break
                 
@@ -51,7 +48,7 @@ class FirestoreStreamer:
                 yield doc
             
             last_doc = docs[-1]
-            time.sleep(0.1) # Soft rate limit
+            page_size = adapt_page_size(page_size, latency, target_latency)
 
     def get_user_observations(self, user_id: str) -> Generator[Dict, None, None]:
         """Streams health observations for a single user."""
@@ -61,7 +58,8 @@ class FirestoreStreamer:
         for sub in user_ref.collections():
             if not sub.id.startswith("HealthObservations"):
                 continue
-                
+            metric = clean_metric(sub.id)
+
             for doc in self.stream_collection(sub):
                 data = doc.to_dict()
                 period = data.get('effectivePeriod')
@@ -70,7 +68,7 @@ class FirestoreStreamer:
                     yield {
                         **period,
                         'user_id': user_id,
-                        'metric': clean_metric(sub.id),
+                        'metric': metric,
                         'value': data.get('valueQuantity', {}).get('value'),
                         'unit': data.get('valueQuantity', {}).get('unit'),
                         'value_str': data.get('valueString')
@@ -0,0 +1,167 @@
+# Out-of-core per (user_id, metric, value_str) snapshot of the firestore_temp*.csv checkpoints.
+# Files are read in chunks (one worker process per file), start is parsed once per chunk, and each
+# chunk is reduced to mergeable partial aggregates (min/max/count/sum/null count), so memory is bounded
+# by the chunk size and the number of groups, not the number of rows.
+# Run: python snapshot_engine.py  - parity check and benchmark against the in-memory version on synthetic files.
+
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firestore_to_BQ_parser'))
+from metrics import registry as metric_registry
+
+keys = ['user_id', 'metric', 'value_str']
+columns = {'user_id': str, 'metric': str, 'value_str': str, 'start': str, 'value': float}
+max_workers = int(os.environ.get("SNAPSHOT_MAX_WORKERS", os.cpu_count() or 1))
+
+# partial aggregate columns -> how partials merge
+merge_aggs = {'start_count': 'sum', 'value_min': 'min', 'value_max': 'max',
+              'value_sum': 'sum', 'value_count': 'sum', 'value_mask_sum': 'sum'}
+
+
+def checkpoint_files(folder: str = 'temp', prefix: str = 'firestore_temp') -> List[str]:
+    return sorted(os.path.join(folder, p) for p in os.listdir(folder) if p.startswith(prefix))
+
+
+def extremes(df: pd.DataFrame, ns: str, text: str, suffix: str) -> pd.DataFrame:
+    """Earliest (suffix 'min') or latest ('max') start of every group, as the parsed time and its original text."""
+    ordered = df.sort_values(ns, kind='stable', na_position='last')
+    grouped = ordered.groupby(keys, sort=False)[[ns, text]]
+    picked = grouped.first() if suffix == 'min' else grouped.last()
+    return picked.set_axis([f'start_{suffix}_ns', f'start_{suffix}'], axis=1)
+
+
+def chunk_aggregates(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Partial aggregates of one chunk of checkpoint rows, indexed by the group keys."""
+    chunk = chunk.dropna(subset=['user_id', 'metric'])
+    chunk = chunk.assign(value_str=chunk['value_str'].fillna('None'),
+                         # parsed once; datetime64 is int64 nanoseconds underneath
+                         start_ns=pd.to_datetime(chunk['start'], format='ISO8601', utc=True),
+                         value_mask=chunk['value'].isna())
+    sums = chunk.groupby(keys, sort=False).agg(
+        start_count=('start', 'count'), value_min=('value', 'min'), value_max=('value', 'max'),
+        value_sum=('value', 'sum'), value_count=('value', 'count'), value_mask_sum=('value_mask', 'sum'))
+    return pd.concat([sums, extremes(chunk, 'start_ns', 'start', 'min'), extremes(chunk, 'start_ns', 'start', 'max')], axis=1)
+
+
+def merge(parts: List[pd.DataFrame]) -> pd.DataFrame:
+    """Merges partial aggregates (of chunks, files or workers) into one partial aggregate."""
+    parts = [p for p in parts if p is not None and len(p)]
+    if len(parts) <= 1:
+        return parts[0] if parts else None
+    combined = pd.concat(parts).reset_index()
+    sums = combined.groupby(keys, sort=False).agg(merge_aggs)
+    first = extremes(combined, 'start_min_ns', 'start_min', 'min')
+    last = extremes(combined, 'start_max_ns', 'start_max', 'max')
+    return pd.concat([sums, first, last], axis=1)
+
+
+def file_aggregates(path: str, chunksize: int = 500_000) -> Optional[pd.DataFrame]:
+    """Partial aggregates of one checkpoint file, read chunksize rows at a time."""
+    result = None
+    for chunk in pd.read_csv(path, usecols=list(columns), dtype=columns, chunksize=chunksize):
+        result = merge([result, chunk_aggregates(chunk)])
+    return result
+
+
+def finalize(agg: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """The snapshot table: one row per group in key order, metric names cleaned."""
+    out_columns = [*keys, 'start_min', 'start_max', 'start_count', 'value_min', 'value_max', 'value_mean', 'value_mask_sum', 'span']
+    if agg is None:
+        return pd.DataFrame(columns=out_columns)
+    agg = agg.sort_index()
+    agg['value_mean'] = agg['value_sum'] / agg['value_count'].where(agg['value_count'] > 0)
+    agg['span'] = (agg['start_max_ns'] - agg['start_min_ns']).dt.days
+    df = agg.reset_index()
+    df['metric'] = metric_registry.clean_series(df['metric']).astype(str)
+    return df.loc[:, out_columns]
+
+
+def snapshot(files: List[str], out_path: Optional[str] = None, workers: int = max_workers, chunksize: int = 500_000) -> pd.DataFrame:
+    """Snapshot of the checkpoint files, one worker process per file; written to out_path if given."""
+    # fork, so the workers do not re-run the calling script on import (spawn/forkserver do)
+    if workers > 1 and len(files) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(min(workers, len(files)), mp_context=multiprocessing.get_context('fork')) as pool:
+            result = None
+            for part in pool.map(file_aggregates, files, [chunksize] * len(files)):
+                result = merge([result, part])
+    else:
+        result = None
+        for path in files:
+            result = merge([result, file_aggregates(path, chunksize)])
+    df = finalize(result)
+    if out_path:
+        df.to_csv(out_path)
+    return df
+
+
+def legacy_snapshot(files: List[str]) -> pd.DataFrame:
+    """The former in-memory concat + groupby of analytics_test.py, kept as the parity reference."""
+    df = pd.concat([pd.read_csv(p, dtype={k: str for k in keys}) for p in files], axis=0, ignore_index=True)
+    df['value_str'] = df['value_str'].fillna('None')
+    df['value_mask'] = df['value'].isna().astype(int)
+    df_a = df.groupby(keys).agg({'start': ['min', 'max', 'count'], 'value': ['min', 'max', 'mean'], 'value_mask': 'sum'}).reset_index()
+    df_a.columns = ['_'.join(col).strip() if col[1] else col[0] for col in df_a.columns.values]
+    df_a['span'] = (pd.to_datetime(df_a['start_max'], format='ISO8601', utc=True) - pd.to_datetime(df_a['start_min'], format='ISO8601', utc=True)).dt.days
+    df_a['metric'] = metric_registry.clean_series(df_a['metric']).astype(str)
+    return df_a
+
+
+def synthetic_checkpoints(folder: str, n_files: int = 4, rows: int = 500_000, n_users: int = 300, seed: int = 0) -> List[str]:
+    """Checkpoint CSVs shaped like the parser's firestore_temp files (NaN values, value_str answers).
+
+    Every row has a start: the in-memory groupby fails on a missing one (str vs float min), the engine does not.
+    """
+    rng = np.random.default_rng(seed)
+    metrics = ['HealthObservations_HKQuantityTypeIdentifierStepCount', 'HeartRate', 'HealthObservations_HKWorkoutTypeIdentifier',
+               'HealthObservations_HKCategoryTypeIdentifierSleepAnalysis', 'HealthObservations_MHCHealthObservationTimedWalkingTestResultIdentifier']
+    paths = []
+    for i in range(n_files):
+        start = pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 400 * 86400, rows), unit='s')
+        df = pd.DataFrame({
+            'start': start.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'end': (start + pd.Timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'user_id': np.array([f'user{u:04d}' for u in range(n_users)])[rng.integers(0, n_users, rows)],
+            'metric': np.array(metrics)[rng.integers(0, len(metrics), rows)],
+            'value': rng.gamma(2.0, 40.0, rows),
+            'unit': 'count',
+            'value_str': np.where(rng.random(rows) < 0.1, np.array(['asleep', 'inBed'])[rng.integers(0, 2, rows)], None),
+        })
+        df.loc[rng.random(rows) < 0.05, 'value'] = np.nan
+        paths.append(os.path.join(folder, f'firestore_temp_{i}.csv'))
+        df.to_csv(paths[-1], index=False)
+    return paths
+
+
+def check_parity(files: List[str], **kwargs):
+    """Asserts the engine's snapshot equals the in-memory one (means to float tolerance: sums merge in a different order)."""
+    expected, result = legacy_snapshot(files), snapshot(files, **kwargs)
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result.drop(columns='value_mean'), expected.drop(columns='value_mean'), check_dtype=False)
+    np.testing.assert_allclose(result['value_mean'], expected['value_mean'], rtol=1e-9)
+    print(f"snapshot matches ({len(result)} groups)")
+
+
+def benchmark(n_files: int = 4, rows: int = 500_000):
+    import subprocess
+    import tempfile
+    folder = tempfile.mkdtemp()
+    here = os.path.dirname(os.path.abspath(__file__))
+    # generation and both timings in fresh processes, before this one grows: peak RSS is inherited across fork/exec
+    run = lambda code: subprocess.run([sys.executable, '-c', f"import resource, time, snapshot_engine as s; {code}"], check=True, cwd=here)
+    run(f"s.synthetic_checkpoints({folder!r}, {n_files}, {rows})")
+    files = checkpoint_files(folder)
+    for name, call in (('in-memory', 'legacy_snapshot(files)'), ('chunked', 'snapshot(files, chunksize=100_000)')):
+        run(f"files = {files!r}; tic = time.perf_counter(); s.{call}; "
+            f"print(f'{name}: {{time.perf_counter() - tic:.1f}}s, peak RSS {{max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024:.0f}} MB')")
+    print(f"{n_files} files x {rows} rows")
+    check_parity(files, chunksize=100_000)
+
+
+if __name__ == "__main__":
+    benchmark()